@@ -1,17 +1,31 @@
-from PIL import Image, ImageTk
-from typing import Any
+from __future__ import annotations
+import functools
+from typing import Any, TYPE_CHECKING
 
-from psd_handler import PSDVarianceHandler, Category, DEBUG, VHError, PSDImage
+from psd_handler import PSDVarianceHandler, Category, VHError
+import tracing
+
+if TYPE_CHECKING:
+    from PIL import Image
+    from psd_tools import PSDImage
 
 class NotAllowedError(Exception):
     pass
 
+def _locked(fn):
+    '''修改类别树的接口持有 vh.lock，与后台渲染线程互斥'''
+    @functools.wraps(fn)
+    def wrapper(vh:PSDVarianceHandler, *args, **kwargs):
+        with vh.lock:
+            return fn(vh, *args, **kwargs)
+    return wrapper
+
+@_locked
 def reverse_visibility(vh:PSDVarianceHandler, 
                        target_name:str, 
                        parent_names:list[str]):
     '''parent_names: list of parent names from the root to the target category (not included)'''
-    if DEBUG:
-        print(f"Reverse visibility for {target_name} with parents: {parent_names}")
+    tracing.log(f"Reverse visibility for {target_name} with parents: {parent_names}")
     categories = vh.get_Categories(parent_names)
     final_c = categories[-1]
     if final_c.mode == 'all':
@@ -37,20 +51,36 @@ def reverse_visibility(vh:PSDVarianceHandler,
         final_c.visibilities = [not final_c.visibilities[idx]] * len(final_c.visibilities)
     else:
         raise VHError(f"Unknown mode({final_c.mode}) for category {final_c.name}")
+    final_c.notify()
     
-def get_visible_image(vh:PSDVarianceHandler) -> Image:
-    return vh.save_png()
+def get_visible_image(vh:PSDVarianceHandler, backend:str|None=None) -> Image:
+    return vh.save_png(backend=backend)
 
 def get_specific_layers_image(vh:PSDVarianceHandler, 
                               target_names:str|list[str], 
-                              visible:bool=False
+                              visible:bool=False,
+                              backend:str|None=None,
+                              crop:bool=False
                               ) -> Image:
     '''parent_names: list of parent names from the root to the target category (not included)
-    visible: if True, only visible layers will be shown'''
-    if DEBUG:
-        print(f"Get specific layers image for {target_names}")
-    layer_idxs = [t for t in target_names if t in vh.layer_dict.keys()]
-    others = [t for t in target_names if t not in vh.layer_dict.keys()]
+    visible: if True, only visible layers will be shown
+    backend: 'pil', 'numpy' or 'psd_tools'; None uses vh.backend
+    crop: if True, only the union bbox of the layers is rendered and returned'''
+    tracing.log(f"Get specific layers image for {target_names}")
+    layer_idxs = get_specific_layer_idxs(vh, target_names, visible)
+    if crop:
+        return vh.render_bbox(layer_idxs, backend)[0]
+    return vh.render(layer_idxs, backend)
+
+def get_specific_layer_idxs(vh:PSDVarianceHandler,
+                            target_names:str|list[str],
+                            visible:bool=False
+                            ) -> list[str]:
+    '''target_names 中的图层下标与类别 (DFS 查找) 对应的叶子图层下标
+    visible: if True, only visible layers of the categories are included'''
+    # 用 leaf_index 判断图层下标，不需要打开 PSD
+    layer_idxs = [t for t in target_names if t in vh.leaf_index]
+    others = [t for t in target_names if t not in vh.leaf_index]
     categories = vh.get_Categories(others, search_mode=1)
     for c in categories:
         if visible:
@@ -58,9 +88,8 @@ def get_specific_layers_image(vh:PSDVarianceHandler,
                 layer_idxs.extend(result)
         else:
             if result := c.get_all_layers():
-                layer_idxs.append(result)
-    psd_image = vh.copy_psd(layer_idxs)
-    return psd_image.composite(force=True)
+                layer_idxs.extend(result)
+    return vh.parse_layer(layer_idxs)
 
 
 def get_psd_layers_dict(vh:PSDVarianceHandler, 
@@ -71,8 +100,7 @@ def get_psd_layers_dict(vh:PSDVarianceHandler,
     show_image 代表是否返回合成图像
     
     返回值：(dict, PIL.Image)，其中图片是所有图层的合成图，dict是图层的字典，具有嵌套结构。'''
-    if DEBUG:
-        print(f"Get PSD layers dict for {search_root}")
+    tracing.log(f"Get PSD layers dict for {search_root}")
     if search_root is None:
         search_root = vh.psd
     if isinstance(search_root, str):
@@ -80,31 +108,62 @@ def get_psd_layers_dict(vh:PSDVarianceHandler,
             raise VHError(f"Layer {search_root} not found in PSD!")
         search_root = vh.layer_dict[search_root]
     if show_image:
-        image = search_root.composite()
+        image = _composite_subtree(vh, search_root)
     else:
         image = None
     
+    if not search_root.is_group():
+        return {search_root.name: None}, image
     return {search_root.name: [
         get_psd_layers_dict(vh, x, show_image=False)[0] for x in search_root
     ]}, image
 
+def _composite_subtree(vh:PSDVarianceHandler, search_root) -> Image.Image:
+    '''
+    用 vh.render 合成 search_root 下在 PSD 中可见的叶子图层，图层与图层组裁剪到自身范围。
+    不调用 composite()，lazy 模式下的 LazyPSD/LazyLayer 同样可用
+    '''
+    if search_root is vh.psd:
+        root_idx, leaves = '', list(vh.z_order)
+    else:
+        root_idx = next((idx for idx, layer in vh.layer_dict.items() if layer is search_root), None)
+        if root_idx is None:
+            raise VHError(f"Layer {search_root.name} not found in PSD!")
+        leaves = vh.get_all_leaf_layer_name(root_idx)
+    def visible(idx:str) -> bool:
+        # 叶子及其在 search_root 之下的祖先图层组都可见
+        while len(idx) > len(root_idx):
+            if not vh.layer_dict[idx].visible:
+                return False
+            idx = idx.rpartition('-')[0]
+        return True
+    layer_idxs = [idx for idx in leaves if visible(idx)]
+    if root_idx:
+        # 与 composite() 一致，只合成可见叶子图层范围的并集，超出画布的部分为透明
+        from renderer import union_bbox
+        if (bbox := union_bbox(vh.layer_bbox[idx] for idx in layer_idxs)) is not None:
+            return vh.render(layer_idxs, viewport=bbox)
+    return vh.render(layer_idxs)
+
+@_locked
 def rename_sub_c(vh:PSDVarianceHandler, 
                  target_name:str, 
                  parent_names:list[str], 
                  new_name:str):
     '''parent_names: list of parent names from the root to the target category (not included)'''
-    if DEBUG:
-        print(f"Rename {target_name} to {new_name} with parents: {parent_names}")
+    tracing.log(f"Rename {target_name} to {new_name} with parents: {parent_names}")
     categories = vh.get_Categories(parent_names)
     final_c = categories[-1]
     if result := final_c.get_sub(target_name):
         target_c = result[1]
         target_c.name = new_name
+        final_c.notify()
     elif result := final_c.get_layer(target_name):
         raise NotAllowedError(f"不能修改底层图层名！{target_name}")
     else:
         raise VHError(f"Category {target_name} not found in {parent_names}")
 
+@_locked
 def add_sub_c(vh:PSDVarianceHandler, 
               target_name:str, 
               parent_names:list[str], 
@@ -112,8 +171,7 @@ def add_sub_c(vh:PSDVarianceHandler,
               new_c_mode:str='unk'
               ) -> Category:
     '''parent_names: list of parent names from the root to the target category (not included)'''
-    if DEBUG:
-        print(f"Add sub-category {new_c_name} to {target_name} with parents: {parent_names}")
+    tracing.log(f"Add sub-category {new_c_name} to {target_name} with parents: {parent_names}")
     vh._check_layer_idx_double_name(new_c_name)
     categories = vh.get_Categories(parent_names)
     final_c = categories[-1]
@@ -126,12 +184,12 @@ def add_sub_c(vh:PSDVarianceHandler,
     
     return target_c.add_sub(new_c_name, new_c_mode)
 
+@_locked
 def delete_sub_c(vh:PSDVarianceHandler,
                  target_name:str,
                  parent_names:list[str]):
     '''parent_names: list of parent names from the root to the target category (not included)'''
-    if DEBUG:
-        print(f"Delete sub-category {target_name} with parents: {parent_names}")
+    tracing.log(f"Delete sub-category {target_name} with parents: {parent_names}")
     categories = vh.get_Categories(parent_names)
     final_c = categories[-1]
     if result := final_c.get_sub(target_name):
@@ -141,15 +199,15 @@ def delete_sub_c(vh:PSDVarianceHandler,
     else:
         raise VHError(f"Category {target_name} not found in {parent_names}")
     
-    final_c.subcategories.remove(target_c)
+    final_c.remove_sub(target_c.name)
 
+@_locked
 def change_mode(vh:PSDVarianceHandler, 
                 target_name:str, 
                 parent_names:list[str], 
                 new_mode:str):
     '''parent_names: list of parent names from the root to the target category (not included)'''
-    if DEBUG:
-        print(f"Change mode of {target_name} to {new_mode} with parents: {parent_names}")
+    tracing.log(f"Change mode of {target_name} to {new_mode} with parents: {parent_names}")
     if new_mode not in ('all', 'or', 'one', 'same'):
         raise NotAllowedError(f"不允许的模式：{new_mode}！")
     categories = vh.get_Categories(parent_names)
@@ -167,14 +225,16 @@ def change_mode(vh:PSDVarianceHandler,
         target_c.visibilities = [True] * len(target_c.visibilities)
     elif new_mode == 'one':
         target_c.visibilities[0] = True
+    target_c.notify()
+    final_c.notify()
 
+@_locked
 def add_layer(vh:PSDVarianceHandler, 
               target_name:str, 
               parent_names:list[str], 
               new_layer_name:str):
     '''parent_names: list of parent names from the root to the target category (not included)'''
-    if DEBUG:
-        print(f"Add layer {new_layer_name} to {target_name} with parents: {parent_names}")
+    tracing.log(f"Add layer {new_layer_name} to {target_name} with parents: {parent_names}")
     vh._check_layer_idx_double_name(new_layer_name)
     if new_layer_name not in vh.layer_dict.keys():
         raise VHError(f"Layer {new_layer_name} not found in PSD!")
@@ -182,16 +242,16 @@ def add_layer(vh:PSDVarianceHandler,
     final_c = categories[-1]
     final_c.add_layer(new_layer_name)
 
+@_locked
 def delete_layer(vh:PSDVarianceHandler,
                  target_name:str,
                  parent_names:list[str]):
     '''parent_names: list of parent names from the root to the target category (not included)'''
-    if DEBUG:
-        print(f"Delete layer {target_name} with parents: {parent_names}")
+    tracing.log(f"Delete layer {target_name} with parents: {parent_names}")
     categories = vh.get_Categories(parent_names)
     final_c = categories[-1]
     if target_name not in final_c.layers:
         raise VHError(f"Layer {target_name} not found in {parent_names}")
-    final_c.layers.remove(target_name)
+    final_c.remove_layer(target_name)
 
     
\ No newline at end of file
@@ -0,0 +1,259 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+from PIL import Image
+
+from psd_handler import PSDVarianceHandler, VHError
+from renderer import PrefixCache
+from encoders import Encoder, write_atomic
+import tracing
+
+# 每个工作进程只打开并解码一次 PSD
+_worker_vh:PSDVarianceHandler|None = None
+# 工作进程中已打开的共享内存槽，按名称缓存
+_worker_slots:dict[str, SharedMemory] = {}
+
+def _slot(name:str) -> SharedMemory:
+    if (slot := _worker_slots.get(name)) is None:
+        slot = _worker_slots[name] = SharedMemory(name)
+    return slot
+
+def _init_tracing(trace:bool):
+    # fork 出的进程继承了主进程的 sink，改为只记录，由主进程转发
+    if trace:
+        tracing.enable(tracing.Recorder())
+    else:
+        tracing.disable()
+
+def _init_worker(psd_path:str, handler_kwargs:dict, prefix_cache_bytes:int, trace:bool=False):
+    global _worker_vh
+    _init_tracing(trace)
+    _worker_vh = PSDVarianceHandler(psd_path, **handler_kwargs)
+    if prefix_cache_bytes > 0:
+        # 预算容纳不下足够多的画布时 for_budget 返回 None，不缓存
+        _worker_vh.compositor.prefix_cache = PrefixCache.for_budget(prefix_cache_bytes, _worker_vh.size)
+
+def _records() -> list[tuple]|None:
+    return recorder.drain() if (recorder := tracing.recorder()) is not None else None
+
+def _handler_kwargs(vh:PSDVarianceHandler) -> dict:
+    # 每个差分只渲染一次，工作进程不需要完成图缓存
+    return {'lazy': vh.lazy, 'cache_dir': vh.cache_dir, 'backend': vh.backend, 'render_cache_bytes': 0,
+            'incremental': vh.incremental}
+
+def _render_worker(layer_idxs:list[str], output_path:str, encoder:Encoder|None, slot:str|None=None):
+    '''
+    encoder 为 None 时把像素写入主进程分配的共享内存槽 slot，由编码进程池读出写文件，
+    像素不经过主进程；图像大于槽时才随结果返回。
+    返回值的最后一项是本任务的 tracing 记录 (未开启时为 None)
+    '''
+    image = _worker_vh.render(layer_idxs)
+    if encoder is not None:
+        with tracing.span('write'):
+            digest = write_atomic(encoder.encode(image), output_path)
+        return output_path, digest, _records()
+    data = image.tobytes()
+    if len(data) <= (buf := _slot(slot).buf).nbytes:
+        buf[:len(data)] = data
+        data = len(data)
+    return output_path, image.mode, image.size, data, _records()
+
+def _encode_worker(output_path:str, mode:str, size:tuple[int, int], data:bytes|int, encoder:Encoder,
+                   slot:str|None=None) -> tuple[str, str, list|None]:
+    '''data 为 int 时像素是共享内存槽 slot 的前 data 个字节'''
+    if isinstance(data, int):
+        with _slot(slot).buf[:data] as view:
+            image = Image.frombytes(mode, size, view)
+    else:
+        image = Image.frombytes(mode, size, data)
+    with tracing.span('write'):
+        digest = write_atomic(encoder.encode(image), output_path)
+    return output_path, digest, _records()
+
+def _facts_worker(layer_idxs:list[str]) -> tuple[dict, list|None]:
+    cache = _worker_vh.layer_cache
+    return {idx: cache.facts(idx) for idx in layer_idxs}, _records()
+
+def prime_layer_facts(vh:PSDVarianceHandler, max_workers:int|None=None, pool:ProcessPoolExecutor|None=None):
+    '''
+    在进程池中解码叶子图层、计算 LayerFacts 并交给 vh.layer_cache，
+    之后主进程中的 normalize/effective_key (去重) 不必在主进程里逐个解码图层。
+    pool 为 None 时临时创建 max_workers 个进程；给出 pool (如 render_jobs 的渲染进程池) 时
+    图层在各工作进程中解码后留在其缓存里，渲染时不再重复解码。
+    '''
+    leaves = vh.layer_cache.missing_facts()
+    if not leaves:
+        return
+    workers = max_workers or os.cpu_count() or 1
+    own = pool is None
+    if own:
+        pool = ProcessPoolExecutor(workers, initializer=_init_worker,
+                                   initargs=(vh.psd_path, _handler_kwargs(vh), 0, tracing.ENABLED))
+    try:
+        # 每个进程分几块，图层大小不均时也能分摊
+        n = min(len(leaves), workers * 4)
+        with tracing.span('facts', layers=len(leaves)):
+            for facts, records in pool.map(_facts_worker, [leaves[i::n] for i in range(n)]):
+                tracing.replay(records, stage='facts')
+                vh.layer_cache.add_facts(facts)
+    finally:
+        if own:
+            pool.shutdown()
+
+def iter_render_jobs(vh:PSDVarianceHandler, output_dir:str, name_template:str='{index:05d}.png', variants=None, with_variants:bool=False):
+    '''
+    依次产出每个差分的 (输出路径, 可见叶子图层下标)，不修改 root。
+    name_template 可使用 {index} 与 {name} (见 Category.variant_name)。
+    with_variants 为 True 时产出 (输出路径, 可见叶子图层下标, 差分)。
+    '''
+    compiled = vh.compile_categories()
+    if variants is None:
+        states = compiled.iter_states()
+    else:
+        states = ((state, compiled.mask_of(state)) for state in map(compiled.variant_to_state, variants))
+    need_name = '{name' in name_template
+    for index, (state, mask) in enumerate(states):
+        variant = compiled.state_to_variant(state) if need_name or with_variants else None
+        name = vh.root.variant_name(variant) if need_name else ''
+        output_path = os.path.join(output_dir, name_template.format(index=index, name=name))
+        if with_variants:
+            yield output_path, sorted(compiled.visible_layer_idxs(mask)), variant
+        else:
+            yield output_path, sorted(compiled.visible_layer_idxs(mask))
+
+def render_jobs(vh:PSDVarianceHandler,
+                jobs,
+                max_workers:int|None=None,
+                max_pending:int|None=None,
+                prefix_cache_bytes:int=0,
+                on_done=None,
+                encoder:Encoder|None=None,
+                encode_workers:int|None=None,
+                prime_facts:bool=False
+                ) -> int:
+    '''
+    在进程池中渲染 jobs 中的 (输出路径, 可见叶子图层下标)，返回完成的数量。
+    合成与编码是两个流水线阶段：渲染进程只合成，像素经共享内存交给独立的 encode_workers 个编码进程
+    按 encoder (默认 PNG) 编码写出，合成进程不必等待压缩。
+    max_workers 是两个进程池共用的 CPU 预算 (默认为 CPU 核数)：编码进程默认占三分之一，其余为渲染进程；
+    encode_workers 为 0 (或预算不足 3) 时在渲染进程内直接编码。
+    jobs 是惰性读取的，两个阶段在途的任务总数不超过 max_pending (默认 4 × 进程数)，以限制内存。
+    prefix_cache_bytes > 0 时每个工作进程持有一个该预算的 PrefixCache，默认不缓存部分合成结果：
+    任务交错分给各进程，前缀复用有限，图层少时反而更慢 (见 python -m bench run 的 prefix 阶段)。
+    on_done(输出路径, sha256) 在主进程中按完成顺序调用。
+    prime_facts 为 True 时，在读取 jobs 之前先用渲染进程池计算图层属性 (见 prime_layer_facts)，供 jobs 去重。
+    开启 tracing 时，工作进程的计时与计数随结果交回，在主进程中转发给 sink (附带 pid)。
+    '''
+    budget = max_workers or os.cpu_count() or 1
+    if encode_workers is None:
+        encode_workers = budget // 3
+    encode_workers = min(encode_workers, budget - 1)
+    render_workers = budget - encode_workers
+    max_pending = max_pending or budget * 4
+    encoder = encoder or Encoder()
+    count = 0
+    # 任务 -> 共享内存槽，槽在编码完成后回收
+    rendering:dict = {}
+    encoding:dict = {}
+    slots:list[SharedMemory] = []
+    free:list[str] = []
+    trace = tracing.ENABLED
+    if encode_workers > 0:
+        # 工作进程打开共享内存时也会登记到 resource_tracker，先启动让所有进程共用，由主进程统一 unlink
+        resource_tracker.ensure_running()
+    render_pool = ProcessPoolExecutor(render_workers, initializer=_init_worker,
+                                      initargs=(vh.psd_path, _handler_kwargs(vh), prefix_cache_bytes, trace))
+    encode_pool = ProcessPoolExecutor(encode_workers, initializer=_init_tracing, initargs=(trace,)) if encode_workers > 0 else None
+    def acquire() -> str:
+        if not free:
+            slot = SharedMemory(create=True, size=vh.size[0] * vh.size[1] * 4)
+            slots.append(slot)
+            free.append(slot.name)
+        return free.pop()
+    def finish(output_path:str, digest:str):
+        nonlocal count
+        count += 1
+        if on_done is not None:
+            on_done(output_path, digest)
+    def drain():
+        done, _ = wait(rendering.keys() | encoding.keys(), return_when=FIRST_COMPLETED)
+        for future in done:
+            *result, records = future.result()
+            tracing.replay(records, stage='render' if future in rendering else 'encode')
+            if future in rendering:
+                slot = rendering.pop(future)
+                if encode_pool is None:
+                    finish(*result)
+                else:
+                    encoding[encode_pool.submit(_encode_worker, *result, encoder, slot)] = slot
+            else:
+                free.append(encoding.pop(future))
+                finish(*result)
+    try:
+        if prime_facts:
+            prime_layer_facts(vh, render_workers, render_pool)
+        for output_path, layer_idxs in jobs:
+            if encode_pool is None:
+                rendering[render_pool.submit(_render_worker, layer_idxs, output_path, encoder)] = None
+            else:
+                slot = acquire()
+                rendering[render_pool.submit(_render_worker, layer_idxs, output_path, None, slot)] = slot
+            while len(rendering) + len(encoding) >= max_pending:
+                drain()
+        while rendering or encoding:
+            drain()
+    finally:
+        render_pool.shutdown(cancel_futures=True)
+        if encode_pool is not None:
+            encode_pool.shutdown(cancel_futures=True)
+        for slot in slots:
+            slot.close()
+            slot.unlink()
+    return count
+
+def render_variants(vh:PSDVarianceHandler,
+                    output_dir:str,
+                    name_template:str='{index:05d}.png',
+                    variants=None,
+                    max_workers:int|None=None,
+                    max_pending:int|None=None,
+                    prefix_cache_bytes:int=0,
+                    encoder:Encoder|None=None,
+                    encode_workers:int|None=None,
+                    dedupe:bool=True
+                    ) -> list[str]:
+    '''
+    在进程池中渲染差分并写入 output_dir。variants 为 None 时渲染 vh.iter_variants() 的全部结果。
+    差分是惰性生成的，同时在途的任务数不超过 max_pending (默认 4 × 进程数)。
+    prefix_cache_bytes > 0 时每个工作进程持有一个该预算的 PrefixCache，默认不缓存部分合成结果：
+    任务交错分给各进程，前缀复用有限，图层少时反而更慢 (见 python -m bench run 的 prefix 阶段)。
+    encoder 决定输出格式 (见 encoders.Encoder)，输出文件的扩展名会换成该格式的扩展名。
+    dedupe 为 True 时按 LayerCache.effective_key 合并像素相同的差分，只渲染第一个，
+    之后的差分在返回值中指向第一个的输出路径，不再写文件。所需的图层属性在渲染进程中计算。
+    返回按差分顺序排列的输出路径。
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    encoder = encoder or Encoder()
+    outputs = []
+    seen = set()
+    rendered:dict[tuple, str] = {}
+    def jobs():
+        for output_path, layer_idxs in iter_render_jobs(vh, output_dir, name_template, variants):
+            output_path = encoder.output_path(output_path)
+            if output_path in seen:
+                raise VHError(f"输出文件名重复: {output_path}，请在 name_template 中使用 {{index}}")
+            seen.add(output_path)
+            if dedupe:
+                key = vh.layer_cache.effective_key(layer_idxs)
+                if (first := rendered.get(key)) is not None:
+                    outputs.append(first)
+                    continue
+                rendered[key] = output_path
+            outputs.append(output_path)
+            yield output_path, layer_idxs
+    count = render_jobs(vh, jobs(), max_workers, max_pending, prefix_cache_bytes, encoder=encoder, encode_workers=encode_workers,
+                        prime_facts=dedupe)
+    tracing.log(f"已渲染 {count} 个差分到 {output_dir}，共 {len(outputs)} 个差分")
+    return outputs
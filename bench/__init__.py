@@ -0,0 +1,12 @@
+'''
+性能基准：生成合成 PSD 与类别配置，对打开、索引、可见图层解析、合成、编码与批量渲染分别计时。
+
+    python -m bench run -o results.json [--layers 256 --depth 3 --fanout 4 --size 2048x2048 ...]
+    python -m bench tree -o tree.json [--nodes 50000 --fanout 4]
+    python -m bench compare old.json new.json
+
+不需要网络，只依赖 requirements.txt 中的库与 numpy。
+'''
+from bench.synth import generate
+from bench.run import run_benchmarks, compare, environment, STAGES
+from bench.tree import generate_tree, run_tree_benchmarks, TREE_STAGES
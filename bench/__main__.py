@@ -0,0 +1,116 @@
+import argparse, json, os, sys, tempfile
+
+from bench.synth import generate, MODES
+from bench.run import run_benchmarks, compare, environment, STAGES, RESULT_VERSION
+from bench.tree import run_tree_benchmarks, TREE_STAGES
+
+def _size(text:str) -> tuple[int, int]:
+    width, _, height = text.lower().partition('x')
+    return int(width), int(height or width)
+
+def _dump(output:dict, path:str|None):
+    text = json.dumps(output, ensure_ascii=False, indent=2)
+    if path:
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench', description='PSD 差分性能基准')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('run', help='生成合成 PSD 并计时')
+    p.add_argument('-o', '--output', help='结果 JSON 路径，默认输出到 stdout')
+    p.add_argument('--psd', help='使用已有的 PSD，需同时给出 --config')
+    p.add_argument('--config', help='与 --psd 对应的 vh_config.json')
+    p.add_argument('--work-dir', help='合成 PSD 的保存目录，默认为临时目录 (结束后删除)')
+    p.add_argument('--layers', type=int, default=64)
+    p.add_argument('--depth', type=int, default=2)
+    p.add_argument('--fanout', type=int, default=4)
+    p.add_argument('--size', type=_size, default=(1024, 1024), help='画布大小，如 2048x1536')
+    p.add_argument('--coverage', type=float, default=0.25, help='每个图层范围占画布面积的比例')
+    p.add_argument('--modes', default=','.join(MODES), help='类别模式，逗号分隔，按先序轮流分配')
+    p.add_argument('--opaque', type=float, default=0.2, help='完全不透明图层的比例')
+    p.add_argument('--blend', type=float, default=0.0, help='非普通混合模式图层的比例')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--stages', default=','.join(STAGES), help=f'要计时的阶段，逗号分隔: {",".join(STAGES)}')
+    p.add_argument('--repeat', type=int, default=5)
+    p.add_argument('--backends', default='pil,numpy,psd_tools')
+    p.add_argument('--formats', default='png,webp,raw,qoi')
+    p.add_argument('--batch-variants', type=int, default=64)
+    p.add_argument('-j', '--jobs', type=int, help='batch 阶段的进程数')
+
+    p = subparsers.add_parser('tree', help='生成大类别树，测量内存与加载/保存时间')
+    p.add_argument('-o', '--output', help='结果 JSON 路径，默认输出到 stdout')
+    p.add_argument('--nodes', type=int, default=50000, help='类别数')
+    p.add_argument('--fanout', type=int, default=4, help='平均子类别数')
+    p.add_argument('--layers-per-leaf', type=int, default=4)
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--stages', default=','.join(TREE_STAGES), help=f'要计时的阶段，逗号分隔: {",".join(TREE_STAGES)}')
+    p.add_argument('--repeat', type=int, default=5)
+
+    p = subparsers.add_parser('compare', help='比较两次结果的中位数')
+    p.add_argument('old')
+    p.add_argument('new')
+    p.add_argument('--threshold', type=float, default=1.1, help='新/旧超过该比值视为变慢，退出码为 1')
+
+    args = parser.parse_args(argv)
+    if args.command == 'compare':
+        with open(args.old, 'r', encoding='utf-8') as f:
+            old = json.load(f)
+        with open(args.new, 'r', encoding='utf-8') as f:
+            new = json.load(f)
+        rows = compare(old, new, args.threshold)
+        regressed = False
+        for name, before, after, ratio, slower in rows:
+            regressed |= slower
+            print(f"{name:32s} {before * 1000:10.2f}ms {after * 1000:10.2f}ms {ratio:7.2f}x{'  变慢' if slower else ''}")
+        return 1 if regressed else 0
+    if args.command == 'tree':
+        tree = {'nodes': args.nodes, 'fanout': args.fanout, 'layers_per_leaf': args.layers_per_leaf, 'seed': args.seed}
+        results = run_tree_benchmarks(args.nodes, args.fanout, args.layers_per_leaf, args.stages.split(','),
+                                      args.repeat, args.seed, progress=lambda name: print(name, file=sys.stderr))
+        _dump({'version': RESULT_VERSION, 'environment': environment(), 'tree': tree, 'results': results}, args.output)
+        return 0
+
+    synth = None
+    temp_dir = None
+    if args.psd or args.config:
+        if not (args.psd and args.config):
+            parser.error('--psd 与 --config 必须同时给出')
+        psd_path, config_path = args.psd, args.config
+    else:
+        synth = {
+            'layers': args.layers, 'depth': args.depth, 'fanout': args.fanout, 'size': list(args.size),
+            'coverage': args.coverage, 'modes': args.modes.split(','), 'opaque': args.opaque,
+            'blend': args.blend, 'seed': args.seed,
+        }
+        if args.work_dir:
+            work_dir = args.work_dir
+        else:
+            # 未指定 --work-dir 时生成的 PSD 在结束后删除
+            temp_dir = tempfile.TemporaryDirectory(prefix='vh_bench_')
+            work_dir = temp_dir.name
+    try:
+        if synth is not None:
+            psd_path, config_path = generate(work_dir, **{**synth, 'size': args.size, 'modes': tuple(synth['modes'])})
+        results = run_benchmarks(
+            psd_path, config_path, args.stages.split(','), args.repeat, args.backends.split(','), args.formats.split(','),
+            args.batch_variants, args.jobs, args.seed, progress=lambda name: print(name, file=sys.stderr))
+        output = {
+            'version': RESULT_VERSION,
+            'environment': environment(),
+            'synth': synth,
+            'psd_path': os.path.abspath(psd_path),
+            'psd_bytes': os.path.getsize(psd_path),
+            'results': results,
+        }
+    finally:
+        if temp_dir is not None:
+            temp_dir.cleanup()
+    _dump(output, args.output)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
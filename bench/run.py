@@ -0,0 +1,146 @@
+'''
+各阶段计时。每个阶段重复 repeat 次，记录每次的秒数与统计值；结果是可以直接 json.dump 的字典。
+'''
+import gc, itertools, os, platform, shutil, statistics, subprocess, sys, tempfile, time
+
+import PIL
+import psd_tools
+from psd_tools import PSDImage
+
+import psd_handler
+from psd_handler import PSDVarianceHandler
+from renderer import Compositor, PrefixCache
+from encoders import Encoder
+from batch import iter_render_jobs
+
+RESULT_VERSION = 1
+STAGES = ('open', 'index', 'handler', 'parse_layer', 'visible', 'copy_psd', 'composite', 'prefix', 'encode', 'batch')
+
+def timeit(fn, repeat:int=5, setup=None) -> dict:
+    '''运行 fn repeat 次，setup 在每次计时前调用 (不计时)'''
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        gc.collect()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {
+        'repeat': repeat,
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.fmean(times),
+        'max': max(times),
+        'times': times,
+    }
+
+def _git_commit() -> str|None:
+    try:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        result = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root, capture_output=True, text=True, timeout=10)
+        return result.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def environment() -> dict:
+    return {
+        'commit': _git_commit(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'pillow': PIL.__version__,
+        'psd_tools': psd_tools.__version__,
+    }
+
+def run_benchmarks(psd_path:str, config_path:str, stages=STAGES, repeat:int=5,
+                   backends=('pil', 'numpy', 'psd_tools'), formats=('png', 'webp', 'raw', 'qoi'),
+                   batch_variants:int=64, batch_workers:int|None=None, seed:int=0, progress=None) -> dict:
+    '''
+    对 psd_path / config_path 运行 stages 中的阶段，返回 {阶段名: 计时统计}。
+    composite 与 encode 按后端、格式分别计时，键为 'composite.pil'、'encode.png' 等；
+    composite.<后端>.cold 为新建 handler 后第一次合成 (含图层解码)。
+    prefix.off / prefix.on 为按枚举顺序 (与 manifest 相同) 依次合成前 batch_variants 个差分，不使用与使用 256 MiB
+    的 PrefixCache；画布太大、预算内放不下足够多的前缀时不记录 prefix.on。prefix.on 另记录命中次数。
+    batch 为 render_variants 渲染 batch_variants 个抽样差分 (不合并相同差分)，另记录每秒差分数。
+    progress: 可选的 callback(阶段名)，开始每个计时项前调用
+    '''
+    results = {}
+    def measure(name, fn, setup=None, n=repeat):
+        if progress is not None:
+            progress(name)
+        results[name] = timeit(fn, n, setup)
+        return results[name]
+    vh = PSDVarianceHandler(config=config_path)
+    visible = sorted(vh.get_all_visible_layers(original=True))
+    names = vh.root.get_all_layers()
+    if 'open' in stages:
+        measure('open', lambda: PSDImage.open(psd_path))
+    if 'index' in stages:
+        def index():
+            vh.layer_dict = {}
+            vh._index_layers(vh.psd)
+        measure('index', index)
+    if 'handler' in stages:
+        measure('handler', lambda: PSDVarianceHandler(config=config_path))
+    if 'parse_layer' in stages:
+        measure('parse_layer', lambda: vh.parse_layer(names))
+    if 'visible' in stages:
+        measure('visible', lambda: vh.get_all_visible_layers(original=True))
+    if 'copy_psd' in stages:
+        measure('copy_psd', lambda: vh.copy_psd(visible))
+    image = None
+    if 'composite' in stages:
+        for backend in backends:
+            # psd_tools 合成很慢，冷启动与重复计时都只做一次
+            n = 1 if backend == 'psd_tools' else repeat
+            fresh = []
+            measure(f'composite.{backend}.cold', lambda: fresh[-1].render(visible, backend),
+                    setup=lambda: fresh.append(PSDVarianceHandler(config=config_path)), n=1)
+            measure(f'composite.{backend}', lambda: vh._render(visible, backend, None), n=n)
+    if 'prefix' in stages and batch_variants > 0 and vh.compositor.supports(visible):
+        jobs = [layer_idxs for _, layer_idxs in itertools.islice(iter_render_jobs(vh, ''), batch_variants)]
+        if all(vh.compositor.supports(layer_idxs) for layer_idxs in jobs):
+            def run(compositor:Compositor):
+                for layer_idxs in jobs:
+                    compositor.composite(layer_idxs)
+            # 图层像素先全部解码，只比较合成
+            run(Compositor(vh.layer_cache))
+            measure('prefix.off', lambda: run(Compositor(vh.layer_cache)))
+            if PrefixCache.for_budget(256 * 1024 * 1024, vh.size) is not None:
+                caches = []
+                result = measure('prefix.on', lambda: run(Compositor(vh.layer_cache, caches[-1])),
+                                 setup=lambda: caches.append(PrefixCache.for_budget(256 * 1024 * 1024, vh.size)))
+                result['hits'] = caches[-1].hits
+            results['prefix.off']['variants'] = len(jobs)
+    if 'encode' in stages:
+        image = vh.render(visible)
+        for spec in formats:
+            try:
+                encoder = Encoder.parse(spec)
+            except psd_handler.VHError:
+                continue
+            result = measure(f'encode.{spec}', lambda: encoder.encode(image))
+            result['bytes'] = len(encoder.encode(image))
+    if 'batch' in stages and batch_variants > 0:
+        variants = vh.sample_variants(batch_variants, seed)
+        output_dir = tempfile.mkdtemp(prefix='vh_bench_')
+        try:
+            result = measure('batch', lambda: vh.render_variants(output_dir, variants=variants, max_workers=batch_workers, dedupe=False),
+                             setup=lambda: (shutil.rmtree(output_dir), os.makedirs(output_dir)), n=1)
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+        result['variants'] = len(variants)
+        result['variants_per_second'] = len(variants) / result['median']
+    return results
+
+def compare(old:dict, new:dict, threshold:float=1.1) -> list[tuple[str, float, float, float, bool]]:
+    '''按中位数比较两次结果，返回 (计时项, 旧, 新, 新/旧, 是否变慢超过 threshold)'''
+    rows = []
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+        before, after = old['results'][name]['median'], result['median']
+        ratio = after / before if before > 0 else float('inf')
+        rows.append((name, before, after, ratio, ratio > threshold))
+    return rows
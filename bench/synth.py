@@ -0,0 +1,125 @@
+'''
+合成测试用的 PSD 与对应的 vh_config.json。
+
+图层组按 depth 层、每层 fanout 个子组排列，叶子图层轮流分到最底层的组中；
+类别树与图层组一一对应，叶子组的类别直接包含图层，模式按 modes 轮流分配。
+'''
+import json, os
+
+import numpy as np
+from PIL import Image
+from psd_tools import PSDImage
+from psd_tools.api.layers import Group, PixelLayer
+from psd_tools.constants import BlendMode
+
+from psd_handler import VHError
+
+MODES = ('one', 'or', 'all', 'same')
+# blend > 0 时轮流使用的非普通混合模式
+BLENDS = (BlendMode.MULTIPLY, BlendMode.SCREEN, BlendMode.OVERLAY, BlendMode.HARD_LIGHT, BlendMode.DARKEN,
+          BlendMode.LIGHTEN, BlendMode.LINEAR_DODGE, BlendMode.LINEAR_BURN, BlendMode.DIFFERENCE)
+
+def _layer_pixels(rng:np.random.Generator, width:int, height:int, opaque:bool) -> Image.Image:
+    '''带渐变与少量噪声的纯色块；不透明图层完全覆盖自身范围，其余为边缘透明的椭圆'''
+    yy, xx = np.mgrid[0:height, 0:width]
+    shade = (xx * 64 // width + yy * 64 // height - 64)[..., None]
+    color = rng.integers(0, 256, 3) + shade + rng.integers(-8, 9, (height, width, 3))
+    pixels = np.empty((height, width, 4), dtype=np.uint8)
+    pixels[..., :3] = np.clip(color, 0, 255)
+    if opaque:
+        pixels[..., 3] = 255
+    else:
+        d = ((xx + 0.5) / width * 2 - 1) ** 2 + ((yy + 0.5) / height * 2 - 1) ** 2
+        pixels[..., 3] = np.clip((1 - d) * 510, 0, 255)
+    return Image.fromarray(pixels, 'RGBA')
+
+def _visibilities(rng:np.random.Generator, mode:str, n:int) -> list[bool]:
+    if mode == 'all':
+        return [True] * n
+    if mode == 'one':
+        return [i == 0 for i in range(n)]
+    if mode == 'same':
+        return [bool(rng.integers(2))] * n
+    return [bool(x) for x in rng.integers(0, 2, n)]
+
+def generate(output_dir:str,
+             layers:int=64,
+             depth:int=2,
+             fanout:int=4,
+             size:tuple[int, int]=(1024, 1024),
+             coverage:float=0.25,
+             modes:tuple[str, ...]=MODES,
+             opaque:float=0.2,
+             blend:float=0.0,
+             seed:int=0,
+             name:str='synth'
+             ) -> tuple[str, str]:
+    '''
+    生成 <name>.psd 与 <name>.json，返回两者的路径。
+    layers: 叶子图层数，不少于 fanout ** depth
+    depth / fanout: 图层组的层数与每组的子组数，depth 为 0 时所有图层直接在根上
+    size: 画布 (宽, 高)；coverage: 每个图层范围占画布面积的比例
+    modes: 类别模式，按先序轮流分配 (根类别固定为 'all')
+    opaque / blend: 完全不透明的图层、非普通混合模式的图层所占比例
+    '''
+    for mode in modes:
+        if mode not in MODES:
+            raise VHError(f"未知的模式: {mode}")
+    if layers < fanout ** depth:
+        raise VHError(f"图层数 {layers} 少于叶子组数 {fanout ** depth}")
+    if not 0 < coverage <= 1:
+        raise VHError(f"coverage 必须在 (0, 1] 内: {coverage}")
+    rng = np.random.default_rng(seed)
+    width, height = size
+    layer_width = max(1, round(width * coverage ** 0.5))
+    layer_height = max(1, round(height * coverage ** 0.5))
+    psd = PSDImage.new('RGBA', size)
+
+    # 先建立图层组树，记录叶子组
+    def build_groups(parent, prefix:str, level:int) -> dict:
+        node = {'name': prefix, 'group': parent, 'children': [], 'layers': []}
+        if level < depth:
+            for i in range(fanout):
+                name = f'{prefix}_{i}' if prefix != 'root' else f'g{i}'
+                node['children'].append(build_groups(Group.new(parent, name=name), name, level + 1))
+        return node
+    tree = build_groups(psd, 'root', 0)
+    leaves = []
+    def collect(node):
+        if node['children']:
+            for child in node['children']:
+                collect(child)
+        else:
+            leaves.append(node)
+    collect(tree)
+
+    for i in range(layers):
+        node = leaves[i % len(leaves)]
+        layer_name = f'L{i:05d}'
+        left = int(rng.integers(0, width - layer_width + 1))
+        top = int(rng.integers(0, height - layer_height + 1))
+        image = _layer_pixels(rng, layer_width, layer_height, rng.random() < opaque)
+        layer = PixelLayer.frompil(image, node['group'], layer_name, top, left)
+        if rng.random() < blend:
+            layer.blend_mode = BLENDS[i % len(BLENDS)]
+        node['layers'].append(layer_name)
+
+    counter = iter(range(1 << 30))
+    def to_category(node, mode:str|None=None) -> dict:
+        mode = mode or modes[next(counter) % len(modes)]
+        if node['children']:
+            subs = [to_category(child) for child in node['children']]
+            visibilities = _visibilities(rng, mode, len(subs))
+            return {'name': node['name'], 'mode': mode, 'layers': [],
+                    'subcategories': [[sub, v] for sub, v in zip(subs, visibilities)]}
+        visibilities = _visibilities(rng, mode, len(node['layers']))
+        return {'name': node['name'], 'mode': mode, 'layers': node['layers'],
+                'subcategories': [[layer, v] for layer, v in zip(node['layers'], visibilities)]}
+
+    os.makedirs(output_dir, exist_ok=True)
+    psd_path = os.path.abspath(os.path.join(output_dir, f'{name}.psd'))
+    config_path = os.path.join(output_dir, f'{name}.json')
+    psd.save(psd_path)
+    with open(config_path, 'w', encoding='utf-8') as f:
+        json.dump({'psd_path': psd_path.split(os.sep), 'root': to_category(tree, 'all')}, f, ensure_ascii=False)
+    return psd_path, config_path
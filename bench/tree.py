@@ -0,0 +1,94 @@
+'''
+大类别树的内存与加载/保存计时，不需要 PSD。
+
+类别树按先序生成，每个类别有 1 到 2*fanout-1 个子类别 (平均 fanout)，直到总数达到 nodes；
+叶子类别各包含 layers_per_leaf 个图层下标，模式按 modes 轮流分配。
+'''
+import json, os, random, shutil, tempfile, tracemalloc
+
+from psd_handler import Category
+from bench.run import timeit
+from bench.synth import MODES
+
+TREE_STAGES = ('from_dict', 'to_dict', 'load_config', 'save_config', 'count_variants', 'get_variant')
+
+def _visibilities(rng:random.Random, mode:str, n:int) -> list[bool]:
+    if mode == 'all':
+        return [True] * n
+    if mode == 'one':
+        return [i == 0 for i in range(n)]
+    if mode == 'same':
+        return [rng.random() < 0.5] * n
+    return [rng.random() < 0.5 for _ in range(n)]
+
+def generate_tree(nodes:int=50000, fanout:int=4, layers_per_leaf:int=4, modes=MODES, seed:int=0) -> dict:
+    '''返回 Category.to_dict 格式的字典，类别总数约为 nodes'''
+    rng = random.Random(seed)
+    counter = [0]
+    def build(idx:str, budget:int) -> dict:
+        mode = modes[counter[0] % len(modes)]
+        name = f'c{counter[0]}'
+        counter[0] += 1
+        budget -= 1
+        n = min(budget, rng.randint(1, 2 * fanout - 1)) if budget > 0 else 0
+        if n == 0:
+            layers = [f'{idx}-{i}' for i in range(layers_per_leaf)]
+            return {'name': name, 'mode': mode, 'layers': layers,
+                    'subcategories': [[layer, v] for layer, v in zip(layers, _visibilities(rng, mode, len(layers)))]}
+        # 剩余的类别数平均分给子类别
+        subs = [build(f'{idx}-{i}', budget // n + (i < budget % n)) for i in range(n)]
+        return {'name': name, 'mode': mode, 'layers': [],
+                'subcategories': [[sub, v] for sub, v in zip(subs, _visibilities(rng, mode, n))]}
+    return build('0', nodes)
+
+def tree_memory(data:dict) -> int:
+    '''from_dict 得到的类别树占用的字节数 (tracemalloc 统计，不含 data 本身)'''
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        root = Category.from_dict(data)
+        size = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del root
+    return size
+
+def run_tree_benchmarks(nodes:int=50000, fanout:int=4, layers_per_leaf:int=4, stages=TREE_STAGES,
+                        repeat:int=5, seed:int=0, progress=None) -> dict:
+    '''返回 {'tree.<阶段>': 计时统计}，tree.from_dict 另记录类别数与类别树的字节数'''
+    results = {}
+    def measure(name, fn, n=repeat):
+        if progress is not None:
+            progress(f'tree.{name}')
+        results[f'tree.{name}'] = timeit(fn, n)
+        return results[f'tree.{name}']
+    data = generate_tree(nodes, fanout, layers_per_leaf, seed=seed)
+    root = Category.from_dict(data)
+    work_dir = tempfile.mkdtemp(prefix='vh_bench_')
+    path = os.path.join(work_dir, 'vh_config.json')
+    root.save_config(path)
+    try:
+        if 'from_dict' in stages:
+            result = measure('from_dict', lambda: Category.from_dict(data))
+            result['nodes'] = sum(1 for _ in _walk(root))
+            result['bytes'] = tree_memory(data)
+        if 'to_dict' in stages:
+            measure('to_dict', root.to_dict)
+        if 'load_config' in stages:
+            measure('load_config', lambda: Category.load_config(path))
+        if 'save_config' in stages:
+            measure('save_config', lambda: root.save_config(path))
+        if 'count_variants' in stages:
+            measure('count_variants', root.count_variants)
+        if 'get_variant' in stages:
+            measure('get_variant', root.get_variant)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+def _walk(c:Category):
+    stack = [c]
+    while stack:
+        c = stack.pop()
+        yield c
+        stack.extend(c.subcategories)
@@ -0,0 +1,271 @@
+'''
+无界面的批量渲染工具。
+
+    python cli.py manifest vh_config.json -o manifest.jsonl [--sample N | --require-layer X ...]
+    python cli.py render manifest.jsonl -d output [-j 8]
+    python cli.py count vh_config.json [--require-layer X ...]
+
+manifest 是 JSONL：第一行是头部 (配置、PSD 路径与内容哈希、条目数)，之后每行一个差分。
+render 每完成一个差分就向 <manifest>.done 追加一行 (输出名, 任务键, 输出文件 sha256)；
+重新运行时，输出文件存在、任务键一致且内容哈希一致的条目会被跳过，因此中断的任务可以续跑。
+像素相同的差分 (去掉透明与被完全覆盖的图层后图层内容相同) 只渲染第一个，其余条目的 alias 指向它的输出名。
+'''
+from __future__ import annotations
+import argparse, hashlib, json, os, sys, time
+from typing import TYPE_CHECKING
+
+import psd_handler
+from psd_handler import PSDVarianceHandler, VHError
+import tracing
+
+# batch、encoders 与 disk_cache 会导入 PIL、numpy 与 psd_tools，只在写 manifest 与渲染时导入
+if TYPE_CHECKING:
+    from encoders import Encoder
+
+MANIFEST_VERSION = 1
+
+def job_key(psd_hash:str, backend:str, layer_idxs:list[str], encoder:str='png:6') -> str:
+    '''同一 PSD 内容、后端、图层集合与编码设置的任务键相同'''
+    return hashlib.sha256(json.dumps([psd_hash, backend, sorted(layer_idxs), encoder]).encode()).hexdigest()
+
+def _has_query(args) -> bool:
+    return bool(args.require_category or args.forbid_category or args.require_layer or args.forbid_layer)
+
+def _select_variants(vh:PSDVarianceHandler, args):
+    '''按参数选择差分：抽样、约束查询，或 None 表示全部枚举。抽样与约束查询不能同时使用 (main 中检查)'''
+    if args.sample is not None:
+        return vh.sample_variants(args.sample, args.seed, args.unique, args.stratified)
+    if _has_query(args):
+        return vh.query_variants(args.require_category, args.forbid_category,
+                                 args.require_layer, args.forbid_layer, args.search_mode)
+    return None
+
+def write_manifest(vh:PSDVarianceHandler, config:str, output:str, name_template:str, backend:str, variants=None,
+                   encoder:Encoder|None=None, dedupe:bool=True, max_workers:int|None=None) -> int:
+    '''
+    写出 manifest，返回条目数。输出名的扩展名换成 encoder 格式的扩展名。
+    dedupe 为 True 时按 LayerCache.effective_key 合并像素相同的差分，重复条目带 alias 字段，不单独渲染；
+    所需的图层属性先在 max_workers 个进程中计算 (见 batch.prime_layer_facts)。
+    '''
+    from disk_cache import file_hash
+    from batch import iter_render_jobs, prime_layer_facts
+    from encoders import Encoder
+    encoder = encoder or Encoder()
+    psd_hash = file_hash(vh.psd_path)
+    if dedupe:
+        prime_layer_facts(vh, max_workers)
+    count = 0
+    seen = set()
+    rendered:dict[tuple, str] = {}
+    tmp_path = output + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for name, layer_idxs, variant in iter_render_jobs(vh, '', name_template, variants, with_variants=True):
+            name = encoder.output_path(name)
+            if name in seen:
+                raise VHError(f"输出文件名重复: {name}，请在 name_template 中使用 {{index}}")
+            seen.add(name)
+            entry = {
+                'index': count,
+                'output': name,
+                'key': job_key(psd_hash, backend, layer_idxs, encoder.spec),
+                'layers': layer_idxs,
+                'variant': [[list(path), list(visibilities)] for path, visibilities in variant.items()],
+            }
+            if dedupe:
+                effective = vh.layer_cache.effective_key(layer_idxs)
+                if (first := rendered.setdefault(effective, name)) != name:
+                    entry['alias'] = first
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            count += 1
+    header = {
+        'manifest_version': MANIFEST_VERSION,
+        'config': os.path.abspath(config),
+        'psd_path': os.path.abspath(vh.psd_path),
+        'psd_sha256': psd_hash,
+        'backend': backend,
+        'encoder': encoder.spec,
+        'count': count,
+        'unique': len(rendered) if dedupe else count,
+    }
+    # 头部需要条目数，条目写完后再拼接到前面
+    with open(output, 'w', encoding='utf-8') as out, open(tmp_path, 'r', encoding='utf-8') as f:
+        out.write(json.dumps(header, ensure_ascii=False) + '\n')
+        for line in f:
+            out.write(line)
+    os.remove(tmp_path)
+    return count
+
+def read_manifest(path:str) -> tuple[dict, list[dict]]:
+    with open(path, 'r', encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        if header.get('manifest_version') != MANIFEST_VERSION:
+            raise VHError(f"不支持的 manifest 版本: {header.get('manifest_version')}")
+        entries = [json.loads(line) for line in f if line.strip()]
+    return header, entries
+
+def _read_done(path:str) -> dict[str, dict]:
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 进程被杀时最后一行可能不完整
+                continue
+            done[record['output']] = record
+    return done
+
+def _is_done(entry:dict, record:dict|None, output_path:str) -> bool:
+    if record is None or record['key'] != entry['key'] or not os.path.exists(output_path):
+        return False
+    from disk_cache import file_hash
+    return file_hash(output_path) == record['sha256']
+
+class Progress:
+    '''在 stderr 上单行显示进度、速度与预计剩余时间'''
+    def __init__(self, total:int, skipped:int=0, stream=sys.stderr, interval:float=0.5):
+        self.total = total
+        self.done = skipped
+        self.skipped = skipped
+        self.stream = stream
+        self.interval = interval
+        self.start = time.perf_counter()
+        self._last = 0.0
+    def update(self, n:int=1):
+        self.done += n
+        now = time.perf_counter()
+        if now - self._last >= self.interval or self.done == self.total:
+            self._last = now
+            rate = (self.done - self.skipped) / max(now - self.start, 1e-9)
+            eta = (self.total - self.done) / rate if rate > 0 else float('inf')
+            self.stream.write(f"\r{self.done}/{self.total}  {rate:.1f}/s  剩余 {eta:.0f}s ")
+            self.stream.flush()
+    def close(self):
+        self.stream.write('\n')
+
+def render_manifest(manifest:str, output_dir:str, max_workers:int|None=None, lazy:bool=False,
+                    cache_dir:str|None=None, prefix_cache_bytes:int=0, progress:bool=True,
+                    encode_workers:int|None=None) -> int:
+    '''渲染 manifest 中尚未完成的条目，返回本次渲染的数量'''
+    from disk_cache import file_hash
+    from batch import render_jobs
+    from encoders import Encoder
+    header, entries = read_manifest(manifest)
+    if file_hash(header['psd_path']) != header['psd_sha256']:
+        raise VHError(f"PSD 内容已改变，请重新生成 manifest: {header['psd_path']}")
+    os.makedirs(output_dir, exist_ok=True)
+    done_path = manifest + '.done'
+    done = _read_done(done_path)
+    # alias 条目与其指向的条目像素相同，不需要渲染
+    entries = [e for e in entries if 'alias' not in e]
+    todo = [e for e in entries if not _is_done(e, done.get(e['output']), os.path.join(output_dir, e['output']))]
+    tracing.log(f"共 {len(entries)} 个需要渲染的差分，已完成 {len(entries) - len(todo)} 个")
+    if not todo:
+        return 0
+    vh = PSDVarianceHandler(header['psd_path'], lazy=lazy, cache_dir=cache_dir, backend=header['backend'])
+    keys = {os.path.join(output_dir, e['output']): e['key'] for e in todo}
+    bar = Progress(len(entries), len(entries) - len(todo)) if progress else None
+    with open(done_path, 'a', encoding='utf-8') as done_file:
+        def on_done(output_path:str, digest:str):
+            record = {'output': os.path.relpath(output_path, output_dir), 'key': keys[output_path], 'sha256': digest}
+            done_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            done_file.flush()
+            if bar is not None:
+                bar.update()
+        jobs = ((os.path.join(output_dir, e['output']), e['layers']) for e in todo)
+        try:
+            count = render_jobs(vh, jobs, max_workers, prefix_cache_bytes=prefix_cache_bytes, on_done=on_done,
+                                encoder=Encoder.parse(header['encoder']), encode_workers=encode_workers)
+        finally:
+            if bar is not None:
+                bar.close()
+    return count
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='PSD 差分批量渲染')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('manifest', help='由 vh_config.json 生成差分 manifest')
+    p.add_argument('config')
+    p.add_argument('-o', '--output', default='manifest.jsonl')
+    p.add_argument('-t', '--name-template', default='{index:05d}.png', help='可使用 {index} 与 {name}')
+    p.add_argument('--backend', default='pil', choices=psd_handler.BACKENDS)
+    p.add_argument('-f', '--format', default='png', help='输出格式: png[:压缩级别 0-9]、webp[:method 0-6]、raw、qoi')
+    p.add_argument('--sample', type=int, help='只抽取 N 个差分')
+    p.add_argument('--seed', type=int)
+    p.add_argument('--unique', action='store_true', help='不重复抽样')
+    p.add_argument('--stratified', action='store_true', help='分层抽样')
+    p.add_argument('--require-category', action='append', default=[], help='必须可见的类别，路径用 - 分隔')
+    p.add_argument('--forbid-category', action='append', default=[])
+    p.add_argument('--require-layer', action='append', default=[])
+    p.add_argument('--forbid-layer', action='append', default=[])
+    p.add_argument('--search-mode', type=int, default=0, help='类别查找方式，同 get_Categories')
+    p.add_argument('--no-dedupe', action='store_true', help='不合并像素相同的差分')
+    p.add_argument('-j', '--jobs', type=int, help='去重时计算图层属性的进程数，默认为 CPU 核数')
+    p.add_argument('--snapshot', nargs='?', const=True, default=False, metavar='PATH',
+                   help='读写类别树与图层索引的快照，默认为配置旁的 .vhsnap，也可以指定路径')
+
+    p = subparsers.add_parser('count', help='统计差分数量 (使用快照，不读取图层像素)')
+    p.add_argument('config')
+    p.add_argument('--require-category', action='append', default=[], help='必须可见的类别，路径用 - 分隔')
+    p.add_argument('--forbid-category', action='append', default=[])
+    p.add_argument('--require-layer', action='append', default=[])
+    p.add_argument('--forbid-layer', action='append', default=[])
+    p.add_argument('--search-mode', type=int, default=0, help='类别查找方式，同 get_Categories')
+    p.add_argument('--snapshot', nargs='?', const=True, default=False, metavar='PATH',
+                   help='读写类别树与图层索引的快照，默认为配置旁的 .vhsnap，也可以指定路径')
+
+    p = subparsers.add_parser('render', help='渲染 manifest，可中断后续跑')
+    p.add_argument('manifest')
+    p.add_argument('-d', '--output-dir', default='output')
+    p.add_argument('-j', '--jobs', type=int, help='渲染与编码共用的进程数，默认为 CPU 核数')
+    p.add_argument('--encode-jobs', type=int, help='其中的编码进程数，默认为三分之一，0 表示在渲染进程内编码')
+    p.add_argument('--lazy', action='store_true')
+    p.add_argument('--cache-dir')
+    p.add_argument('--prefix-cache-mb', type=int, default=0, help='每个渲染进程的前缀缓存预算，默认不缓存')
+    p.add_argument('--quiet', action='store_true', help='不显示进度')
+    p.add_argument('-v', '--verbose', action='store_true', help='输出日志')
+    p.add_argument('--trace', help='把计时与计数写成 JSON Lines，结束时在 stderr 输出汇总')
+
+    args = parser.parse_args(argv)
+    if args.command == 'manifest':
+        from encoders import Encoder
+        if args.sample is not None and _has_query(args):
+            parser.error("--sample 不能与 --require-*/--forbid-* 同时使用")
+        try:
+            encoder = Encoder.parse(args.format)
+        except (ValueError, VHError) as e:
+            parser.error(f"无法解析输出格式 {args.format}: {e}")
+        vh = PSDVarianceHandler(config=args.config, lazy=True, backend=args.backend, snapshot=args.snapshot)
+        count = write_manifest(vh, args.config, args.output, args.name_template, args.backend,
+                               _select_variants(vh, args), encoder, not args.no_dedupe, args.jobs)
+        print(f"已写入 {count} 个差分到 {args.output}")
+    elif args.command == 'count':
+        vh = PSDVarianceHandler(config=args.config, lazy=True, snapshot=args.snapshot)
+        if _has_query(args):
+            count = vh.query_variants(args.require_category, args.forbid_category,
+                                      args.require_layer, args.forbid_layer, args.search_mode).count()
+        else:
+            count = vh.count_variants()
+        print(count)
+    else:
+        sinks = [tracing.LogSink()] if args.verbose else []
+        if args.trace:
+            sinks += [tracing.JSONLinesSink(args.trace), tracing.Aggregator()]
+        tracing.enable(*sinks)
+        try:
+            count = render_manifest(args.manifest, args.output_dir, args.jobs, args.lazy, args.cache_dir,
+                                    args.prefix_cache_mb * 1024 * 1024, progress=not args.quiet, encode_workers=args.encode_jobs)
+        finally:
+            for sink in sinks:
+                if isinstance(sink, tracing.JSONLinesSink):
+                    sink.close()
+            if (aggregator := tracing.aggregator()) is not None:
+                print(aggregator.report(), file=sys.stderr)
+            tracing.disable()
+        print(f"本次渲染 {count} 个差分")
+
+if __name__ == '__main__':
+    main()
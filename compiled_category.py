@@ -0,0 +1,298 @@
+import itertools
+
+from psd_handler import Category, VHError
+
+# 子树组合数不超过该值时缓存其全部 (state, mask)，内层循环直接用 itertools.product
+_MEMO_LIMIT = 4096
+
+class CompiledCategory:
+    '''
+    Category 树的位集编译形式。
+    每个类别(节点)的可见性是一个整数 sel，第 i 位对应第 i 个子类别或图层；
+    所有节点的 sel 按先序拼接成一个整数 state。
+    每个图层出现位置(叶子类别中的一个图层)分配一个 mask 位，同名图层在不同类别中占不同的位，
+    因此各子树的 mask 互不相交，可见性改变时只需沿祖先链异或差值，复杂度 O(深度)。
+    '''
+    def __init__(self, root:Category, resolve=None):
+        '''resolve: 可选的 图层名列表 -> 叶子图层下标列表 函数 (如 PSDVarianceHandler.parse_layer)'''
+        self.root = root
+        self.nodes:list[Category] = []
+        self.paths:list[tuple] = []
+        self.parent:list[int] = []
+        self.parent_slot:list[int] = []
+        self.offsets:list[int] = []
+        self.nslots:list[int] = []
+        # 每个槽位的贡献：子类别槽为子节点编号，图层槽为 mask 位
+        self.children:list[list[int]] = []
+        self.layer_bits:list[list[int]] = []
+        self.layer_names:list[str] = []
+        self._build(root, (), -1, -1)
+        self.index = {path: n for n, path in enumerate(self.paths)}
+        self.full = [(1 << k) - 1 for k in self.nslots]
+        self._resolved = None
+        if resolve is not None:
+            self._resolved = [tuple(resolve([name])) for name in self.layer_names]
+        self._memo:dict[int, list[tuple[int, int]]|None] = {}
+        self._counts:dict[int, int] = {}
+        self.sel:list[int] = [0] * len(self.nodes)
+        self.vis:list[int] = [0] * len(self.nodes)
+        self.load()
+
+    def _build(self, c:Category, path:tuple, parent:int, slot:int):
+        n = len(self.nodes)
+        self.nodes.append(c)
+        self.paths.append(path)
+        self.parent.append(parent)
+        self.parent_slot.append(slot)
+        self.offsets.append(sum(self.nslots))
+        self.nslots.append(len(c.visibilities))
+        self.children.append([])
+        self.layer_bits.append([])
+        if len(c.subcategories) > 0:
+            for i, sub_c in enumerate(c.subcategories):
+                self.children[n].append(len(self.nodes))
+                self._build(sub_c, path + (sub_c.name,), n, i)
+        else:
+            for layer in c.layers:
+                self.layer_bits[n].append(1 << len(self.layer_names))
+                self.layer_names.append(layer)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def _contrib(self, n:int, i:int) -> int:
+        if self.layer_bits[n]:
+            return self.layer_bits[n][i]
+        return self.vis[self.children[n][i]]
+
+    ### 状态读写 ###
+    def load(self):
+        '''从 Category 树读取当前可见性'''
+        # 'unk' 节点的组合数与枚举结果取决于 sel
+        self._counts.clear()
+        self._memo.clear()
+        for n in reversed(range(len(self.nodes))):
+            sel = 0
+            for i, v in enumerate(self.nodes[n].visibilities):
+                if v:
+                    sel |= 1 << i
+            self.sel[n] = sel
+            self.vis[n] = self._own_mask(n, sel)
+    def store(self):
+        '''把当前可见性写回 Category 树'''
+        for n, c in enumerate(self.nodes):
+            c.visibilities = [bool(self.sel[n] >> i & 1) for i in range(self.nslots[n])]
+
+    def _own_mask(self, n:int, sel:int) -> int:
+        mask = 0
+        for i in range(self.nslots[n]):
+            if sel >> i & 1:
+                mask |= self._contrib(n, i)
+        return mask
+
+    @property
+    def mask(self) -> int:
+        '''当前可见图层出现位置的位集'''
+        return self.vis[0]
+    @property
+    def state(self) -> int:
+        '''所有节点 sel 拼接成的状态'''
+        state = 0
+        for n, sel in enumerate(self.sel):
+            state |= sel << self.offsets[n]
+        return state
+    def sel_of(self, state:int, n:int) -> int:
+        return state >> self.offsets[n] & self.full[n]
+
+    def set_slot(self, n:int, i:int, visible:bool):
+        '''修改节点 n 第 i 个槽位的可见性，沿祖先链更新 mask，不检查模式'''
+        bit = 1 << i
+        if bool(self.sel[n] & bit) == visible:
+            return
+        self.sel[n] ^= bit
+        if self.nodes[n].mode == 'unk':
+            # 'unk' 节点只有当前状态一种组合，它及祖先的组合数与枚举缓存都已过期
+            m = n
+            while m >= 0:
+                self._counts.pop(m, None)
+                self._memo.pop(m, None)
+                m = self.parent[m]
+        delta = self._contrib(n, i)
+        while True:
+            self.vis[n] ^= delta
+            p, slot = self.parent[n], self.parent_slot[n]
+            if p < 0 or not self.sel[p] >> slot & 1:
+                return
+            n = p
+
+    def _slot(self, n:int, name:str) -> int:
+        c = self.nodes[n]
+        if result := c.get_sub(name):
+            return result[0]
+        if result := c.get_layer(name):
+            return result[0]
+        raise VHError(f"未找到名称为 {name} 的子类别或图层")
+    def set_visibility(self, path:tuple, name:str, visible:bool):
+        '''按类别模式修改可见性，语义同 Category.set_visibility'''
+        n = self.index[tuple(path)]
+        mode = self.nodes[n].mode
+        if mode == 'all':
+            raise VHError("该类别所有子类别及图层必须可见，无法修改")
+        i = self._slot(n, name)
+        if mode == 'same':
+            for j in range(self.nslots[n]):
+                self.set_slot(n, j, visible)
+        elif mode == 'one':
+            if visible:
+                for j in range(self.nslots[n]):
+                    if j != i:
+                        self.set_slot(n, j, False)
+                self.set_slot(n, i, True)
+            else:
+                self.set_slot(n, i, False)
+                if self.sel[n] == 0 and self.nslots[n] > 0:
+                    self.set_slot(n, 0, True)
+        else:
+            self.set_slot(n, i, visible)
+
+    def check(self, n:int|None=None):
+        '''按模式检查节点 (默认全部节点) 的可见性，与 Category.check_visibility 一致'''
+        for n in (range(len(self.nodes)) if n is None else [n]):
+            sel, full, mode = self.sel[n], self.full[n], self.nodes[n].mode
+            if mode == 'all' and sel != full:
+                raise VHError("该类别所有子类别及图层必须可见")
+            if mode == 'one' and (sel == 0 or sel & (sel - 1)):
+                raise VHError("该类别只能有一个子类别或图层可见")
+            if mode == 'same' and sel not in (0, full):
+                raise VHError(f"该类别所有子类别或图层必须同时可见或不可见: {self.nodes[n].visibilities}")
+
+    ### 可见图层 ###
+    def visible_layers(self, mask:int|None=None) -> list[str]:
+        mask = self.mask if mask is None else mask
+        return list({self.layer_names[k] for k in _iter_bits(mask)})
+    def visible_layer_idxs(self, mask:int|None=None) -> list[str]:
+        '''需要在构造时提供 resolve'''
+        if self._resolved is None:
+            raise VHError("编译时未提供图层解析函数，无法返回图层下标")
+        mask = self.mask if mask is None else mask
+        output = set()
+        for k in _iter_bits(mask):
+            output.update(self._resolved[k])
+        return list(output)
+
+    ### 枚举 ###
+    def own_selections(self, n:int):
+        '''节点 n 在其模式下允许的 sel'''
+        k, mode = self.nslots[n], self.nodes[n].mode
+        if mode == 'all':
+            return [self.full[n]]
+        if mode == 'one':
+            return [1 << i for i in range(k)]
+        if mode == 'or':
+            return range(1 << k)
+        if mode == 'same':
+            return [0, self.full[n]] if k > 0 else [0]
+        return [self.sel[n]]
+
+    def count(self, n:int=0) -> int:
+        '''节点 n 子树的合法组合数'''
+        if (result := self._counts.get(n)) is not None:
+            return result
+        k, mode = self.nslots[n], self.nodes[n].mode
+        counts = [self.count(child) for child in self.children[n]] or [1] * k
+        if mode == 'all':
+            result = _prod(counts)
+        elif mode == 'one':
+            result = sum(counts)
+        elif mode == 'or':
+            result = _prod(1 + x for x in counts)
+        elif mode == 'same':
+            result = 1 + _prod(counts) if k > 0 else 1
+        else:
+            result = _prod(x for i, x in enumerate(counts) if self.sel[n] >> i & 1)
+        self._counts[n] = result
+        return result
+
+    def _iter_node(self, n:int):
+        if n in self._memo:
+            if (cached := self._memo[n]) is not None:
+                yield from cached
+                return
+        elif self.count(n) <= _MEMO_LIMIT:
+            self._memo[n] = list(self._iter_node_lazy(n))
+            yield from self._memo[n]
+            return
+        else:
+            self._memo[n] = None
+        yield from self._iter_node_lazy(n)
+
+    def _iter_node_lazy(self, n:int):
+        offset, layer_bits = self.offsets[n], self.layer_bits[n]
+        for sel in self.own_selections(n):
+            state = sel << offset
+            if layer_bits:
+                mask = 0
+                for i, bit in enumerate(layer_bits):
+                    if sel >> i & 1:
+                        mask |= bit
+                yield state, mask
+                continue
+            visible = [child for i, child in enumerate(self.children[n]) if sel >> i & 1]
+            if all(self.count(child) <= _MEMO_LIMIT for child in visible):
+                for combo in itertools.product(*[list(self._iter_node(child)) for child in visible]):
+                    s, m = state, 0
+                    for cs, cm in combo:
+                        s |= cs
+                        m |= cm
+                    yield s, m
+            else:
+                yield from self._iter_product(visible, state, 0)
+
+    def _iter_product(self, visible:list[int], state:int, mask:int):
+        if len(visible) == 0:
+            yield state, mask
+            return
+        for cs, cm in self._iter_node(visible[0]):
+            yield from self._iter_product(visible[1:], state | cs, mask | cm)
+
+    def iter_states(self):
+        '''惰性枚举所有合法组合的 (state, mask)，不可见子树的 sel 为 0'''
+        yield from self._iter_node(0)
+
+    def state_to_variant(self, state:int) -> dict[tuple, tuple[bool]]:
+        '''转换为 Category.iter_variants 使用的差分字典'''
+        variant = {}
+        stack = [0]
+        while stack:
+            n = stack.pop()
+            sel = self.sel_of(state, n)
+            variant[self.paths[n]] = tuple(bool(sel >> i & 1) for i in range(self.nslots[n]))
+            stack.extend(child for i, child in enumerate(self.children[n]) if sel >> i & 1)
+        return variant
+    def variant_to_state(self, variant:dict[tuple, tuple[bool]]) -> int:
+        state = 0
+        for path, visibilities in variant.items():
+            n = self.index[path]
+            for i, v in enumerate(visibilities):
+                if v:
+                    state |= 1 << (self.offsets[n] + i)
+        return state
+    def mask_of(self, state:int, n:int=0) -> int:
+        '''由 state 计算可见图层位集'''
+        sel, mask = self.sel_of(state, n), 0
+        for i in range(self.nslots[n]):
+            if sel >> i & 1:
+                mask |= self.layer_bits[n][i] if self.layer_bits[n] else self.mask_of(state, self.children[n][i])
+        return mask
+
+def _prod(values) -> int:
+    result = 1
+    for x in values:
+        result *= x
+    return result
+
+def _iter_bits(mask:int):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
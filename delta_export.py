@@ -0,0 +1,144 @@
+'''
+基础图 + 差异块的差分导出。
+
+每组差分只保存一张完整的基础图；每个差分只保存与基础图不同的矩形区域 (patch)。
+可能不同的区域由与基础图可见图层集合的差异决定：只在这些图层范围的并集内合成并与基础图比较，
+再收缩到真正有像素差异的范围。导出目录中的 deltas.json 记录基础图、每个差分的图层与 patch 位置，
+DeltaReader 由它还原任意差分。
+'''
+import json, os
+from collections import Counter
+
+import numpy as np
+from PIL import Image
+
+from psd_handler import PSDVarianceHandler, VHError
+from encoders import Encoder, write_atomic, read_image
+import tracing
+
+DELTA_VERSION = 1
+MANIFEST_NAME = 'deltas.json'
+
+def _group_key(variant:dict, group_by:list[tuple]) -> tuple:
+    return tuple(variant.get(tuple(path)) for path in group_by)
+
+def _base_layers(layer_sets:list[list[str]]) -> list[str]:
+    '''组内超过半数差分可见的图层作为基础图，使差异总量尽量小'''
+    counts = Counter(idx for layer_idxs in layer_sets for idx in layer_idxs)
+    return sorted(idx for idx, n in counts.items() if n * 2 > len(layer_sets))
+
+def changed_region(vh:PSDVarianceHandler, base_layers, layer_idxs) -> tuple[int, int, int, int]|None:
+    '''与基础图相比可能发生变化的范围：差异图层范围的并集。含图层样式等不支持属性的图层按整张画布处理'''
+    diff = set(base_layers) ^ set(layer_idxs)
+    if not diff:
+        return None
+    canvas = (0, 0) + tuple(vh.size)
+    if any(not vh.layer_cache.get(idx).supported for idx in diff):
+        return canvas
+    return vh.get_bbox(diff)
+
+def _diff_bbox(a:np.ndarray, b:np.ndarray) -> tuple[int, int, int, int]|None:
+    '''两个同样大小的 RGBA 数组中不同像素的范围'''
+    changed = np.any(a != b, axis=2)
+    rows, cols = np.flatnonzero(changed.any(axis=1)), np.flatnonzero(changed.any(axis=0))
+    if len(rows) == 0:
+        return None
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+def export_deltas(vh:PSDVarianceHandler,
+                  output_dir:str,
+                  variants=None,
+                  group_by:list[tuple]|None=None,
+                  encoder:Encoder|None=None,
+                  backend:str|None=None
+                  ) -> dict:
+    '''
+    导出差分为基础图 + patch，返回写入 deltas.json 的内容。
+    variants 为 None 时导出 vh.iter_variants() 的全部结果。
+    group_by: 类别路径列表，这些类别可见性相同的差分共用一张基础图；为 None 时全部差分共用一张。
+    '''
+    encoder = encoder or Encoder()
+    os.makedirs(output_dir, exist_ok=True)
+    compiled = vh.compile_categories()
+    group_by = [tuple(path) for path in group_by] if group_by else []
+    # 第一遍只计算图层集合并分组
+    groups:dict[tuple, list[int]] = {}
+    entries = []
+    states = compiled.iter_states() if variants is None else (
+        (state, compiled.mask_of(state)) for state in map(compiled.variant_to_state, variants))
+    for index, (state, mask) in enumerate(states):
+        variant = compiled.state_to_variant(state)
+        key = _group_key(variant, group_by)
+        groups.setdefault(key, []).append(index)
+        entries.append({'index': index, 'group': None, 'layers': sorted(compiled.visible_layer_idxs(mask))})
+    manifest = {
+        'version': DELTA_VERSION,
+        'size': list(vh.size),
+        'format': encoder.spec,
+        'groups': [],
+        'variants': entries,
+    }
+    for g, indices in enumerate(groups.values()):
+        base_layers = _base_layers([entries[i]['layers'] for i in indices])
+        base = vh.render(base_layers, backend)
+        base_name = f'base_{g:04d}{encoder.ext}'
+        write_atomic(encoder.encode(base), os.path.join(output_dir, base_name))
+        manifest['groups'].append({'base': base_name, 'layers': base_layers})
+        base_array = np.asarray(base.convert('RGBA'))
+        for i in indices:
+            entry = entries[i]
+            entry['group'] = g
+            entry['patch'] = entry['box'] = None
+            if (region := changed_region(vh, base_layers, entry['layers'])) is None:
+                continue
+            patch = vh.render(entry['layers'], backend, viewport=region).convert('RGBA')
+            patch_array = np.asarray(patch)
+            left, top, right, bottom = region
+            if (box := _diff_bbox(patch_array, base_array[top:bottom, left:right])) is None:
+                continue
+            patch = patch.crop(box)
+            entry['box'] = [left + box[0], top + box[1], left + box[2], top + box[3]]
+            entry['patch'] = f'{i:05d}{encoder.ext}'
+            write_atomic(encoder.encode(patch), os.path.join(output_dir, entry['patch']))
+    tmp_path = os.path.join(output_dir, MANIFEST_NAME + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, os.path.join(output_dir, MANIFEST_NAME))
+    if tracing.ENABLED:
+        patched = sum(1 for e in entries if e['patch'] is not None)
+        tracing.log(f"已导出 {len(entries)} 个差分：{len(groups)} 张基础图，{patched} 个 patch")
+    return manifest
+
+class DeltaReader:
+    '''读取 export_deltas 的导出目录并还原差分'''
+    def __init__(self, directory:str):
+        self.directory = directory
+        with open(os.path.join(directory, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            self.manifest = json.load(f)
+        if self.manifest.get('version') != DELTA_VERSION:
+            raise VHError(f"不支持的差分导出版本: {self.manifest.get('version')}")
+        self._bases:dict[int, Image.Image] = {}
+    def __len__(self):
+        return len(self.manifest['variants'])
+    def __getitem__(self, index:int) -> Image.Image:
+        return self.get(index)
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.get(index)
+
+    def layers(self, index:int) -> list[str]:
+        return self.manifest['variants'][index]['layers']
+    def base(self, group:int) -> Image.Image:
+        if (image := self._bases.get(group)) is None:
+            path = os.path.join(self.directory, self.manifest['groups'][group]['base'])
+            image = self._bases[group] = read_image(path).convert('RGBA')
+        return image
+    def get(self, index:int) -> Image.Image:
+        '''还原第 index 个差分，返回新图像'''
+        entry = self.manifest['variants'][index]
+        image = self.base(entry['group']).copy()
+        if entry['patch'] is not None:
+            patch = read_image(os.path.join(self.directory, entry['patch'])).convert('RGBA')
+            # patch 是完整的像素，直接覆盖而不是混合
+            image.paste(patch, tuple(entry['box'][:2]))
+        return image
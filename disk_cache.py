@@ -0,0 +1,143 @@
+import hashlib, json, os
+
+import numpy as np
+from PIL import Image
+from psd_tools.constants import BlendMode
+
+from renderer import LayerPixels
+
+CACHE_VERSION = 3
+
+def file_hash(path:str, chunk_size:int=1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _channel_data(layer) -> list[tuple[int, int, bytes]]:
+    '''图层的 (通道 id, 压缩方式, 压缩数据)，不解码'''
+    if hasattr(layer, 'channel_data'):
+        # lazy_psd.LazyLayer
+        return [(int(cid), int(compression), data) for cid, compression, data in layer.channel_data()]
+    return [(int(info.id), int(channel.compression), channel.data)
+            for info, channel in zip(layer._record.channel_info, layer._channels)]
+
+def _ancestors(layer) -> tuple[list, object]:
+    '''从外到内的祖先图层组，以及图层所在的文档'''
+    groups = []
+    node = layer.parent
+    while node.parent is not None:
+        groups.append(node)
+        node = node.parent
+    groups.reverse()
+    return groups, node
+
+def layer_key(layer) -> str:
+    '''
+    图层解码结果的键：该图层的通道数据，加上图层记录、祖先图层组与文档中影响解码结果的属性。
+    与图层下标、名称及 PSD 其余部分无关，编辑 PSD 后内容未变的图层键不变
+    '''
+    groups, document = _ancestors(layer)
+    h = hashlib.sha256()
+    h.update(repr((
+        CACHE_VERSION,
+        tuple(document.size), int(document.color_mode), document.depth,
+        tuple(layer.bbox), layer.opacity, layer.fill_opacity, layer.blend_mode.name,
+        layer.clipping, layer.has_clip_layers(), layer.has_mask(), layer.has_effects(),
+        [(group.opacity, group.blend_mode.name, group.has_mask(), group.has_effects()) for group in groups],
+    )).encode())
+    for cid, compression, data in _channel_data(layer):
+        h.update(repr((cid, compression, len(data))).encode())
+        h.update(data)
+    return h.hexdigest()
+
+class DiskLayerCache:
+    '''
+    持久化的已解码图层缓存。目录结构为 cache_dir/<键前两位>/<键>.npy|.json，键见 layer_key，
+    同一目录可供多个 PSD 及同一 PSD 的不同版本共用，PSD 修改后只有内容改变的图层需要重新解码。
+    .npy 保存裁剪到画布并已乘上不透明度的 RGBA 像素，读取时以内存映射方式打开；
+    .json 保存偏移与混合参数。缓存版本不一致的条目视为过期并重新生成。
+    '''
+    def __init__(self, cache_dir:str, psd_path:str):
+        self.cache_dir = cache_dir
+        self.psd_path = psd_path
+        # 图层下标 -> 键，load 时计算，save 复用
+        self._keys:dict[str, str] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _paths(self, key:str) -> tuple[str, str]:
+        base = os.path.join(self.cache_dir, key[:2], key)
+        return base + '.json', base + '.npy'
+
+    def _key(self, layer_idx:str, layer) -> str:
+        if (key := self._keys.get(layer_idx)) is None:
+            key = self._keys[layer_idx] = layer_key(layer)
+        return key
+
+    def load(self, layer_idx:str, layer, z:int) -> LayerPixels|None:
+        meta_path, array_path = self._paths(self._key(layer_idx, layer))
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('version') != CACHE_VERSION:
+                self.misses += 1
+                return None
+            image = None
+            if meta['has_image']:
+                array = np.load(array_path, mmap_mode='r')
+                height, width = array.shape[:2]
+                image = Image.frombuffer('RGBA', (width, height), array, 'raw', 'RGBA', 0, 1)
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        # 祖先图层组按层数保存，图层移动到同样属性的位置后按当前下标还原
+        parts = layer_idx.split('-')
+        ancestors = tuple(('-'.join(parts[:depth]), BlendMode[blend_mode], opacity)
+                          for depth, blend_mode, opacity in meta['ancestors'])
+        return LayerPixels(layer_idx, z, image, meta['left'], meta['top'], meta['opacity'],
+                           BlendMode[meta['blend_mode']], meta['supported'], ancestors)
+
+    def save(self, entry:LayerPixels, layer):
+        meta_path, array_path = self._paths(self._key(entry.layer_idx, layer))
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        # 多个工作进程可能同时写同一条目，先写入各自的临时文件再原子替换
+        if entry.image is not None:
+            tmp_path = f'{array_path}.{os.getpid()}.tmp.npy'
+            np.save(tmp_path, np.asarray(entry.image.convert('RGBA')))
+            os.replace(tmp_path, array_path)
+        meta = {
+            'version': CACHE_VERSION,
+            'has_image': entry.image is not None,
+            'left': entry.left,
+            'top': entry.top,
+            'opacity': entry.opacity,
+            'blend_mode': entry.blend_mode.name,
+            'supported': entry.supported,
+            'ancestors': [(idx.count('-') + 1, blend_mode.name, opacity) for idx, blend_mode, opacity in entry.ancestors],
+        }
+        tmp_path = f'{meta_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_path, meta_path)
+
+    def prune(self, layers) -> int:
+        '''
+        只保留 layers (叶子图层对象) 用到的条目，删除其余条目，返回删除的条目数。
+        缓存目录由多个 PSD 共用时，layers 应包含所有仍在使用的 PSD 的图层
+        '''
+        keep = {layer_key(layer) for layer in layers}
+        removed = 0
+        for prefix in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, prefix)
+            if not os.path.isdir(path):
+                continue
+            for name in os.listdir(path):
+                key = name.split('.', 1)[0]
+                if key in keep:
+                    continue
+                os.remove(os.path.join(path, name))
+                removed += name.endswith('.json')
+        return removed
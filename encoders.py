@@ -0,0 +1,99 @@
+import hashlib, io, os, struct
+
+from PIL import Image, features
+
+from psd_handler import VHError
+import tracing
+
+# raw 格式的文件头：魔数、宽、高 (小端 uint32)，之后是逐行的 RGBA 像素
+RAW_MAGIC = b'VHRGBA\0\0'
+
+class Encoder:
+    '''
+    输出编码设置，可以传给编码进程。
+    png: compress_level 0-9 (0 不压缩，1 最快，9 最小)
+    webp: 无损，method 0-6 (越大越慢、越小)
+    raw: RAW_MAGIC + 宽高 + RGBA 像素，不压缩
+    qoi: QOI 快速无损格式，需要 Pillow 支持写入
+    '''
+    FORMATS = {'png': '.png', 'webp': '.webp', 'raw': '.rgba', 'qoi': '.qoi'}
+    def __init__(self, format:str='png', level:int|None=None):
+        if format not in self.FORMATS:
+            raise VHError(f"未知的输出格式: {format}，可选 {', '.join(self.FORMATS)}")
+        if format == 'webp' and not features.check('webp'):
+            raise VHError("当前 Pillow 不支持 WebP 编码")
+        if format == 'qoi':
+            Image.init()
+            if 'QOI' not in Image.SAVE:
+                raise VHError("当前 Pillow 不支持 QOI 编码")
+        self.format = format
+        if level is None:
+            level = {'png': 6, 'webp': 4}.get(format)
+        self.level = level
+    def __repr__(self):
+        return f"Encoder({self.spec!r})"
+    def __eq__(self, other):
+        return isinstance(other, Encoder) and self.spec == other.spec
+
+    @property
+    def spec(self) -> str:
+        return self.format if self.level is None else f'{self.format}:{self.level}'
+    @classmethod
+    def parse(cls, spec:str) -> 'Encoder':
+        '''解析 "png"、"png:1"、"webp:6"、"raw"、"qoi" 形式的设置'''
+        format, _, level = spec.partition(':')
+        return cls(format.lower(), int(level) if level else None)
+
+    @property
+    def ext(self) -> str:
+        return self.FORMATS[self.format]
+    def output_path(self, path:str) -> str:
+        '''把扩展名换成该格式的扩展名'''
+        return os.path.splitext(path)[0] + self.ext
+
+    def encode(self, image:Image.Image) -> bytes:
+        with tracing.span('encode', format=self.spec):
+            return self._encode(image)
+    def _encode(self, image:Image.Image) -> bytes:
+        if self.format == 'raw':
+            image = image.convert('RGBA')
+            return RAW_MAGIC + struct.pack('<II', image.width, image.height) + image.tobytes()
+        buffer = io.BytesIO()
+        if self.format == 'png':
+            image.save(buffer, format='PNG', compress_level=self.level)
+        elif self.format == 'webp':
+            # exact 保留完全透明像素的颜色，与 png/raw 的像素一致
+            image.save(buffer, format='WEBP', lossless=True, method=self.level, exact=True)
+        else:
+            image.save(buffer, format='QOI')
+        return buffer.getvalue()
+
+def read_raw(path:str) -> Image.Image:
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:len(RAW_MAGIC)] != RAW_MAGIC:
+        raise VHError(f"不是 raw RGBA 文件: {path}")
+    width, height = struct.unpack_from('<II', data, len(RAW_MAGIC))
+    return Image.frombytes('RGBA', (width, height), data[len(RAW_MAGIC) + 8:])
+
+def read_image(path:str) -> Image.Image:
+    '''读取任意 Encoder 格式写出的图像'''
+    if path.endswith(Encoder.FORMATS['raw']):
+        return read_raw(path)
+    with Image.open(path) as image:
+        image.load()
+        return image
+
+def write_atomic(data:bytes, output_path:str) -> str:
+    '''写入临时文件再替换，中断时不会留下不完整的输出。返回内容的 sha256'''
+    tmp_path = f'{output_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        # 写入或替换失败时原有的输出不变，也不留下临时文件
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return hashlib.sha256(data).hexdigest()
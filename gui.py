@@ -1,17 +1,20 @@
-import os, json
+import os, json, queue, threading
 import tkinter as tk
 from tkinter import ttk, Menu, filedialog, messagebox
 from PIL import Image, ImageTk
 
 import api
+import psd_handler
+import tracing
 from api import (
     PSDVarianceHandler, Category, 
-    VHError, NotAllowedError,
-    DEBUG
+    VHError, NotAllowedError
 )
 
 current_menu = None
 root = None
+preview_worker = None
+tree_model = None
 
 def warning(message):
     messagebox.showwarning("警告", message)
@@ -63,11 +66,107 @@ def close_menu(event):
         current_menu = None
 #### GUI 主界面功能 END####
 
+#### 后台渲染 ####
+class PreviewWorker:
+    '''
+    在后台线程中合成预览图，Tk 主线程只负责取可见图层快照和显示结果。
+    request() 会被防抖：delay_ms 内的连续调用只提交最后一次；
+    渲染线程每次只取最新的任务，先在与显示大小相当的金字塔级别上合成低分辨率预览，
+    没有新请求时再合成全分辨率图像替换；完成时若已有更新的请求则丢弃结果。
+    结果放入队列，由主线程用 after() 轮询后交给 on_done。
+    渲染时持有 vh.lock，主线程经 api 或 vh.rename_layer 的修改等当前这次合成结束后再进行。
+    '''
+    def __init__(self, widget:tk.Misc, vh:PSDVarianceHandler, on_done, max_size=None, delay_ms:int=150, poll_ms:int=30):
+        '''max_size: 返回显示区域 (宽, 高) 的函数，为 None 时直接合成全分辨率图像'''
+        self.widget = widget
+        self.vh = vh
+        self.on_done = on_done
+        self.max_size = max_size
+        self.delay_ms = delay_ms
+        self.poll_ms = poll_ms
+        self._after_id = None
+        self._generation = 0
+        self._job = None
+        self._cond = threading.Condition()
+        self._results = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='preview-render', daemon=True)
+        self._thread.start()
+        self.widget.after(self.poll_ms, self._poll)
+
+    def request(self):
+        '''可见性改变后调用，只在主线程中调用'''
+        if self._after_id is not None:
+            self.widget.after_cancel(self._after_id)
+        self._after_id = self.widget.after(self.delay_ms, self._submit)
+
+    def _submit(self):
+        self._after_id = None
+        # Category 树只在主线程读写，这里取一份可见图层快照交给渲染线程
+        try:
+            layer_idxs = self.vh.parse_layer(self.vh.root.get_all_visible_layers())
+        except VHError as e:
+            error(str(e))
+            return
+        level = self.vh.preview_level(self.max_size()) if self.max_size is not None else 0
+        with self._cond:
+            self._generation += 1
+            self._job = (self._generation, layer_idxs, level)
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._job is None and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                generation, layer_idxs, level = self._job
+                self._job = None
+            for stage in ([level, 0] if level > 0 else [0]):
+                # 有新请求时不再细化当前结果
+                if stage == 0 and level > 0 and self._job is not None:
+                    break
+                try:
+                    with self.vh.lock:
+                        image = self.vh.render(layer_idxs, level=stage)
+                except Exception as e:
+                    self._results.put((generation, None, e))
+                    break
+                self._results.put((generation, image, None))
+
+    def _poll(self):
+        if self._closed:
+            return
+        latest = None
+        while True:
+            try:
+                latest = self._results.get_nowait()
+            except queue.Empty:
+                break
+        # 渲染期间又有新请求时，旧结果直接丢弃
+        if latest is not None and latest[0] == self._generation:
+            generation, image, exc = latest
+            if exc is not None:
+                error(f"预览渲染失败: {exc}")
+            else:
+                self.on_done(image)
+        self.widget.after(self.poll_ms, self._poll)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+def request_preview():
+    if preview_worker is not None:
+        preview_worker.request()
+#### 后台渲染 END ####
+
 #### 差分列表功能 ####
 ### Category Menu Function ###
 def rename_category(tree:ttk.Treeview, item_id:str, category_name:str, vh:PSDVarianceHandler):
-    if DEBUG:
-        print(f"Rename category {category_name}")
+    tracing.log(f"Rename category {category_name}")
     c_name, c_mode, c_visibility = parse_category_name(category_name)
     rename_window = tk.Toplevel()
     rename_window.title(f"重命名 {c_name}")
@@ -84,7 +183,6 @@ def rename_category(tree:ttk.Treeview, item_id:str, category_name:str, vh:PSDVar
                 api.rename_sub_c(vh, c_name, get_all_parents(tree, item_id), new_name)
                 # Rename the item in the treeview
                 mark_unsaved()
-                tree.item(item_id, text=f"{new_name} ({c_mode}){'*' if c_visibility else ''}")
             except VHError as e:
                 error(str(e))
                 return
@@ -99,20 +197,14 @@ def rename_category(tree:ttk.Treeview, item_id:str, category_name:str, vh:PSDVar
     tk.Button(rename_window, text="保存", command=save_new_name).pack(pady=10)
 
 def reverse_visibility(tree:ttk.Treeview, item_id:str, category_name:str, vh:PSDVarianceHandler):
-    if DEBUG:
-        print(f"Reverse visibility of {category_name}")
+    tracing.log(f"Reverse visibility of {category_name}")
     c_name, c_mode, c_visibility = parse_category_name(category_name)
     try:
         parents = get_all_parents(tree, item_id)
+        # 父类别会发出改变通知，由 tree_model 只更新受影响的行
         api.reverse_visibility(vh, c_name, parent_names=parents)
-        # Change the item in the treeview
-        parent_id = tree.parent(item_id)
-        parent_c = vh.get_Categories(parents)[-1] if len(parents) > 0 else vh.root
-        for child in tree.get_children(parent_id):
-            tree.delete(child)
-        for sub_c, v in zip(parent_c.subcategories, parent_c.visibilities):
-            build_tree(tree, parent_id, sub_c, v)
         # mark_unsaved()
+        request_preview()
     except VHError as e:
         error(str(e))
     except NotAllowedError as e:
@@ -121,10 +213,11 @@ def reverse_visibility(tree:ttk.Treeview, item_id:str, category_name:str, vh:PSD
 
 def create_menu(tree:ttk.Treeview, event:tk.Event, vh:PSDVarianceHandler):
     global current_menu
-    if DEBUG: print(f"Right-clicked at {event.x}, {event.y}")
+    tracing.log(f"Right-clicked at {event.x}, {event.y}")
     selected_item = tree.identify('item', event.x, event.y)
     tree.selection_set(selected_item)
-    category_name = tree.item(selected_item, 'text')
+    # 占位行不对应任何类别或图层
+    category_name = tree.item(selected_item, 'text') if tree_model.owns(selected_item) else ''
 
     current_menu = Menu(tree, tearoff=0)
     if category_name:
@@ -136,22 +229,142 @@ def create_menu(tree:ttk.Treeview, event:tk.Event, vh:PSDVarianceHandler):
     current_menu.add_command(label="Option 2", command=lambda: print("Option 2 selected"))
     current_menu.post(event.x_root, event.y_root)
 
-def build_tree(tree:ttk.Treeview, parent:str, category:Category, display:bool):
-    display_name = f"{category.name} ({category.mode})"
-    if display:
-        display_name += '*'
-    item_id = tree.insert(parent, 'end', text=display_name)
-    if category.mode == 'all':
-        tree.item(item_id, open=True)
-    if len(subcategory := category.subcategories) > 0:
-        for subcategory, v in zip(subcategory, category.visibilities):
-            build_tree(tree, item_id, subcategory, v)
-    elif len(layers := category.layers) > 0:
-        for layer, v in zip(layers, category.visibilities):
-            display_name = layer
-            if v:
-                display_name += '*'
-            tree.insert(item_id, 'end', text=display_name)
+class CategoryTree:
+    '''
+    Treeview 与 Category 树的映射。每一行对应 (父类别, 槽位)，行文本由父类别的 visibilities 决定。
+    行插入后订阅父类别的改变通知，可见性改变时只更新该类别子行的文字，子类别或图层数量改变时只重建这一层。
+    未展开的子树只放一个占位行，第一次展开时才插入其中的行。
+    '''
+    PLACEHOLDER = '…'
+    def __init__(self, tree:ttk.Treeview, root_category:Category):
+        self.tree = tree
+        self.root_category = root_category
+        # 行 id -> (父类别, 槽位)
+        self.rows:dict[str, tuple[Category, int]] = {}
+        # 已插入子行的行 id -> (类别, 子行 id 列表)，根类别的行 id 为 ''
+        self.children:dict[str, tuple[Category, list[str]]] = {}
+        # id(类别) -> 行 id
+        self.items:dict[int, str] = {}
+        self.tree.bind('<<TreeviewOpen>>', self._on_open, add='+')
+        self.rebuild()
+
+    def owns(self, item_id:str) -> bool:
+        return item_id in self.rows
+
+    def category_of(self, item_id:str) -> Category|None:
+        '''行对应的类别，图层行返回 None'''
+        if item_id == '':
+            return self.root_category
+        parent_c, slot = self.rows[item_id]
+        return parent_c.subcategories[slot] if len(parent_c.subcategories) > 0 else None
+
+    def parent_of(self, item_id:str) -> Category:
+        return self.rows[item_id][0]
+
+    @staticmethod
+    def label(parent_c:Category, slot:int) -> str:
+        if len(parent_c.subcategories) > 0:
+            sub_c = parent_c.subcategories[slot]
+            text = f"{sub_c.name} ({sub_c.mode})"
+        else:
+            text = parent_c.layers[slot]
+        return text + '*' if parent_c.visibilities[slot] else text
+
+    def rebuild(self):
+        '''按 root_category 重建，保留已展开的行'''
+        opened = {self.path(item) for item in self.rows if self.tree.item(item, 'open')}
+        for c, _ in self.children.values():
+            c.unsubscribe(self._on_change)
+        self.tree.delete(*self.tree.get_children(''))
+        self.rows.clear()
+        self.children.clear()
+        self.items.clear()
+        self._populate('', self.root_category)
+        for path in sorted(opened, key=len):
+            if (item := self.find(path)) is not None:
+                self.expand(item)
+
+    def path(self, item_id:str) -> tuple[str, ...]:
+        names = []
+        while item_id:
+            c = self.category_of(item_id)
+            names.append(c.name if c is not None else self.tree.item(item_id, 'text').rstrip('*'))
+            item_id = self.tree.parent(item_id)
+        return tuple(reversed(names))
+
+    def find(self, path:tuple[str, ...]) -> str|None:
+        '''按类别名路径查找行，沿途展开'''
+        item_id = ''
+        for name in path:
+            if item_id:
+                self.expand(item_id)
+            c = self.category_of(item_id)
+            if c is None or (result := c.get_sub(name)) is None:
+                return None
+            item_id = self.children[item_id][1][result[0]]
+        return item_id
+
+    def expand(self, item_id:str):
+        self._ensure_populated(item_id)
+        self.tree.item(item_id, open=True)
+
+    def _insert(self, parent_item:str, parent_c:Category, slot:int) -> str:
+        item_id = self.tree.insert(parent_item, 'end', text=self.label(parent_c, slot))
+        self.rows[item_id] = (parent_c, slot)
+        if (c := self.category_of(item_id)) is not None and len(c.visibilities) > 0:
+            if c.mode == 'all':
+                self.expand(item_id)
+            else:
+                self.tree.insert(item_id, 'end', text=self.PLACEHOLDER)
+        return item_id
+
+    def _populate(self, item_id:str, c:Category):
+        for child in self.tree.get_children(item_id):
+            self._forget(child)
+        self.tree.delete(*self.tree.get_children(item_id))
+        items = [self._insert(item_id, c, slot) for slot in range(len(c.visibilities))]
+        self.children[item_id] = (c, items)
+        self.items[id(c)] = item_id
+        c.subscribe(self._on_change)
+
+    def _forget(self, item_id:str):
+        '''删除行之前清理映射与订阅'''
+        if self.rows.pop(item_id, None) is None:
+            return
+        for child in self.tree.get_children(item_id):
+            self._forget(child)
+        if (entry := self.children.pop(item_id, None)) is not None:
+            entry[0].unsubscribe(self._on_change)
+            del self.items[id(entry[0])]
+
+    def _ensure_populated(self, item_id:str):
+        c = self.category_of(item_id)
+        if c is not None and item_id not in self.children:
+            self._populate(item_id, c)
+
+    def _on_open(self, event):
+        if (item_id := self.tree.focus()) and self.owns(item_id):
+            self._ensure_populated(item_id)
+
+    def _on_change(self, c:Category):
+        item_id = self.items[id(c)]
+        items = self.children[item_id][1]
+        if len(items) != len(c.visibilities):
+            self._populate(item_id, c)
+            return
+        for slot, child in enumerate(items):
+            self.tree.item(child, text=self.label(c, slot))
+            # 模式或子类别数量改变后占位行可能需要更新
+            if (sub_c := self.category_of(child)) is not None and child not in self.children:
+                has_placeholder = len(self.tree.get_children(child)) > 0
+                if has_placeholder != (len(sub_c.visibilities) > 0):
+                    self.tree.delete(*self.tree.get_children(child))
+                    if not has_placeholder:
+                        self.tree.insert(child, 'end', text=self.PLACEHOLDER)
+        if item_id:
+            # 类别的名称或模式显示在它自己的行上
+            parent_c, slot = self.rows[item_id]
+            self.tree.item(item_id, text=self.label(parent_c, slot))
 
 def get_all_parents(tree:ttk.Treeview, item_id):
     parents = []
@@ -166,45 +379,56 @@ def get_all_parents(tree:ttk.Treeview, item_id):
 def on_tree_double_click(event, tree:ttk.Treeview, vh:PSDVarianceHandler):
     item_id = tree.identify('item', event.x, event.y)
     if item_id:
+        if not tree_model.owns(item_id):
+            return
         category_name = tree.item(item_id, 'text')
         parent_names = get_all_parents(tree, item_id)
-        parent_c_mode = parse_category_name(tree.item(tree.parent(item_id), 'text'))[1]
-        if DEBUG: print(f"Double-clicked on: {category_name}, Parents: {parent_names}")
+        parent_c_mode = tree_model.parent_of(item_id).mode
+        tracing.log(f"Double-clicked on: {category_name}, Parents: {parent_names}")
         if parent_c_mode == 'all':
-            if DEBUG: print("Parent mode is 'all'. Forbidden to change.")
+            tracing.log("Parent mode is 'all'. Forbidden to change.")
             return
         reverse_visibility(tree, item_id, category_name, vh)
 #### 差分列表功能 END ####
 
 #### GUI 顶部按钮功能 ####
 def refresh_tree(tree:ttk.Treeview, root_category:Category):
-    for item in tree.get_children():
-        tree.delete(item)
-    for sub_c in root_category.subcategories:
-        build_tree(tree, "", sub_c, False)
+    global tree_model
+    if tree_model is None or tree_model.root_category is not root_category:
+        tree_model = CategoryTree(tree, root_category)
+    else:
+        tree_model.rebuild()
 
 def refresh_all(tree: ttk.Treeview, canvas: tk.Canvas, root_category: Category):
     refresh_tree(tree, root_category)
     canvas.delete("all")
     print("Treeview refreshed and Canvas cleared")
 
-def show_image(canvas:tk.Canvas, image_path:str=os.path.join('resources', 'output1.png')):
-    image = Image.open(image_path)
-    canvas_width = 700
-    canvas_height = 700
-    
-    image_width, image_height = image.size
-    scale = min(canvas_width / image_width, canvas_height / image_height)
-    new_width = int(image_width * scale)
-    new_height = int(image_height * scale)
-    
-    resized_image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-    image_tk = ImageTk.PhotoImage(resized_image)
-    
-    canvas.delete("all")
-    canvas.create_image(0, 0, anchor='nw', image=image_tk)
-    canvas.image = image_tk  # 保存引用以防止图像被垃圾回收
-    canvas.original_image = image
+def canvas_size(canvas:tk.Canvas) -> tuple[int, int]:
+    # 画布尚未布局时宽高为 1
+    canvas_width = canvas.winfo_width() if canvas.winfo_width() > 1 else 700
+    canvas_height = canvas.winfo_height() if canvas.winfo_height() > 1 else 700
+    return canvas_width, canvas_height
+
+def show_image(canvas:tk.Canvas, image:Image.Image|str):
+    '''image: 合成好的图像或图片路径，低分辨率预览也按画布大小缩放显示'''
+    if isinstance(image, str):
+        image = Image.open(image)
+    with tracing.span('gui.redraw', size=image.size):
+        canvas_width, canvas_height = canvas_size(canvas)
+        
+        image_width, image_height = image.size
+        scale = min(canvas_width / image_width, canvas_height / image_height)
+        new_width = int(image_width * scale)
+        new_height = int(image_height * scale)
+        
+        resized_image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+        image_tk = ImageTk.PhotoImage(resized_image)
+        
+        canvas.delete("all")
+        canvas.create_image(0, 0, anchor='nw', image=image_tk)
+        canvas.image = image_tk  # 保存引用以防止图像被垃圾回收
+        canvas.original_image = image
 
 def save_image(canvas: tk.Canvas):
     if not hasattr(canvas, 'original_image') or not canvas.original_image:
@@ -218,12 +442,13 @@ def save_image(canvas: tk.Canvas):
         print(f"Image saved to {file_path}")
 
 def menu_button(tree:ttk.Treeview, vh:PSDVarianceHandler):
-    if DEBUG: print("Menu button clicked")
+    tracing.log("Menu button clicked")
     # 获取treeview中选中的项目
     selected_item = tree.selection()
     print(selected_item)
     tree.selection_set(selected_item)
-    category_name = tree.item(selected_item, 'text')
+    selected_item = selected_item[0] if selected_item else ''
+    category_name = tree.item(selected_item, 'text') if tree_model.owns(selected_item) else ''
 
     current_menu = Menu(tree, tearoff=0)
     if category_name:
@@ -238,8 +463,11 @@ def menu_button(tree:ttk.Treeview, vh:PSDVarianceHandler):
 #### GUI 顶部按钮功能 END ####
 
 def main(vh:PSDVarianceHandler):
-    global root
+    global root, preview_worker
     root_category = vh.root
+    if psd_handler.DEBUG and not tracing.ENABLED:
+        # VH_DEBUG=1 时把日志打印到终端，计时与计数需要另外添加 sink
+        tracing.enable(tracing.LogSink())
     root = tk.Tk()
     root.title("差分预览")
     root.geometry("950x770")
@@ -250,7 +478,7 @@ def main(vh:PSDVarianceHandler):
     commands = [
         lambda: menu_button(tree, vh),
         lambda: refresh_all(tree, canvas, root_category),
-        lambda: show_image(canvas), 
+        lambda: request_preview(), 
         lambda: save_image(canvas), 
         lambda: check_unsaved_changes_then_quit()
     ]
@@ -278,11 +506,14 @@ def main(vh:PSDVarianceHandler):
     root.bind("<Button-1>", close_menu)
     root.protocol("WM_DELETE_WINDOW", check_unsaved_changes_then_quit)
 
-    for sub_c in root_category.subcategories:
-        build_tree(tree, "", sub_c, True)
+    refresh_tree(tree, root_category)
+
+    preview_worker = PreviewWorker(root, vh, lambda image: show_image(canvas, image), lambda: canvas_size(canvas))
+    preview_worker.request()
 
     root.mainloop()
+    preview_worker.close()
 
 if __name__ == "__main__":
-    vh = PSDVarianceHandler(config=os.path.join('resources', 'vh_config.json'))
+    vh = PSDVarianceHandler(config=os.path.join('resources', 'vh_config.json'), incremental=True)
     main(vh)
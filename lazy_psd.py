@@ -0,0 +1,264 @@
+import mmap, struct
+
+import numpy as np
+from PIL import Image
+from psd_tools.compression import decompress
+from psd_tools.constants import BlendMode, ChannelID, Clipping, ColorMode, Compression, SectionDivider, Tag
+from psd_tools.psd.header import FileHeader
+from psd_tools.psd.layer_and_mask import LayerRecord
+
+_EFFECT_TAGS = (Tag.OBJECT_BASED_EFFECTS_LAYER_INFO, Tag.OBJECT_BASED_EFFECTS_LAYER_INFO_V0,
+                Tag.OBJECT_BASED_EFFECTS_LAYER_INFO_V1, Tag.EFFECTS_LAYER)
+
+class LazyLayer:
+    '''
+    只含图层记录的轻量图层。通道数据只记录在文件中的偏移，第一次 topil() 时才从内存映射中解码。
+    提供 PSDVarianceHandler 与 LayerCache 用到的 psd_tools 图层接口子集。
+    '''
+    def __init__(self, psd:'LazyPSD', record:LayerRecord, channels:list[tuple[int, int, int]]):
+        self._psd = psd
+        self._record = record
+        # (通道 id, 数据起始偏移, 数据长度)，数据以 2 字节压缩类型开头
+        self._channels = channels
+        self._layers:list['LazyLayer'] = []
+        self._clip_layers:list['LazyLayer'] = []
+        self.parent:'LazyLayer|LazyPSD|None' = None
+        self._bbox:tuple[int, int, int, int]|None = None
+        self._name = record.tagged_blocks.get_data(Tag.UNICODE_LAYER_NAME, record.name)
+        self._section = None
+        for tag in (Tag.SECTION_DIVIDER_SETTING, Tag.NESTED_SECTION_DIVIDER_SETTING):
+            if (setting := record.tagged_blocks.get_data(tag)) is not None:
+                self._section = setting
+                break
+    def __repr__(self):
+        return f"LazyLayer({self.name!r}, {self.kind}, {self.bbox})"
+    def __iter__(self):
+        return iter(self._layers)
+    def __len__(self):
+        return len(self._layers)
+    def __getitem__(self, index):
+        return self._layers[index]
+
+    @property
+    def name(self) -> str:
+        return self._name
+    @name.setter
+    def name(self, value:str):
+        self._name = value
+    @property
+    def kind(self) -> str:
+        return 'group' if self.is_group() else 'pixel'
+    def is_group(self) -> bool:
+        return self._section is not None and self._section.kind in (SectionDivider.OPEN_FOLDER, SectionDivider.CLOSED_FOLDER)
+    def _is_divider(self) -> bool:
+        return self._section is not None and self._section.kind == SectionDivider.BOUNDING_SECTION_DIVIDER
+    @property
+    def visible(self) -> bool:
+        return self._record.flags.visible
+    def is_visible(self) -> bool:
+        return self.visible and (self.parent is None or self.parent.is_visible())
+    @property
+    def opacity(self) -> int:
+        return self._record.opacity
+    @property
+    def fill_opacity(self) -> int:
+        return self._record.tagged_blocks.get_data(Tag.BLEND_FILL_OPACITY, 255)
+    @property
+    def blend_mode(self) -> BlendMode:
+        if self._section is not None and getattr(self._section, 'blend_mode', None) is not None:
+            return self._section.blend_mode
+        return self._record.blend_mode
+    @property
+    def clipping(self) -> bool:
+        return self._record.clipping == Clipping.NON_BASE
+    def has_clip_layers(self) -> bool:
+        return len(self._clip_layers) > 0
+    def has_mask(self) -> bool:
+        return self._record.mask_data is not None
+    def has_effects(self) -> bool:
+        # 不解析效果描述符，只要存在效果记录就视为有效果，由调用方回退到 psd_tools
+        return any(tag in self._record.tagged_blocks for tag in _EFFECT_TAGS)
+
+    @property
+    def left(self) -> int:
+        return self.bbox[0]
+    @property
+    def top(self) -> int:
+        return self.bbox[1]
+    @property
+    def right(self) -> int:
+        return self.bbox[2]
+    @property
+    def bottom(self) -> int:
+        return self.bbox[3]
+    @property
+    def width(self) -> int:
+        return max(0, self.right - self.left)
+    @property
+    def height(self) -> int:
+        return max(0, self.bottom - self.top)
+    @property
+    def size(self) -> tuple[int, int]:
+        return self.width, self.height
+    @property
+    def bbox(self) -> tuple[int, int, int, int]:
+        '''
+        像素图层为图层记录的范围；图层组的记录范围为空，与 psd_tools 一样取可见、非剪贴子图层范围的并集，
+        没有这样的子图层时为 (0, 0, 0, 0)
+        '''
+        if self._bbox is None:
+            if self.is_group():
+                self._bbox = _extract_bbox(self._layers)
+            else:
+                record = self._record
+                self._bbox = (record.left, record.top, record.right, record.bottom)
+        return self._bbox
+    def has_pixels(self) -> bool:
+        return self.width > 0 and self.height > 0 and any(
+            channel_id >= 0 and length > 2 for channel_id, _, length in self._channels)
+    def channel_data(self) -> list[tuple[int, Compression, bytes]]:
+        '''(通道 id, 压缩方式, 压缩数据) 列表，只从内存映射中复制该图层的数据，不解码'''
+        output = []
+        for cid, offset, length in self._channels:
+            compression = Compression(struct.unpack_from('>H', self._psd._mm, offset)[0])
+            output.append((cid, compression, self._psd._mm[offset + 2:offset + length]))
+        return output
+
+    def _read_channel(self, channel_id:int) -> np.ndarray|None:
+        for cid, offset, length in self._channels:
+            if cid == channel_id:
+                compression = Compression(struct.unpack_from('>H', self._psd._mm, offset)[0])
+                data = self._psd._mm[offset + 2:offset + length]
+                raw = decompress(data, compression, self.width, self.height, self._psd.depth, self._psd.version)
+                return np.frombuffer(raw, dtype=np.uint8).reshape(self.height, self.width)
+        return None
+    def topil(self) -> Image.Image|None:
+        '''解码 RGBA 像素，只支持 8 位 RGB 文档'''
+        if not self.has_pixels():
+            return None
+        if self._psd.color_mode != ColorMode.RGB or self._psd.depth != 8:
+            raise ValueError(f"延迟加载只支持 8 位 RGB 文档: {self._psd.color_mode.name}, {self._psd.depth} 位")
+        planes = [self._read_channel(channel_id) for channel_id in (0, 1, 2, ChannelID.TRANSPARENCY_MASK)]
+        if planes[3] is None:
+            planes[3] = np.full((self.height, self.width), 255, dtype=np.uint8)
+        planes = [p if p is not None else np.zeros((self.height, self.width), dtype=np.uint8) for p in planes]
+        return Image.fromarray(np.dstack(planes), 'RGBA')
+
+def _extract_bbox(layers) -> tuple[int, int, int, int]:
+    bboxes = [layer.bbox for layer in layers if layer.is_visible() and not layer.clipping]
+    bboxes = [bbox for bbox in bboxes if bbox != (0, 0, 0, 0)]
+    if not bboxes:
+        return (0, 0, 0, 0)
+    lefts, tops, rights, bottoms = zip(*bboxes)
+    return min(lefts), min(tops), max(rights), max(bottoms)
+
+class LazyPSD:
+    '''
+    延迟加载的 PSD 文档。打开时只读取文件头和图层记录并建立图层树，
+    通道数据保留在内存映射中，直到某个图层第一次需要像素时才解码。
+    '''
+    def __init__(self, path:str):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._layers:list[LazyLayer] = []
+        self.parent = None
+        self.name = 'Root'
+        try:
+            self._read()
+        except Exception:
+            self.close()
+            raise
+    def __repr__(self):
+        return f"LazyPSD({self.path!r}, size={self.width}x{self.height})"
+    def __iter__(self):
+        return iter(self._layers)
+    def __len__(self):
+        return len(self._layers)
+    def __getitem__(self, index):
+        return self._layers[index]
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        self._file.close()
+
+    def is_group(self) -> bool:
+        return True
+    @property
+    def size(self) -> tuple[int, int]:
+        return self.width, self.height
+    @property
+    def visible(self) -> bool:
+        return True
+    def is_visible(self) -> bool:
+        return True
+
+    def _read_length(self, fp) -> int:
+        return struct.unpack('>Q' if self.version == 2 else '>I', fp.read(8 if self.version == 2 else 4))[0]
+    def _read(self):
+        # 图层记录按顺序从文件读取，通道数据只通过内存映射按需访问
+        fp = self._file
+        header = FileHeader.read(fp)
+        self.version = header.version
+        self.width, self.height = header.width, header.height
+        self.depth = header.depth
+        self.color_mode = ColorMode(header.color_mode)
+        # 跳过颜色模式数据与图像资源
+        for _ in range(2):
+            length = struct.unpack('>I', fp.read(4))[0]
+            fp.seek(length, 1)
+        layer_and_mask_length = self._read_length(fp)
+        if layer_and_mask_length == 0:
+            return
+        layer_info_length = self._read_length(fp)
+        if layer_info_length == 0:
+            return
+        layer_count = abs(struct.unpack('>h', fp.read(2))[0])
+        records = [LayerRecord.read(fp, encoding='macroman', version=self.version) for _ in range(layer_count)]
+        # 通道数据紧随图层记录，按记录顺序排列，只计算偏移
+        offset = fp.tell()
+        layers = []
+        for record in records:
+            channels = []
+            for info in record.channel_info:
+                channels.append((int(info.id), offset, info.length))
+                offset += info.length
+            layers.append(LazyLayer(self, record, channels))
+        self._build_tree(layers)
+
+    def _build_tree(self, layers:list[LazyLayer]):
+        '''图层记录从下到上排列，分隔符记录开启图层组，组记录结束图层组'''
+        stack:list[list[LazyLayer]] = [[]]
+        for layer in layers:
+            if layer._is_divider():
+                stack.append([])
+            elif layer.is_group():
+                layer._layers = stack.pop() if len(stack) > 1 else []
+                stack[-1].append(layer)
+            else:
+                stack[-1].append(layer)
+        self._layers = stack[0]
+        self._link(self, self._layers)
+    def _link(self, parent, children:list[LazyLayer]):
+        base = None
+        for layer in children:
+            layer.parent = parent
+            if layer.clipping and base is not None:
+                base._clip_layers.append(layer)
+            elif not layer.clipping:
+                base = layer
+            if layer.is_group():
+                self._link(layer, layer._layers)
+
+    def descendants(self):
+        def walk(layers):
+            for layer in layers:
+                yield layer
+                if layer.is_group():
+                    yield from walk(layer._layers)
+        return walk(self._layers)
@@ -1,32 +1,112 @@
-from psd_tools import PSDImage
-from PIL import Image
-import json, copy, os
+from __future__ import annotations
+import json, copy, os, math, random, threading, warnings
+from typing import TYPE_CHECKING
+
+import tracing
+
+# psd_tools、PIL 与 numpy 导入较慢，只在需要打开 PSD 或合成时才导入，
+# 只读写类别或统计差分时不需要
+if TYPE_CHECKING:
+    from psd_tools import PSDImage
+    from PIL import Image
+    from renderer import LayerCache, Compositor, NumpyCompositor, RenderCache
+    from lazy_psd import LazyPSD
+
+def __getattr__(name):
+    # 兼容 from psd_handler import PSDImage
+    if name == 'PSDImage':
+        from psd_tools import PSDImage
+        return PSDImage
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 class VHError(Exception):
     pass
 
-DEBUG = True
+# 设置环境变量 VH_DEBUG=1 开启：add_sub_c_to_category 遇到模式不匹配时只发出警告而不报错，
+# gui 把 tracing 日志打印到终端
+DEBUG = os.environ.get('VH_DEBUG', '') not in ('', '0')
+
+def _mode_mismatch(message:str):
+    if not DEBUG:
+        raise VHError(message)
+    warnings.warn(message, stacklevel=3)
+    tracing.log(message)
+
+BACKENDS = ('pil', 'numpy', 'psd_tools')
+
+MODES = ('all', 'or', 'one', 'same', 'unk')
+
+class Visibilities(bytearray):
+    '''
+    类别的可见性，每项占一个字节。
+    读取与迭代得到 bool，可以与 list/tuple 比较，其余用法与 list[bool] 相同 (append、pop、切片赋值等)
+    '''
+    __slots__ = ()
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return Visibilities(bytearray.__getitem__(self, i))
+        return bytearray.__getitem__(self, i) != 0
+    def __iter__(self):
+        return map(bool, bytearray.__iter__(self))
+    def pop(self, i:int=-1) -> bool:
+        return bytearray.pop(self, i) != 0
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple)):
+            return len(self) == len(other) and bytearray.__eq__(self, bytes(map(bool, other)))
+        return bytearray.__eq__(self, other)
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+    __hash__ = None
+    def copy(self) -> 'Visibilities':
+        return Visibilities(self)
+    def __repr__(self):
+        return repr(list(self))
+    # bytearray.__str__ 输出字节串，错误信息中的 f-string 也应显示为 list[bool]
+    __str__ = __repr__
 
 class Category:
-    def __init__(self, name:str, mode:str='unk', subcategories:list['Category']=[], layers:list[str]=[], visibilities:list[bool]=[]):
+    # 生成的类别树可能有数万个类别，用 __slots__ 省去每个类别的实例字典；
+    # 订阅者列表在第一次 subscribe 时才创建
+    __slots__ = ('name', 'mode', 'subcategories', 'layers', '_visibilities', '_listeners')
+    def __init__(self, name:str, mode:str='unk', subcategories:list['Category']|None=None, layers:list[str]|None=None,
+                 visibilities:list[bool]|None=None):
         self.name = name
-        if mode in ['all', 'or', 'one', 'same', 'unk']:
+        if mode in MODES:
             self.mode = mode
         else:
             raise VHError(f"未知的模式: {mode}")
-        self.subcategories = subcategories
-        self.layers = layers
-        if len(visibilities) == 0:
-            self.visibilities = []
+        self.subcategories = subcategories if subcategories is not None else []
+        self.layers = layers if layers is not None else []
+        if not visibilities:
             self._build_visibility()
         else:
             self.visibilities = visibilities
+        self._listeners:list|None = None
         self.check_visibility()
     def __str__(self):
         return f"Category({self.name}, {self.mode}, {len(self.subcategories)} subs, {len(self.layers)} layers)"
+    @property
+    def visibilities(self) -> Visibilities:
+        return self._visibilities
+    @visibilities.setter
+    def visibilities(self, value):
+        self._visibilities = value if type(value) is Visibilities else Visibilities(map(bool, value))
+    @classmethod
+    def _restore(cls, name:str, mode:str, subcategories:list['Category'], layers:list[str], visibilities) -> 'Category':
+        '''不做检查直接恢复已校验过的类别 (见 snapshot)'''
+        c = cls.__new__(cls)
+        c.name = name
+        c.mode = mode
+        c.subcategories = subcategories
+        c.layers = layers
+        c._visibilities = Visibilities(visibilities)
+        c._listeners = None
+        return c
     @classmethod
     def _sub_c_from_dict(cls, sub_c:list[dict, bool]) -> list['Category']:
-        return [Category.from_dict(x[0]) for x in sub_c], [x[1] for x in sub_c]
+        # 叶子类别的 subcategories 中保存的是 (图层名, 可见性)
+        return [Category.from_dict(x[0]) for x in sub_c if isinstance(x[0], dict)], [x[1] for x in sub_c]
     @classmethod
     def from_dict(cls, data:dict):
         sub_cs, visibilities = Category._sub_c_from_dict(data['subcategories'])
@@ -57,18 +137,34 @@ class Category:
             self.visibilities = [False] * len(self.subcategories)
         
         if self.mode == 'all':
-            self.visibilities = [True] * len(self.layers)
+            self.visibilities = [True] * len(self.visibilities)
         elif self.mode == 'one':
             self.visibilities[0] = True
+    def subscribe(self, callback):
+        '''callback(category) 在该类别的可见性、子类别或图层改变后被调用'''
+        if self._listeners is None:
+            self._listeners = []
+        if callback not in self._listeners:
+            self._listeners.append(callback)
+    def unsubscribe(self, callback):
+        if self._listeners and callback in self._listeners:
+            self._listeners.remove(callback)
+    def notify(self):
+        '''直接修改 visibilities 等属性后调用，通知订阅者'''
+        if not self._listeners:
+            return
+        for callback in list(self._listeners):
+            callback(self)
     def check_visibility(self):
+        # 可见性只含 0/1，直接用 bytearray 的查找与计数
         if self.mode == 'all':
-            if len(self.visibilities) > 0 and not all(self.visibilities):
+            if 0 in self._visibilities:
                 raise VHError("该类别所有子类别及图层必须可见")
         elif self.mode == 'one':
-            if not sum(1 for x in self.visibilities if x) == 1:
+            if self._visibilities.count(1) != 1:
                 raise VHError("该类别只能有一个子类别或图层可见")
         elif self.mode == 'same':
-            if len(self.visibilities) > 0 and (not all(self.visibilities) or any(self.visibilities)):
+            if 0 in self._visibilities and 1 in self._visibilities:
                 raise VHError(f"该类别所有子类别或图层必须同时可见或不可见: {self.visibilities}")
         
     
@@ -92,8 +188,8 @@ class Category:
     def get_all_visible_layers(self) -> list[str]:
         output = []
         if len(self.subcategories) > 0:
-            for i, c in enumerate(self.subcategories):
-                if c.visibilities[i]:
+            for c, v in zip(self.subcategories, self.visibilities):
+                if v:
                     output.extend(c.get_all_visible_layers())
         else:
             for i, l in enumerate(self.layers):
@@ -105,12 +201,15 @@ class Category:
             raise VHError("无法向包含子类别的类别添加图层")
         self.layers.append(layer)
         self.visibilities.append(False)
+        self.notify()
     def remove_layer(self, layer:str):
         if len(self.subcategories) > 0:
             raise VHError("无法从包含子类别的类别中删除图层")
         if layer in self.layers:
-            self.layers.remove(layer)
-            self.visibilities.pop(self.layers.index(layer))
+            i = self.layers.index(layer)
+            self.layers.pop(i)
+            self.visibilities.pop(i)
+            self.notify()
         else:
             raise VHError(f"未找到名称为 {layer} 的图层")
     def add_sub(self, category_name, mode='unk'):
@@ -122,6 +221,7 @@ class Category:
             self.visibilities.append(self.visibilities[0])
         else:
             self.visibilities.append(False)
+        self.notify()
         return new_c
     def remove_sub(self, category_name:str):
         for i, c in enumerate(self.subcategories):
@@ -132,6 +232,7 @@ class Category:
                 self.visibilities.pop(i)
                 if len(self.subcategories) == 0:
                     self._build_visibility()
+                self.notify()
                 return
     def set_visibility(self, visibility:bool, name:str):
         if self.mode == 'same':
@@ -153,31 +254,279 @@ class Category:
             self.visibilities[self.layers.index(name)] = visibility
         else:
             raise VHError(f"未找到名称为 {name} 的子类别或图层")
+        self.notify()
+
+    ### Variant ###
+    # 一个差分(variant)是 {类别路径: 可见性元组} 的字典，类别路径是从 root(不含)到该类别的名称元组。
+    # 不可见子类别内部的可见性不影响结果，因此不会出现在差分中，也不会被枚举。
+    def _iter_own_visibilities(self):
+        n = len(self.visibilities)
+        if self.mode == 'all':
+            yield (True,) * n
+        elif self.mode == 'one':
+            for i in range(n):
+                yield tuple(j == i for j in range(n))
+        elif self.mode == 'or':
+            # 第 i 个子类别对应计数的第 i 位，与 CompiledCategory 的顺序一致
+            for x in range(1 << n):
+                yield tuple(bool(x >> i & 1) for i in range(n))
+        elif self.mode == 'same':
+            yield (False,) * n
+            if n > 0:
+                yield (True,) * n
+        else:
+            # 未知模式不参与组合，保持当前状态
+            yield tuple(self.visibilities)
+    def _iter_sub_variants(self, subs:list['Category'], path:tuple):
+        if len(subs) == 0:
+            yield {}
+            return
+        for head in subs[0].iter_variants(path + (subs[0].name,)):
+            for tail in self._iter_sub_variants(subs[1:], path):
+                yield head | tail
+    def iter_variants(self, path:tuple=()):
+        '''惰性枚举该类别所有满足模式约束的可见性组合'''
+        for visibilities in self._iter_own_visibilities():
+            visible_subs = [c for c, v in zip(self.subcategories, visibilities) if v]
+            for sub_variant in self._iter_sub_variants(visible_subs, path):
+                yield {path: visibilities} | sub_variant
+    def count_variants(self) -> int:
+        '''不枚举，按模式直接计算 iter_variants 的组合数'''
+        counts = [c.count_variants() for c in self.subcategories] or [1] * len(self.visibilities)
+        return self._count_from(counts)
+    def _count_from(self, counts:list[int]) -> int:
+        '''由各子类别 (或图层) 的组合数计算本类别的组合数'''
+        if self.mode == 'all':
+            return math.prod(counts)
+        if self.mode == 'one':
+            return sum(counts)
+        if self.mode == 'or':
+            return math.prod(1 + x for x in counts)
+        if self.mode == 'same':
+            return 1 + math.prod(counts) if len(counts) > 0 else 1
+        return math.prod(x for x, v in zip(counts, self.visibilities) if v)
+    def _subtree_counts(self, output:dict[int, int]) -> int:
+        '''一次遍历计算所有子树的组合数，写入 output[id(类别)]'''
+        counts = [c._subtree_counts(output) for c in self.subcategories] or [1] * len(self.visibilities)
+        output[id(self)] = result = self._count_from(counts)
+        return result
+    def unrank_variant(self, k:int, path:tuple=()) -> dict[tuple, tuple[bool]]:
+        '''直接返回 iter_variants 中的第 k 个差分 (从 0 开始)'''
+        counts = {}
+        if not 0 <= k < self._subtree_counts(counts):
+            raise VHError(f"差分序号超出范围: {k}")
+        return self._unrank_variant(k, path, counts)
+    def _unrank_variant(self, k:int, path:tuple, subtree_counts:dict[int, int]) -> dict[tuple, tuple[bool]]:
+        '''subtree_counts 为 _subtree_counts 的结果，整次调用只计算一次'''
+        n = len(self.visibilities)
+        counts = [subtree_counts[id(c)] for c in self.subcategories] or [1] * n
+        if self.mode == 'or':
+            # 按计数顺序，高位的取值决定的块最大，从高位到低位逐位确定
+            # prefix 为 counts[:i] 各项加一的乘积，从全部的乘积开始逐位除去，每个节点 O(n)
+            visibilities, chosen = [False] * n, 1
+            prefix = math.prod(1 + x for x in counts)
+            for i in reversed(range(n)):
+                prefix //= 1 + counts[i]
+                block = chosen * prefix
+                if k >= block:
+                    k -= block
+                    visibilities[i] = True
+                    chosen *= counts[i]
+            visibilities = tuple(visibilities)
+        elif self.mode == 'one':
+            # 第 i 个可见时占 counts[i] 个序号，累加找到 k 所在的块
+            for i, x in enumerate(counts):
+                if k < x:
+                    break
+                k -= x
+            visibilities = tuple(j == i for j in range(n))
+        elif self.mode == 'all':
+            visibilities = (True,) * n
+        elif self.mode == 'same':
+            # 全部不可见只有一种组合，排在全部可见之前
+            if k == 0 or n == 0:
+                visibilities = (False,) * n
+            else:
+                visibilities, k = (True,) * n, k - 1
+        else:
+            visibilities = tuple(self.visibilities)
+        output = {path: visibilities}
+        # 可见子类别按混合进制展开，第一个子类别为最高位
+        visible = [(c, x) for c, x, v in zip(self.subcategories, counts, visibilities) if v]
+        block = math.prod(x for _, x in visible)
+        for c, x in visible:
+            block //= x
+            output.update(c._unrank_variant(k // block, path + (c.name,), subtree_counts))
+            k %= block
+        return output
+    def sample_variants(self, n:int, seed=None, unique:bool=False, stratified:bool=False) -> list[dict[tuple, tuple[bool]]]:
+        '''
+        均匀抽取 n 个差分
+        unique: 不重复抽样
+        stratified: 把序号区间均分为 n 段，每段抽取一个，结果按 iter_variants 的顺序排列
+        '''
+        rng = random.Random(seed)
+        counts = {}
+        total = self._subtree_counts(counts)
+        if total == 0:
+            return []
+        if stratified:
+            n = min(n, total)
+            ranks = [i * total // n + rng.randrange((i + 1) * total // n - i * total // n) for i in range(n)]
+        elif unique:
+            ranks = rng.sample(range(total), min(n, total))
+        else:
+            ranks = [rng.randrange(total) for _ in range(n)]
+        return [self._unrank_variant(k, (), counts) for k in ranks]
+    def get_variant(self, path:tuple=()) -> dict[tuple, tuple[bool]]:
+        '''返回当前的完整可见性状态，可用 apply_variant 恢复'''
+        output = {path: tuple(self.visibilities)}
+        for c in self.subcategories:
+            output.update(c.get_variant(path + (c.name,)))
+        return output
+    def apply_variant(self, variant:dict[tuple, tuple[bool]], path:tuple=()):
+        if path in variant:
+            visibilities = variant[path]
+            if len(visibilities) != len(self.visibilities):
+                raise VHError(f"差分与类别 {self.name} 的结构不匹配: {visibilities}")
+            if self.visibilities != visibilities:
+                self.visibilities = visibilities
+                self.notify()
+        for c in self.subcategories:
+            c.apply_variant(variant, path + (c.name,))
+    def variant_name(self, variant:dict[tuple, tuple[bool]], path:tuple=()) -> str:
+        '''由 one/or 类别中被选中的子类别或图层名组成的差分名'''
+        names = []
+        visibilities = variant.get(path, self.visibilities)
+        children = self.subcategories if len(self.subcategories) > 0 else self.layers
+        if self.mode in ('one', 'or'):
+            names.extend(x.name if isinstance(x, Category) else x for x, v in zip(children, visibilities) if v)
+        for c, v in zip(self.subcategories, visibilities):
+            if v and (name := c.variant_name(variant, path + (c.name,))):
+                names.append(name)
+        return '_'.join(names)
 
 class PSDVarianceHandler:
-    def __init__(self, psd_path=None, config=None):
-        if config:
+    def __init__(self, psd_path=None, config=None, lazy=False, cache_dir=None, backend='pil',
+                 render_cache_bytes=128 * 1024 * 1024, snapshot:bool|str=False, incremental:bool=False):
+        """
+        lazy=True 时只读取图层记录与结构并内存映射文件，图层像素在第一次渲染时才解码
+        cache_dir 不为空时，已解码的图层按内容持久化到该目录，之后再打开 (包括修改后的) PSD 时内容未变的图层直接复用
+        backend 为默认合成后端: 'pil'、'numpy' 或 'psd_tools'
+        render_cache_bytes 为完成图 LRU 缓存的字节预算，0 表示不缓存
+        snapshot 只对 config 有效：True 使用配置旁的默认快照 (见 snapshot.snapshot_path)，字符串为快照路径。
+        快照有效时直接恢复类别与图层索引，PSD 在第一次用到图层对象时才打开；无效时正常加载并重写快照
+        incremental=True 时 'pil' 合成器记住上一次的合成，逐个切换图层或类别时只重新混合变化的部分
+        (见 renderer.Compositor._composite_incremental)，适合界面与按顺序导出
+        """
+        if backend not in BACKENDS:
+            raise VHError(f"未知的合成后端: {backend}")
+        self.lazy = lazy
+        self.cache_dir = cache_dir
+        self.backend = backend
+        self.incremental = incremental
+        self._full_psd:PSDImage|None = None
+        self._psd:PSDImage|LazyPSD|None = None
+        self._layer_dict:dict[str, PSDImage]|None = None
+        self._render_cache_bytes = render_cache_bytes
+        self._render_cache:RenderCache|None = None
+        # 后台线程渲染时，渲染与对类别树、图层名、缓存的修改都持有该锁 (见 gui.PreviewWorker 与 api)
+        self.lock = threading.RLock()
+        state = None
+        if config and snapshot:
+            from snapshot import snapshot_path, load_snapshot
+            snapshot = snapshot_path(config) if snapshot is True else snapshot
+            state = load_snapshot(snapshot, config)
+        if state is not None:
+            self.root:Category = state['root']
+            self.psd_path:str = state['psd_path']
+            self.layer_name_index:dict[str, str] = state['layer_name_index']
+            self.leaf_index:dict[str, tuple[str]] = state['leaf_index']
+            self.z_order:dict[str, int] = state['z_order']
+            self._double_names:dict[str, int] = state['double_names']
+            self.layer_bbox:dict[str, tuple[int, int, int, int]] = state['layer_bbox']
+            self.size:tuple[int, int] = state['size']
+        elif config:
             # 从配置文件初始化
             with open(config, 'r', encoding='utf-8') as f:
                 data:dict = json.load(f)
                 self.root = Category.from_dict(data['root'])
                 path_list = data.get('psd_path')
-                self.psd_path:str = os.path.join(*path_list)
-            self.psd = PSDImage.open(self.psd_path)
-            self.layer_dict:dict[str, PSDImage] = {}
-            self._index_layers(self.psd)
+                # 绝对路径拆分后第一项为空字符串，os.path.join 会丢掉根目录
+                self.psd_path:str = os.sep.join(path_list)
+            self.psd = self._open_psd(self.psd_path)
+            self.layer_dict = {}
+            with tracing.span('index'):
+                self._index_layers(self.psd)
         elif psd_path:
             # 初始化图层数据结构
             self.root = Category('root', 'all')
             self.psd_path = psd_path
-            self.psd = PSDImage.open(psd_path)
+            self.psd = self._open_psd(psd_path)
             
             # 标号所有图层并生成图层字典
-            self.layer_dict:dict[str, PSDImage] = {}
-            self._index_layers(self.psd)
+            self.layer_dict = {}
+            with tracing.span('index'):
+                self._index_layers(self.psd)
         else:
             raise VHError("必须提供 PSD 文件路径或配置文件路径")
         self._check_double_name()
+        if config and snapshot and state is None:
+            # 通过检查后才写快照，重名的配置不会留下快照
+            from snapshot import save_snapshot
+            try:
+                save_snapshot(self, snapshot, config)
+            except OSError as e:
+                tracing.log(f"无法写入快照 {snapshot}: {e}")
+        self._layer_cache:LayerCache|None = None
+        # PSD 修订号，参与完成图缓存的键
+        self.revision = 0
+        self._compositors:dict[str|tuple[str, int], Compositor|NumpyCompositor] = {}
+    def _open_psd(self, psd_path) -> PSDImage|LazyPSD:
+        with tracing.span('open', lazy=self.lazy):
+            if self.lazy:
+                from lazy_psd import LazyPSD
+                return LazyPSD(psd_path)
+            from psd_tools import PSDImage
+            return PSDImage.open(psd_path)
+    @property
+    def psd(self) -> PSDImage|LazyPSD:
+        '''从快照恢复时第一次访问才打开 PSD'''
+        if self._psd is None:
+            self._psd = self._open_psd(self.psd_path)
+        return self._psd
+    @psd.setter
+    def psd(self, value:PSDImage|LazyPSD):
+        self._psd = value
+    @property
+    def layer_dict(self) -> dict[str, PSDImage]:
+        '''图层下标 -> 图层对象。从快照恢复时第一次访问才打开 PSD 并重新标号 (结果与快照一致)'''
+        if self._layer_dict is None:
+            self._layer_dict = {}
+            with tracing.span('index'):
+                self._index_layers(self.psd)
+        return self._layer_dict
+    @layer_dict.setter
+    def layer_dict(self, value:dict[str, PSDImage]):
+        self._layer_dict = value
+    @property
+    def render_cache(self) -> RenderCache:
+        if self._render_cache is None:
+            from renderer import RenderCache
+            self._render_cache = RenderCache(self._render_cache_bytes)
+        return self._render_cache
+    @property
+    def full_psd(self) -> PSDImage:
+        """
+        完整解析的 PSDImage。延迟加载模式下只在回退到 psd_tools 合成时才打开
+        """
+        if not self.lazy:
+            return self.psd
+        if self._full_psd is None:
+            from psd_tools import PSDImage
+            with tracing.span('open', lazy=False):
+                self._full_psd = PSDImage.open(self.psd_path)
+        return self._full_psd
     def save_config(self, output_path = 'vh_config.json'):
         """
         保存 PSD 配置
@@ -191,34 +540,73 @@ class PSDVarianceHandler:
         with open(output_path, 'w') as f:
             json.dump(data, f, indent=2, ensure_ascii=False)
 
-    def _index_layers(self, layer, prefix=''):
+    def _index_layers(self, layer, prefix='') -> list[str]:
         """
-        递归标号所有图层
+        递归标号所有图层，同时建立 名称→下标、下标→叶子图层、下标→z 序 索引。
+        返回该图层下所有叶子图层下标(从上到下)。
         """
+        if not prefix:
+            self.layer_name_index:dict[str, str] = {}
+            self.leaf_index:dict[str, tuple[str]] = {}
+            self.z_order:dict[str, int] = {}
+            self._double_names:dict[str, int] = {}
+            self.layer_bbox:dict[str, tuple[int, int, int, int]] = {}
+            self.size:tuple[int, int] = tuple(layer.size)
         index = prefix[:-1] if prefix else prefix
         if index:
             self.layer_dict[index] = layer
+            self.layer_bbox[index] = tuple(layer.bbox)
+            if layer.name in self.layer_name_index:
+                self._double_names[layer.name] = self._double_names.get(layer.name, 1) + 1
+            else:
+                self.layer_name_index[layer.name] = index
         if layer.is_group():
+            leaves = []
             for i, sublayer in enumerate(reversed(list(layer))):
-                self._index_layers(sublayer, f'{prefix}{i}-')
-    
+                leaves.extend(self._index_layers(sublayer, f'{prefix}{i}-'))
+        else:
+            leaves = [index]
+        if index:
+            self.leaf_index[index] = tuple(leaves)
+        else:
+            # layer_dict 按从上到下排列，反转后即为从下到上的 z 序
+            self.z_order = {idx: z for z, idx in enumerate(reversed(leaves))}
+        return leaves
+
+    def rename_layer(self, layer_idx:str, new_name:str):
+        """
+        修改 PSD 图层名并增量更新名称索引，类别中按旧名引用该图层的条目一并改为新名
+        """
+        self._check_layer_idx_double_name(new_name)
+        with self.lock:
+            layer = self.layer_dict[layer_idx]
+            old_name = layer.name
+            # 旧名与其他图层重名时不是该图层的引用
+            owns_name = self.layer_name_index.get(old_name) == layer_idx
+            if owns_name:
+                del self.layer_name_index[old_name]
+            layer.name = new_name
+            self.layer_name_index[new_name] = layer_idx
+            if owns_name and old_name != new_name:
+                stack = [self.root]
+                while stack:
+                    c = stack.pop()
+                    if old_name in c.layers:
+                        c.layers = [new_name if l == old_name else l for l in c.layers]
+                        c.notify()
+                    stack.extend(c.subcategories)
+            self.invalidate_render_cache()
+
     def _check_layer_idx_double_name(self, name=None):
         """
         检查是否有重名图层
         """
-        names = [layer.name for layer in self.layer_dict.values()]
-
         if name:
-            if name in names:
+            if name in self.layer_name_index:
                 raise VHError(f"图层名重复: {name}")
             return
-        if len(names) != len(set(names)):
-            # 找到重名图层
-            name_count = {}
-            for name in names:
-                name_count[name] = name_count.get(name, 0) + 1
-            double_names = [name for name, count in name_count.items() if count > 1]
-            raise VHError(f"图层名重复: {double_names}")
+        if self._double_names:
+            raise VHError(f"图层名重复: {list(self._double_names.keys())}")
     def _check_equal_level_category_double_name(self, parent_c:Category=None, name=None):
         """
         检查是否有重名的同级类别
@@ -243,71 +631,255 @@ class PSDVarianceHandler:
         """
         获取图层组内所有叶子图层名下标
         """
-        if self.layer_dict[layer_idx].is_group():
-            output = []
-            for i in range(len(self.layer_dict[layer_idx])):
-                output.extend(self.get_all_leaf_layer_name(f"{layer_idx}-{i}"))
-            return output
-        else:
-            return [layer_idx]
+        return list(self.leaf_index[layer_idx])
     
     def parse_layer(self, layers:list) -> list:
         """预处理输入的图层名。如果输入的图层名是一个组，返回组内所有叶子图层名。"""
-        output = []
+        output = set()
         for layer in layers:
-            if layer in self.layer_dict.keys():
-                layer_idx = layer
-                output.extend(self.get_all_leaf_layer_name(layer_idx))
-            elif layer in [x.name for x in self.layer_dict.values()]:
-                for k, v in self.layer_dict.items():
-                    if v.name == layer:
-                        layer_idx = k
-                        break
-                output.extend(self.get_all_leaf_layer_name(layer_idx))
+            if layer in self.leaf_index:
+                output.update(self.leaf_index[layer])
+            elif (layer_idx := self.layer_name_index.get(layer)) is not None:
+                output.update(self.leaf_index[layer_idx])
             else:
                 raise VHError(f"图层 {layer} 不存在")
-        return list(set(output))
+        return list(output)
     
     def copy_psd(self, visible_layer_idxs=None) -> PSDImage:
-        """生成psd文件的复制，并且将所有图层组设为可见，所有叶子图层设为不可见，然后根据输入的图层名列表设置可见图层"""
-        visibel_layer_names = set(self.layer_dict[x].name for x in visible_layer_idxs) if visible_layer_idxs else set()
-        psd = copy.deepcopy(self.psd)
-        def handle_layer(layer):
+        """
+        生成psd文件的复制，并且将所有图层组设为可见，所有叶子图层设为不可见，然后根据输入的图层下标列表设置可见图层。
+        按下标而不是图层名选择：延迟加载时 rename_layer 只修改 LazyLayer，full_psd 中仍是旧名
+        """
+        visible_layer_idxs = set(visible_layer_idxs) if visible_layer_idxs else set()
+        psd = copy.deepcopy(self.full_psd)
+        # 与 _index_layers 相同的标号方式
+        def handle_layer(layer, index):
             if layer.is_group():
                 layer.visible = True
-                for sublayer in layer:
-                    handle_layer(sublayer)
+                for i, sublayer in enumerate(reversed(list(layer))):
+                    handle_layer(sublayer, f'{index}-{i}')
             else:
-                layer.visible = False
-                if layer.name in visibel_layer_names:
-                    layer.visible = True
-        for layer in psd:
-            handle_layer(layer)
+                layer.visible = index in visible_layer_idxs
+        for i, layer in enumerate(reversed(list(psd))):
+            handle_layer(layer, str(i))
         return psd
             
-    def save_png(self, output_path=None) -> Image:
+    @property
+    def layer_cache(self) -> LayerCache:
+        if self._layer_cache is None:
+            from renderer import LayerCache
+            from disk_cache import DiskLayerCache
+            disk_cache = DiskLayerCache(self.cache_dir, self.psd_path) if self.cache_dir else None
+            self._layer_cache = LayerCache(self.psd, self.layer_dict, self.z_order, disk_cache)
+        return self._layer_cache
+
+    def get_compositor(self, backend:str, level:int=0) -> Compositor|NumpyCompositor:
+        """
+        level > 0 时返回在缩小 2**level 倍的图层金字塔上合成的合成器
+        """
+        from renderer import COMPOSITORS
+        if backend not in COMPOSITORS:
+            raise VHError(f"合成后端 {backend} 不使用图层缓存")
+        key = backend if level == 0 else (backend, level)
+        if key not in self._compositors:
+            self._compositors[key] = COMPOSITORS[backend](self.layer_cache.level(level))
+            # 只有 pil 合成器 (普通混合模式，满足结合律) 支持增量合成
+            self._compositors[key].incremental = self.incremental and backend == 'pil'
+        return self._compositors[key]
+
+    @property
+    def compositor(self) -> Compositor|NumpyCompositor:
+        return self.get_compositor(self.backend if self.backend != 'psd_tools' else 'pil')
+
+    def render(self, visible_layer_idxs, backend=None, viewport=None, level=0) -> Image:
+        """
+        合成给定的叶子图层。backend 为 None 时使用 self.backend；
+        'pil'/'numpy' 后端不支持的图层(混合模式、蒙版、剪贴、图层样式等)回退到 copy_psd + composite。
+        viewport (left, top, right, bottom) 不为空时只合成该区域。
+        level > 0 时在缩小 2**level 倍的画布上合成低分辨率预览，viewport 也是缩小后的坐标。
+        'pil'/'numpy' 后端先用 LayerCache.normalize 去掉透明及被完全覆盖的图层。
+        相同的图层集合直接从 render_cache 返回，返回的图像不应原地修改。
+        先按原始图层集合查找缓存，未命中时才归一化，并把原始集合记为归一化结果的别名。
+        """
+        from renderer import RenderCache
+        backend = backend or self.backend
+        visible_layer_idxs = list(visible_layer_idxs) if visible_layer_idxs else []
+        with tracing.span('render', backend=backend, level=level):
+            raw_key = RenderCache.render_key(visible_layer_idxs, self.revision, backend, viewport, level)
+            key = raw_key
+            image = self.render_cache.get(raw_key, record=False)
+            if image is None and backend != 'psd_tools':
+                # 透明或被完全覆盖的图层不参与合成，也让结果相同的图层集合共用缓存
+                visible_layer_idxs = self.layer_cache.normalize(visible_layer_idxs)
+                key = RenderCache.render_key(visible_layer_idxs, self.revision, backend, viewport, level)
+                self.render_cache.alias(raw_key, key)
+                image = self.render_cache.get(key, record=False)
+            if image is not None:
+                self.render_cache.hits += 1
+                tracing.count('render_cache.hit')
+                return image
+            self.render_cache.misses += 1
+            tracing.count('render_cache.miss')
+            image = self._render(visible_layer_idxs, backend, viewport, level)
+            self.render_cache.put(key, image)
+            return image
+
+    def _render(self, visible_layer_idxs, backend, viewport, level=0) -> Image:
+        if backend != 'psd_tools':
+            compositor = self.get_compositor(backend, level)
+            if compositor.supports(visible_layer_idxs):
+                with tracing.span('composite', backend=backend, layers=len(visible_layer_idxs)):
+                    return compositor.composite(visible_layer_idxs, viewport)
+            tracing.count('composite.fallback')
+            tracing.log(f"存在 {backend} 合成器不支持的图层，回退到 psd_tools 合成")
+        with tracing.span('composite', backend='psd_tools', layers=len(visible_layer_idxs)):
+            if level == 0:
+                return self.copy_psd(visible_layer_idxs).composite(viewport=viewport, force=True)
+            # psd_tools 只能全分辨率合成，合成后再缩小
+            from renderer import reduce_image
+            image = reduce_image(self.copy_psd(visible_layer_idxs).composite(force=True), 1 << level)
+            return image.crop(viewport) if viewport is not None else image
+
+    def preview_level(self, max_size:tuple[int, int], max_level:int=3) -> int:
+        """
+        按比例缩放到 max_size 内显示时，不低于显示分辨率的最小金字塔级别
+        """
+        width, height = self.size
+        level = 0
+        while level < max_level and width >> (level + 1) >= max_size[0] and height >> (level + 1) >= max_size[1]:
+            level += 1
+        return level
+
+    def invalidate_render_cache(self):
+        """
+        PSD 内容改变后调用：增加修订号，清空完成图缓存及合成器缓存的部分合成结果
+        """
+        with self.lock:
+            self.revision += 1
+            if self._render_cache is not None:
+                self._render_cache.invalidate()
+            for compositor in self._compositors.values():
+                compositor.reset()
+
+    def get_bbox(self, visible_layer_idxs) -> tuple[int, int, int, int]|None:
+        """
+        给定叶子图层在画布内的像素范围并集，全部为空时返回 None
+        """
+        return self.layer_cache.bbox(visible_layer_idxs)
+
+    def render_bbox(self, visible_layer_idxs, backend=None) -> tuple[Image.Image|None, tuple[int, int, int, int]|None]:
+        """
+        只合成给定图层像素范围的并集，返回 (图像, 范围)。范围为空时返回 (None, None)
+        """
+        bbox = self.get_bbox(visible_layer_idxs)
+        if bbox is None:
+            return None, None
+        return self.render(visible_layer_idxs, backend, viewport=bbox), bbox
+
+    def check_backend(self, backend='numpy', layer_idx_sets=None, tolerance=3.0) -> list[tuple[list[str], float]]:
+        """
+        与 psd_tools 的 composite(force=True) 比较合成结果，返回超出容差的 (图层下标, 最大误差)。
+        误差按 8 位预乘颜色及不透明度计算(psd_tools 自身的取整就有 1 左右的误差)；
+        layer_idx_sets 为 None 时检查每个叶子图层单独可见及全部可见。
+        """
+        from renderer import max_difference
+        if layer_idx_sets is None:
+            leaves = list(self.z_order.keys())
+            layer_idx_sets = [[idx] for idx in leaves] + [leaves]
+        failures = []
+        for layer_idxs in layer_idx_sets:
+            expected = self.copy_psd(layer_idxs).composite(force=True)
+            error = max_difference(self._render(list(layer_idxs), backend, None), expected)
+            if error > tolerance:
+                failures.append((list(layer_idxs), error))
+        return failures
+
+    def save_png(self, output_path=None, backend=None) -> Image:
         """
         保存 PSD 文件为 PNG
         """
         visible_layers_idx = self.get_all_visible_layers(original=True)
-        if DEBUG: print(f"可见图层: {[self.layer_dict[layer_idx].name for layer_idx in visible_layers_idx]}")
-        new_psd = self.copy_psd(visible_layers_idx)
-        image = new_psd.composite(force=True)
+        if tracing.ENABLED:
+            tracing.log(f"可见图层: {[self.layer_dict[layer_idx].name for layer_idx in visible_layers_idx]}")
+        image = self.render(visible_layers_idx, backend)
         if output_path:
             image.save(output_path)
         return image
 
+    def iter_variants(self):
+        """
+        惰性枚举 root 下所有合法的可见性组合
+        """
+        return self.root.iter_variants()
+    def count_variants(self) -> int:
+        """
+        root 下合法可见性组合的数量，不需要枚举
+        """
+        return self.root.count_variants()
+    def unrank_variant(self, k:int):
+        """
+        iter_variants 中的第 k 个差分
+        """
+        return self.root.unrank_variant(k)
+    def sample_variants(self, n:int, seed=None, unique=False, stratified=False):
+        """
+        均匀抽取 n 个差分，可直接传给 render_variants(variants=...)
+        """
+        return self.root.sample_variants(n, seed, unique, stratified)
+    def _category_path(self, target, search_mode:int) -> tuple:
+        result = self.get_Categories(target, search_mode)
+        if search_mode == 0:
+            return tuple(c.name for c in result)
+        # DFS 只返回目标类别本身，再从 root 找出它的路径
+        def find(category:Category, path:tuple):
+            if category is result[0]:
+                return path
+            for sub_c in category.subcategories:
+                if (found := find(sub_c, path + (sub_c.name,))) is not None:
+                    return found
+            return None
+        return find(self.root, ())
+    def query_variants(self, require_categories=(), forbid_categories=(), require_layers=(), forbid_layers=(), search_mode:int=0):
+        """
+        惰性枚举满足约束的差分，不可能满足约束的子树会被剪枝，见 variant_query.VariantQuery
+        类别用 get_Categories 解析 (search_mode 含义相同)，图层用 parse_layer 解析
+        """
+        from variant_query import VariantQuery
+        return VariantQuery(
+            self.root,
+            [self._category_path(x, search_mode) for x in require_categories],
+            [self._category_path(x, search_mode) for x in forbid_categories],
+            require_layers, forbid_layers, self.parse_layer)
+
+    def compile_categories(self):
+        """
+        把当前 root 编译成位集形式 (compiled_category.CompiledCategory)，
+        之后对 root 的修改不会反映到编译结果中，需要重新编译
+        """
+        from compiled_category import CompiledCategory
+        return CompiledCategory(self.root, self.parse_layer)
+
+    def render_variants(self, output_dir:str, name_template:str='{index:05d}.png', **kwargs) -> list[str]:
+        """
+        在进程池中渲染所有差分，见 batch.render_variants
+        """
+        from batch import render_variants
+        return render_variants(self, output_dir, name_template, **kwargs)
+
+    def export_deltas(self, output_dir:str, **kwargs) -> dict:
+        """
+        导出为基础图 + 差异块，见 delta_export.export_deltas，用 delta_export.DeltaReader 还原
+        """
+        from delta_export import export_deltas
+        return export_deltas(self, output_dir, **kwargs)
+
     def get_all_visible_layers(self, original=False):
         """
         根据root返回所有可见图层
         """
-        # visible_layers = set(visible_layers)
-        visible_layers = self.root.get_all_visible_layers()
-        parsed_layer_names = self.parse_layer(visible_layers)
-        for layer_idx in parsed_layer_names:
-            layer = self.layer_dict[layer_idx]
-            if DEBUG: print(f"{layer.name}: 设置图层 {layer_idx}({layer.name}) 可见")
-            visible_layers.add(layer_idx)
+        with tracing.span('resolve'):
+            visible_layers = set(self.parse_layer(self.root.get_all_visible_layers()))
+        tracing.count('resolve.layers', len(visible_layers))
 
         if original:
             return visible_layers
@@ -331,9 +903,9 @@ class PSDVarianceHandler:
                             now.mode = mode
                         else:
                             raise VHError(f"未知的模式: {mode}")
-                    elif now.mode != mode:
-                        if DEBUG: print(f"类别 {c_name} 的模式不匹配: {now.mode} != {mode}")
-                        else: raise VHError(f"类别 {c_name} 的模式不匹配: {now.mode} != {mode}")
+                    elif now.mode != mode and now.mode != 'same':
+                        # 'same' 由下面换成新的模式，不算不匹配
+                        _mode_mismatch(f"类别 {c_name} 的模式不匹配: {now.mode} != {mode}")
                     for sub_c_name in sub_c_names:
                         now.add_sub(sub_c_name)
                     if now.mode == 'same':
@@ -341,9 +913,6 @@ class PSDVarianceHandler:
                             now.mode = mode
                         else:
                             raise VHError(f"未知的模式: {mode}")
-                    elif now.mode != mode:
-                        if DEBUG: print(f"类别 {c_name} 的模式不匹配: {now.mode} != {mode}")
-                        else: raise VHError(f"类别 {c_name} 的模式不匹配: {now.mode} != {mode}")
             else:
                 raise VHError(f"未找到名称为 {c_name} 的子类别: {category_dir_name}")
     def build_category_from_txt(self, txt_path:str):
@@ -0,0 +1,782 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+from psd_tools import PSDImage
+from psd_tools.constants import BlendMode, ColorMode
+
+import tracing
+
+class LayerPixels:
+    '''单个叶子图层解码后的像素及合成参数'''
+    def __init__(self, layer_idx:str, z:int, image:Image.Image|None, left:int, top:int,
+                 opacity:int, blend_mode:BlendMode, supported:bool,
+                 ancestors:tuple[tuple[str, BlendMode, int], ...]=()):
+        self.layer_idx = layer_idx
+        self.z = z
+        self.image = image
+        self.left = left
+        self.top = top
+        self.opacity = opacity
+        self.blend_mode = blend_mode
+        # 像素可以直接使用(无蒙版、剪贴、图层样式)，混合模式由各合成器自行判断
+        self.supported = supported
+        # 需要隔离合成的祖先图层组 (下标, 混合模式, 不透明度)，从外到内
+        self.ancestors = ancestors
+        self._float:tuple[np.ndarray, np.ndarray]|None = None
+        self._half:'LayerPixels|None' = None
+        self._hash:str|None = None
+        self._alpha_range:tuple[int, int]|None = None
+    def __str__(self):
+        return f"LayerPixels({self.layer_idx}, z={self.z}, ({self.left}, {self.top}), {self.blend_mode.name})"
+    @property
+    def bbox(self) -> tuple[int, int, int, int]|None:
+        '''裁剪到画布后的像素范围 (left, top, right, bottom)，无像素时为 None'''
+        if self.image is None:
+            return None
+        return self.left, self.top, self.left + self.image.width, self.top + self.image.height
+    def float_arrays(self) -> tuple[np.ndarray, np.ndarray]:
+        '''返回 (非预乘颜色, 不透明度) 的 float32 数组，第一次调用时生成'''
+        if self._float is None:
+            array = np.asarray(self.image, dtype=np.float32) / 255.0
+            self._float = (array[..., :3], array[..., 3:])
+        return self._float
+    @property
+    def alpha_range(self) -> tuple[int, int]:
+        '''不透明度 (已乘图层不透明度) 的最小值与最大值，无像素时为 (0, 0)'''
+        if self._alpha_range is None:
+            self._alpha_range = self.image.getchannel('A').getextrema() if self.image is not None else (0, 0)
+        return self._alpha_range
+    @property
+    def is_empty(self) -> bool:
+        '''像素可以直接使用且完全透明 (无像素、在画布外或不透明度为 0)'''
+        return self.supported and self.alpha_range[1] == 0
+    @property
+    def is_opaque(self) -> bool:
+        '''以普通模式完全覆盖自身范围：像素全部不透明，且祖先图层组都是普通/穿透模式、不透明度 100%'''
+        if not self.supported or self.image is None or self.blend_mode != BlendMode.NORMAL:
+            return False
+        if any(blend_mode != BlendMode.NORMAL or opacity != 255 for _, blend_mode, opacity in self.ancestors):
+            return False
+        return self.alpha_range[0] == 255
+    @property
+    def content_hash(self) -> str:
+        '''像素与合成参数的哈希，第一次访问时计算。内容与位置相同的图层哈希相同'''
+        if self._hash is None:
+            h = hashlib.sha1()
+            h.update(repr((self.left, self.top, self.blend_mode.name, self.supported,
+                           [(idx, blend_mode.name, opacity) for idx, blend_mode, opacity in self.ancestors])).encode())
+            if not self.supported:
+                # 没有缓存像素的图层只能按下标区分
+                h.update(self.layer_idx.encode())
+            elif self.image is not None:
+                h.update(repr(self.image.size).encode())
+                h.update(self.image.tobytes())
+            self._hash = h.hexdigest()
+        return self._hash
+    def downsampled(self, level:int) -> 'LayerPixels':
+        '''
+        缩小 2**level 倍的图层，坐标也换算到缩小后的画布上。
+        每一级由上一级缩小一半得到并缓存在上一级上，构成逐层减半的金字塔。
+        '''
+        entry = self
+        for _ in range(level):
+            if entry._half is None:
+                entry._half = entry._downsample_half()
+            entry = entry._half
+        return entry
+    def _downsample_half(self) -> 'LayerPixels':
+        image = None
+        if self.image is not None:
+            image = reduce_image(self.image, 2, self.left % 2, self.top % 2)
+        return LayerPixels(self.layer_idx, self.z, image, self.left // 2, self.top // 2, self.opacity,
+                           self.blend_mode, self.supported, self.ancestors)
+
+class LayerFacts:
+    '''normalize/effective_key 用到的图层属性，每个图层只算一次，不随像素缓存清除'''
+    __slots__ = ('is_empty', 'supported', 'is_opaque', 'bbox', 'content_hash')
+    def __init__(self, entry:LayerPixels):
+        self.is_empty = entry.is_empty
+        self.supported = entry.supported
+        self.is_opaque = entry.is_opaque
+        self.bbox = entry.bbox
+        self.content_hash = entry.content_hash
+
+def reduce_image(image:Image.Image, factor:int, dx:int=0, dy:int=0) -> Image.Image:
+    '''
+    在预乘颜色上做 factor x factor 的盒式降采样，(dx, dy) 为图像左上角相对降采样网格的偏移。
+    不足一格的边缘用透明像素补齐，与把图像放在透明画布上再缩小的结果一致。
+    '''
+    width = -(-(image.width + dx) // factor) * factor
+    height = -(-(image.height + dy) // factor) * factor
+    padded = Image.new('RGBa', (width, height), (0, 0, 0, 0))
+    padded.paste(image.convert('RGBA').convert('RGBa'), (dx, dy))
+    return padded.reduce(factor).convert('RGBA')
+
+def intersect_bbox(a:tuple|None, b:tuple|None) -> tuple[int, int, int, int]|None:
+    if a is None or b is None:
+        return None
+    bbox = (max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3]))
+    return bbox if bbox[0] < bbox[2] and bbox[1] < bbox[3] else None
+
+def _contains(outer:tuple, inner:tuple) -> bool:
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and inner[2] <= outer[2] and inner[3] <= outer[3]
+
+class _CoverIndex:
+    '''
+    不透明范围的网格索引，查询一个范围是否被某个已加入的范围完全包含。
+    包含它的范围一定覆盖它的左上角，因此只需检查左上角所在格子里的范围
+    '''
+    def __init__(self, size:tuple[int, int], cells:int=16):
+        self.cell_width = max(1, -(-size[0] // cells))
+        self.cell_height = max(1, -(-size[1] // cells))
+        self._grid:dict[tuple[int, int], list[tuple[int, int, int, int]]] = {}
+    def add(self, bbox:tuple[int, int, int, int]):
+        for x in range(bbox[0] // self.cell_width, (bbox[2] - 1) // self.cell_width + 1):
+            for y in range(bbox[1] // self.cell_height, (bbox[3] - 1) // self.cell_height + 1):
+                self._grid.setdefault((x, y), []).append(bbox)
+    def covers(self, bbox:tuple[int, int, int, int]) -> bool:
+        candidates = self._grid.get((bbox[0] // self.cell_width, bbox[1] // self.cell_height))
+        return candidates is not None and any(_contains(cover, bbox) for cover in candidates)
+
+def union_bbox(bboxes) -> tuple[int, int, int, int]|None:
+    bboxes = [b for b in bboxes if b is not None]
+    if not bboxes:
+        return None
+    return (min(b[0] for b in bboxes), min(b[1] for b in bboxes),
+            max(b[2] for b in bboxes), max(b[3] for b in bboxes))
+
+class LayerCache:
+    '''
+    叶子图层像素缓存。每个图层的像素、偏移及混合参数只在第一次用到时解码一次，
+    之后的合成全部直接读缓存，不再复制 PSD、也不再修改图层的可见性。
+    '''
+    def __init__(self, psd:PSDImage, layer_dict:dict[str, PSDImage], z_order:dict[str, int]|None=None, disk_cache=None):
+        '''disk_cache: 可选的 disk_cache.DiskLayerCache，内存未命中时先读盘，解码后写回'''
+        self.psd = psd
+        self.layer_dict = layer_dict
+        self.disk_cache = disk_cache
+        self.size = psd.size
+        self._entries:dict[str, LayerPixels] = {}
+        self._facts:dict[str, LayerFacts] = {}
+        if z_order is None:
+            # layer_dict 按从上到下的先序遍历排列，反转后的叶子顺序即为从下到上的 z 序
+            leaf_idxs = [idx for idx, layer in layer_dict.items() if not layer.is_group()]
+            z_order = {idx: z for z, idx in enumerate(reversed(leaf_idxs))}
+        self.z_order:dict[str, int] = z_order
+        self.document_supported = psd.color_mode == ColorMode.RGB and psd.depth == 8
+    def __len__(self):
+        return len(self._entries)
+    def __contains__(self, layer_idx):
+        return layer_idx in self._entries
+    def clear(self):
+        self._entries.clear()
+
+    def _ancestors(self, layer_idx:str) -> list[str]:
+        parts = layer_idx.split('-')
+        return ['-'.join(parts[:i]) for i in range(1, len(parts))]
+
+    def _is_supported(self, layer_idx:str) -> bool:
+        '''直接合成器只处理无蒙版/剪贴/图层样式的像素图层'''
+        layer = self.layer_dict[layer_idx]
+        if not self.document_supported or not layer.has_pixels():
+            return False
+        if layer.clipping or layer.has_clip_layers() or layer.has_mask() or layer.has_effects():
+            return False
+        for group_idx in self._ancestors(layer_idx):
+            group = self.layer_dict[group_idx]
+            if group.has_mask() or group.has_effects():
+                return False
+        return True
+
+    def _decode(self, layer_idx:str) -> LayerPixels:
+        layer = self.layer_dict[layer_idx]
+        if layer.is_group():
+            raise ValueError(f"图层 {layer_idx}({layer.name}) 是图层组，无法缓存像素")
+        z = self.z_order[layer_idx]
+        supported = self._is_supported(layer_idx)
+        opacity = layer.opacity * layer.fill_opacity // 255 if supported else layer.opacity
+        ancestors = []
+        for group_idx in self._ancestors(layer_idx):
+            group = self.layer_dict[group_idx]
+            if group.opacity != 255 or group.blend_mode != BlendMode.PASS_THROUGH:
+                ancestors.append((group_idx, group.blend_mode, group.opacity))
+        image = None
+        left, top = layer.left, layer.top
+        if supported and layer.width > 0 and layer.height > 0:
+            image = layer.topil()
+            if image is not None:
+                image = image.convert('RGBA')
+                # 裁剪到画布范围内
+                box = (max(0, -left), max(0, -top),
+                       min(image.width, self.size[0] - left), min(image.height, self.size[1] - top))
+                if box[0] >= box[2] or box[1] >= box[3]:
+                    image = None
+                else:
+                    if box != (0, 0) + image.size:
+                        image = image.crop(box)
+                    left, top = left + box[0], top + box[1]
+                    if opacity < 255:
+                        alpha = image.getchannel('A').point(lambda a: a * opacity // 255)
+                        image.putalpha(alpha)
+        return LayerPixels(layer_idx, z, image, left, top, opacity, layer.blend_mode, supported, tuple(ancestors))
+
+    def get(self, layer_idx:str) -> LayerPixels:
+        if (entry := self._entries.get(layer_idx)) is None:
+            with tracing.span('decode', layer=layer_idx):
+                if self.disk_cache is not None:
+                    layer = self.layer_dict[layer_idx]
+                    if (entry := self.disk_cache.load(layer_idx, layer, self.z_order[layer_idx])) is None:
+                        entry = self._decode(layer_idx)
+                        self.disk_cache.save(entry, layer)
+                    else:
+                        tracing.count('disk_cache.hit')
+                else:
+                    entry = self._decode(layer_idx)
+            self._entries[layer_idx] = entry
+        return entry
+
+    def facts(self, layer_idx:str) -> LayerFacts:
+        '''图层的透明/不透明/范围/内容哈希，第一次调用时解码图层并记住'''
+        if (facts := self._facts.get(layer_idx)) is None:
+            facts = self._facts[layer_idx] = LayerFacts(self.get(layer_idx))
+        return facts
+
+    def add_facts(self, facts:dict[str, LayerFacts]):
+        '''加入在其他进程中算好的图层属性 (见 batch.prime_layer_facts)，之后 normalize/effective_key 不再解码这些图层'''
+        self._facts.update(facts)
+    def missing_facts(self) -> list[str]:
+        '''还没有 LayerFacts 的叶子图层下标'''
+        return [idx for idx in self.z_order if idx not in self._facts]
+
+    def bbox(self, layer_idxs) -> tuple[int, int, int, int]|None:
+        '''给定叶子图层像素范围的并集，全部为空时返回 None'''
+        bboxes = []
+        canvas = (0, 0) + self.size
+        for idx in layer_idxs:
+            entry = self.get(idx)
+            # 不支持的图层没有缓存像素，按图层记录的范围估计
+            bboxes.append(entry.bbox if entry.supported else intersect_bbox(tuple(self.layer_dict[idx].bbox), canvas))
+        return union_bbox(bboxes)
+
+    def sort(self, layer_idxs) -> list[str]:
+        '''去重并按 z 序从下到上排列图层下标'''
+        return sorted(set(layer_idxs), key=self.z_order.__getitem__)
+
+    def normalize(self, layer_idxs) -> list[str]:
+        '''
+        去掉对结果没有影响的图层，按 z 序返回：完全透明的图层，以及范围被上方某个完全不透明的普通图层覆盖的图层。
+        有蒙版、图层样式等不支持属性的图层范围不可靠，始终保留。
+        '''
+        output = []
+        # 从上到下扫描，已扫描的不透明图层范围放进网格索引，每个图层只检查少数候选范围
+        covers = _CoverIndex(self.size)
+        facts = self._facts
+        for idx in reversed(self.sort(layer_idxs)):
+            entry = facts.get(idx) or self.facts(idx)
+            if entry.is_empty:
+                continue
+            if entry.supported and covers.covers(entry.bbox):
+                continue
+            if entry.is_opaque:
+                covers.add(entry.bbox)
+            output.append(idx)
+        output.reverse()
+        return output
+
+    def effective_key(self, layer_idxs) -> tuple[str, ...]:
+        '''归一化后图层的内容哈希，键相同的图层集合合成结果相同'''
+        return tuple(self._facts[idx].content_hash for idx in self.normalize(layer_idxs))
+
+    def level(self, level:int) -> 'LayerCache|LevelCache':
+        '''第 level 级降采样视图，0 为自身'''
+        return self if level == 0 else LevelCache(self, level)
+
+class LevelCache:
+    '''
+    LayerCache 的降采样视图，像素与坐标都缩小 2**level 倍，画布大小向上取整。
+    提供合成器用到的 get/sort/size，可以直接交给 Compositor 或 NumpyCompositor。
+    '''
+    def __init__(self, base:LayerCache, level:int):
+        self.base = base
+        self.level = level
+        factor = 1 << level
+        self.size = (-(-base.size[0] // factor), -(-base.size[1] // factor))
+        self.z_order = base.z_order
+    def get(self, layer_idx:str) -> LayerPixels:
+        return self.base.get(layer_idx).downsampled(self.level)
+    def sort(self, layer_idxs) -> list[str]:
+        return self.base.sort(layer_idxs)
+
+class _PrefixNode:
+    __slots__ = ('layer_idx', 'parent', 'depth', 'children', 'image')
+    def __init__(self, layer_idx:str|None, parent:'_PrefixNode|None'):
+        self.layer_idx = layer_idx
+        self.parent = parent
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.children:dict[str, '_PrefixNode'] = {}
+        self.image:Image.Image|None = None
+
+class PrefixCache:
+    '''
+    按 z 序前缀共享的部分合成结果缓存。
+    同一类别树产生的差分通常共享大部分底层图层，只在上层有少量差异；
+    把前缀的合成结果挂在字典树上，新的差分只需从最长的已缓存前缀开始继续混合。
+    每保存一个前缀就要复制一张整画布，因此只在分叉点 (新差分离开已有路径的位置) 与每 interval 个图层保存，
+    其余前缀只记录路径。缓存按画布张数 max_entries 以 LRU 淘汰，路径节点超过 max_nodes 时删去没有缓存内容的分支。
+    '''
+    # 能容纳的画布少于该数时，缓存内容在被复用之前就会被淘汰
+    MIN_ENTRIES = 8
+    def __init__(self, max_entries:int=32, interval:int=8, max_nodes:int=65536):
+        self.max_entries = max_entries
+        self.interval = interval
+        self.max_nodes = max_nodes
+        self.hits = 0
+        self.misses = 0
+        self._nodes = 0
+        self._root = _PrefixNode(None, None)
+        self._lru:OrderedDict[_PrefixNode, None] = OrderedDict()
+    @classmethod
+    def for_budget(cls, max_bytes:int, size:tuple[int, int], interval:int=8) -> 'PrefixCache|None':
+        '''按字节预算换算成 size 大小 RGBA 画布的张数；少于 MIN_ENTRIES 张时返回 None，即不缓存'''
+        max_entries = max_bytes // max(1, size[0] * size[1] * 4)
+        if max_entries < cls.MIN_ENTRIES:
+            return None
+        return cls(max_entries, interval)
+    def __len__(self):
+        return len(self._lru)
+    def clear(self):
+        self._root = _PrefixNode(None, None)
+        self._lru.clear()
+        self._nodes = 0
+
+    def lookup(self, ordered_idxs:list[str]) -> tuple[int, _PrefixNode, int]:
+        '''返回 (最长已缓存前缀的长度, 其节点 (未命中时为根节点), 与已有路径相同的前缀长度即分叉点)'''
+        if self._nodes > self.max_nodes:
+            self._prune(self._root)
+        node = self._root
+        best_len, best_node = 0, self._root
+        depth = 0
+        for i, idx in enumerate(ordered_idxs):
+            node = node.children.get(idx)
+            if node is None:
+                break
+            depth = i + 1
+            if node.image is not None:
+                best_len, best_node = i + 1, node
+        if best_len == 0:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._lru.move_to_end(best_node)
+        return best_len, best_node, depth
+
+    def wants(self, depth:int, branch:int) -> bool:
+        '''长度为 depth 的前缀是否值得保存：分叉点或 interval 的整数倍'''
+        return depth == branch or depth % self.interval == 0
+
+    def extend(self, node:_PrefixNode, layer_idx:str, image:Image.Image|None) -> _PrefixNode:
+        '''
+        记录 node 对应的前缀再叠加 layer_idx 之后的前缀，返回新前缀的节点。
+        image 不为空时缓存该前缀的合成结果 (复制一份)
+        '''
+        if (child := node.children.get(layer_idx)) is None:
+            child = _PrefixNode(layer_idx, node)
+            node.children[layer_idx] = child
+            self._nodes += 1
+        if child.image is not None:
+            self._lru.move_to_end(child)
+        elif image is not None:
+            child.image = image.copy()
+            self._lru[child] = None
+            while len(self._lru) > self.max_entries:
+                self._evict(self._lru.popitem(last=False)[0])
+        return child
+
+    def _evict(self, node:_PrefixNode):
+        node.image = None
+        # 删除不再有缓存内容的叶子节点
+        while node.parent is not None and node.image is None and len(node.children) == 0:
+            del node.parent.children[node.layer_idx]
+            self._nodes -= 1
+            node = node.parent
+
+    def _prune(self, node:_PrefixNode) -> bool:
+        '''删去 node 之下没有缓存内容的分支，返回 node 的子树是否仍有缓存内容'''
+        keep = node.image is not None
+        for idx, child in list(node.children.items()):
+            if self._prune(child):
+                keep = True
+            else:
+                del node.children[idx]
+                self._nodes -= 1
+        return keep
+
+class _Split:
+    '''增量合成的状态：图层集合、变化的 z 序区间 [lo, hi]、区间之下与之上图层的合成结果及完成图'''
+    __slots__ = ('layers', 'lo', 'hi', 'below', 'above', 'image')
+    def __init__(self, layers:frozenset, lo:int|None, hi:int|None,
+                 below:Image.Image|None, above:Image.Image|None, image:Image.Image):
+        self.layers = layers
+        self.lo = lo
+        self.hi = hi
+        self.below = below
+        self.above = above
+        self.image = image
+
+class Compositor:
+    '''
+    直接从 LayerCache 合成可见图层集合，可选地使用 PrefixCache 共享前缀。
+    incremental 为 True 时记住上一次整张画布的合成，图层集合只有少量变化时增量合成 (见 _composite_incremental)
+    '''
+    # 增量合成的区间最多包含的可见图层数，见 _composite_incremental
+    MAX_SPAN = 32
+    def __init__(self, cache:LayerCache|LevelCache, prefix_cache:PrefixCache|None=None, incremental:bool=False):
+        self.cache = cache
+        self.size = cache.size
+        self.prefix_cache = prefix_cache
+        self.incremental = incremental
+        self._split:_Split|None = None
+
+    def reset(self):
+        '''图层像素改变后调用，丢弃缓存的部分合成结果'''
+        self._split = None
+        if self.prefix_cache is not None:
+            self.prefix_cache.clear()
+
+    def supports(self, layer_idxs) -> bool:
+        '''只支持普通混合模式，且祖先图层组均为普通/穿透模式、不透明度 100%'''
+        for idx in layer_idxs:
+            entry = self.cache.get(idx)
+            if not entry.supported or entry.blend_mode != BlendMode.NORMAL:
+                return False
+            if any(blend_mode != BlendMode.NORMAL or opacity != 255 for _, blend_mode, opacity in entry.ancestors):
+                return False
+        return True
+
+    def composite(self, layer_idxs, viewport:tuple[int, int, int, int]|None=None) -> Image.Image:
+        '''
+        合成给定的叶子图层下标集合，结果与 copy_psd(...).composite(force=True) 一致
+        (普通混合模式图层，预乘颜色上只有少量 8 位舍入误差)。
+        每个图层只混合它自己的范围；给出 viewport (left, top, right, bottom) 时只合成该区域。
+        '''
+        ordered = self.cache.sort(layer_idxs)
+        full = (0, 0) + self.size
+        viewport = full if viewport is None else viewport
+        if self.incremental and viewport == full:
+            return self._composite_incremental(ordered)
+        return self._composite(ordered, viewport)
+
+    def _composite(self, ordered:list[str], viewport:tuple[int, int, int, int]) -> Image.Image:
+        start, node, branch = 0, None, 0
+        # 前缀缓存只保存整张画布
+        if self.prefix_cache is not None and viewport == (0, 0) + self.size:
+            start, node, branch = self.prefix_cache.lookup(ordered)
+            tracing.count('prefix_cache.reused_layers', start)
+        if node is not None and node.image is not None:
+            canvas = node.image.copy()
+        else:
+            canvas = Image.new('RGBA', (viewport[2] - viewport[0], viewport[3] - viewport[1]), (0, 0, 0, 0))
+        return self._blend(canvas, ordered[start:], viewport, node, branch)
+
+    def _blend(self, canvas:Image.Image, ordered:list[str], window:tuple[int, int, int, int],
+               node:_PrefixNode|None=None, branch:int=0) -> Image.Image:
+        '''
+        把图层依次混合到 canvas 上，canvas 对应画布上的 window 区域。
+        node 不为空时沿前缀缓存的路径记录每个前缀，并在分叉点 branch 与固定间隔处保存合成结果
+        '''
+        blended = pixels = 0
+        for idx in ordered:
+            entry = self.cache.get(idx)
+            if not entry.supported or entry.blend_mode != BlendMode.NORMAL:
+                raise ValueError(f"图层 {idx} 含有直接合成器不支持的属性")
+            if (box := intersect_bbox(entry.bbox, window)) is not None:
+                source = (box[0] - entry.left, box[1] - entry.top, box[2] - entry.left, box[3] - entry.top)
+                canvas.alpha_composite(entry.image, dest=(box[0] - window[0], box[1] - window[1]), source=source)
+                if tracing.ENABLED:
+                    blended += 1
+                    pixels += (box[2] - box[0]) * (box[3] - box[1])
+            if node is not None:
+                store = self.prefix_cache.wants(node.depth + 1, branch)
+                node = self.prefix_cache.extend(node, idx, canvas if store else None)
+        tracing.count('layers_blended', blended)
+        tracing.count('pixels_touched', pixels)
+        return canvas
+
+    def _composite_incremental(self, ordered:list[str]) -> Image.Image:
+        '''
+        增量合成整张画布。新旧图层集合的差异落在 z 序区间 [lo, hi] 内时，区间之下的图层合成为 below，
+        区间之上的图层在透明画布上预先合并为 above；之后区间内的切换只在变化图层的范围内
+        重新混合区间内的图层并叠加一次 above，耗时与图层总数无关。
+        差异超出当前区间时重建 below/above (相当于一次完整合成)，第一次切换也是如此；
+        与当前区间合并后区间内的可见图层不超过 MAX_SPAN 个时使用合并的区间，附近图层交替切换时不必反复重建。
+        普通混合模式满足结合律，但 above 预先合并后与逐层合成相比有少量 8 位舍入误差。
+        额外占用两张画布大小的内存。
+        '''
+        full = (0, 0) + self.size
+        layers = frozenset(ordered)
+        split = self._split
+        if split is None:
+            image = self._composite(ordered, full)
+            self._split = _Split(layers, None, None, None, None, image)
+            return image
+        changed = layers ^ split.layers
+        if not changed:
+            return split.image
+        z_order = self.cache.z_order
+        lo = min(z_order[idx] for idx in changed)
+        hi = max(z_order[idx] for idx in changed)
+        if split.lo is not None and split.lo <= lo and hi <= split.hi:
+            tracing.count('incremental.reused')
+            lo, hi, below, above = split.lo, split.hi, split.below, split.above
+            # 区间外的图层没有变化，只有变化图层范围内的像素可能改变
+            dirty = intersect_bbox(union_bbox(self.cache.get(idx).bbox for idx in changed), full)
+        else:
+            tracing.count('incremental.rebuilt')
+            if split.lo is not None:
+                span_lo, span_hi = min(lo, split.lo), max(hi, split.hi)
+                if sum(1 for idx in ordered if span_lo <= z_order[idx] <= span_hi) <= self.MAX_SPAN:
+                    lo, hi = span_lo, span_hi
+            below = self._composite([idx for idx in ordered if z_order[idx] < lo], full)
+            above = Image.new('RGBA', self.size, (0, 0, 0, 0))
+            self._blend(above, [idx for idx in ordered if z_order[idx] > hi], full)
+            dirty = full
+        if dirty is None:
+            # 变化的图层都是空图层
+            image = split.image
+        else:
+            region = below.crop(dirty)
+            self._blend(region, [idx for idx in ordered if lo <= z_order[idx] <= hi], dirty)
+            region.alpha_composite(above, source=dirty)
+            if dirty == full:
+                image = region
+            else:
+                # 返回的图像可能被调用方缓存，不原地修改上一次的结果
+                image = split.image.copy()
+                image.paste(region, dirty[:2])
+        self._split = _Split(layers, lo, hi, below, above, image)
+        return image
+
+class RenderCache:
+    '''
+    完成图的 LRU 缓存，按字节预算淘汰。键由 render_key 生成，
+    取出的图像是缓存中的对象本身，调用方不应原地修改。
+    '''
+    def __init__(self, max_bytes:int=128 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._images:OrderedDict[tuple, Image.Image] = OrderedDict()
+        # 别名键 -> 缓存中的键，见 alias
+        self._aliases:OrderedDict[tuple, tuple] = OrderedDict()
+    # 别名只是两个键，按条数限制
+    MAX_ALIASES = 4096
+    def __len__(self):
+        return len(self._images)
+    def __contains__(self, key):
+        return key in self._images
+
+    @staticmethod
+    def render_key(layer_idxs, revision:int=0, backend:str='pil', viewport:tuple|None=None, level:int=0) -> tuple:
+        '''规范化的键：去重排序后的叶子图层下标，加上 PSD 修订号、后端、视口与降采样级别'''
+        return (revision, backend, viewport, level, tuple(sorted(set(layer_idxs))))
+
+    def get(self, key:tuple, record:bool=True) -> Image.Image|None:
+        '''取出 key 或其别名指向的图像。record 为 False 时不计入命中/未命中次数'''
+        if key not in self._images and (target := self._aliases.get(key)) is not None:
+            self._aliases.move_to_end(key)
+            key = target
+        image = self._images.get(key)
+        if image is None:
+            if record:
+                self.misses += 1
+            return None
+        if record:
+            self.hits += 1
+        self._images.move_to_end(key)
+        return image
+
+    def alias(self, key:tuple, target:tuple):
+        '''之后用 key 查找时返回 target 的图像 (如未归一化的图层集合指向归一化后的键)'''
+        if key == target:
+            return
+        self._aliases[key] = target
+        self._aliases.move_to_end(key)
+        while len(self._aliases) > self.MAX_ALIASES:
+            self._aliases.popitem(last=False)
+
+    def put(self, key:tuple, image:Image.Image):
+        nbytes = image.width * image.height * len(image.getbands())
+        if nbytes > self.max_bytes:
+            return
+        if (old := self._images.pop(key, None)) is not None:
+            self.nbytes -= old.width * old.height * len(old.getbands())
+        self._images[key] = image
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._images.popitem(last=False)
+            self.nbytes -= evicted.width * evicted.height * len(evicted.getbands())
+
+    def invalidate(self, predicate=None):
+        '''清空缓存；给出 predicate(key) 时只删除满足条件的条目'''
+        if predicate is None:
+            self._images.clear()
+            self._aliases.clear()
+            self.nbytes = 0
+            return
+        for key in [key for key in self._images if predicate(key)]:
+            image = self._images.pop(key)
+            self.nbytes -= image.width * image.height * len(image.getbands())
+        for key in [key for key in self._aliases if predicate(key)]:
+            del self._aliases[key]
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._images), 'bytes': self.nbytes}
+
+def _hard_light(Cb, Cs):
+    return np.where(Cs <= 0.5, Cb * 2.0 * Cs, 1.0 - 2.0 * (1.0 - Cb) * (1.0 - Cs))
+
+# 可分离混合函数，参数为非预乘的背景色 Cb 与源色 Cs
+BLEND_FUNCS = {
+    BlendMode.NORMAL: lambda Cb, Cs: Cs,
+    BlendMode.MULTIPLY: lambda Cb, Cs: Cb * Cs,
+    BlendMode.SCREEN: lambda Cb, Cs: Cb + Cs - Cb * Cs,
+    BlendMode.OVERLAY: lambda Cb, Cs: _hard_light(Cs, Cb),
+    BlendMode.HARD_LIGHT: _hard_light,
+    BlendMode.DARKEN: np.minimum,
+    BlendMode.LIGHTEN: np.maximum,
+    BlendMode.LINEAR_DODGE: lambda Cb, Cs: np.minimum(Cb + Cs, 1.0),
+    BlendMode.LINEAR_BURN: lambda Cb, Cs: np.maximum(Cb + Cs - 1.0, 0.0),
+    BlendMode.DIFFERENCE: lambda Cb, Cs: np.abs(Cb - Cs),
+}
+
+class _Group:
+    __slots__ = ('blend_mode', 'opacity', 'children', 'bbox')
+    def __init__(self, blend_mode:BlendMode, opacity:int):
+        self.blend_mode = blend_mode
+        self.opacity = opacity
+        self.children:list['_Group|LayerPixels'] = []
+        self.bbox:tuple[int, int, int, int]|None = None
+
+class NumpyCompositor:
+    '''
+    基于 NumPy 的合成后端。画布以预乘 float32 RGBA 保存，普通图层做预乘 "over"，
+    其他常用混合模式 (BLEND_FUNCS) 按 W3C 可分离混合公式向量化计算，只处理图层所在区域。
+    非穿透或不透明度不足 100% 的图层组先隔离合成再整体混合；穿透组按不透明度与背景插值。
+    '''
+    def __init__(self, cache:LayerCache|LevelCache):
+        self.cache = cache
+        self.size = cache.size
+        self.prefix_cache = None
+
+    def reset(self):
+        pass
+
+    def supports(self, layer_idxs) -> bool:
+        for idx in layer_idxs:
+            entry = self.cache.get(idx)
+            if not entry.supported or entry.blend_mode not in BLEND_FUNCS:
+                return False
+            for _, blend_mode, _ in entry.ancestors:
+                if blend_mode != BlendMode.PASS_THROUGH and blend_mode not in BLEND_FUNCS:
+                    return False
+        return True
+
+    def _build_tree(self, ordered:list[str]) -> _Group:
+        '''按 z 序把叶子图层挂到需要隔离的祖先图层组下，同一组的叶子在 z 序上连续'''
+        root = _Group(BlendMode.PASS_THROUGH, 255)
+        stack:list[tuple[str|None, _Group]] = [(None, root)]
+        for idx in ordered:
+            entry = self.cache.get(idx)
+            chain = entry.ancestors
+            depth = 0
+            while depth < len(chain) and depth + 1 < len(stack) and stack[depth + 1][0] == chain[depth][0]:
+                depth += 1
+            del stack[depth + 1:]
+            for group_idx, blend_mode, opacity in chain[depth:]:
+                group = _Group(blend_mode, opacity)
+                stack[-1][1].children.append(group)
+                stack.append((group_idx, group))
+            stack[-1][1].children.append(entry)
+            for _, group in stack:
+                group.bbox = union_bbox((group.bbox, entry.bbox))
+        return root
+
+    @staticmethod
+    def _blend(color:np.ndarray, alpha:np.ndarray, Cs:np.ndarray, As:np.ndarray, blend_mode:BlendMode):
+        '''把非预乘源 (Cs, As) 以 blend_mode 混合到预乘画布区域 (color, alpha) 上，原地修改'''
+        if blend_mode == BlendMode.NORMAL:
+            color *= 1.0 - As
+            color += Cs * As
+        else:
+            Cb = np.divide(color, alpha, out=np.zeros_like(color), where=alpha > 0)
+            blended = np.clip(BLEND_FUNCS[blend_mode](Cb, Cs), 0.0, 1.0)
+            color *= 1.0 - As
+            color += As * ((1.0 - alpha) * Cs + alpha * blended)
+        alpha += As * (1.0 - alpha)
+
+    def _composite_group(self, group:_Group, color:np.ndarray, alpha:np.ndarray, origin:tuple[int, int]):
+        '''color/alpha 是画布上以 origin 为左上角的区域，每个子节点只处理与该区域相交的部分'''
+        ox, oy = origin
+        area = (ox, oy, ox + alpha.shape[1], oy + alpha.shape[0])
+        for child in group.children:
+            if (box := intersect_bbox(child.bbox, area)) is None:
+                continue
+            region = (slice(box[1] - oy, box[3] - oy), slice(box[0] - ox, box[2] - ox))
+            if isinstance(child, LayerPixels):
+                Cs, As = child.float_arrays()
+                source = (slice(box[1] - child.top, box[3] - child.top), slice(box[0] - child.left, box[2] - child.left))
+                self._blend(color[region], alpha[region], Cs[source], As[source], child.blend_mode)
+                if tracing.ENABLED:
+                    tracing.count('layers_blended')
+                    tracing.count('pixels_touched', (box[2] - box[0]) * (box[3] - box[1]))
+            elif child.blend_mode == BlendMode.PASS_THROUGH:
+                # 穿透组直接在背景上合成，再按不透明度与原背景插值；组范围外背景不变
+                sub_color, sub_alpha = color[region], alpha[region]
+                backdrop = (sub_color.copy(), sub_alpha.copy())
+                self._composite_group(child, sub_color, sub_alpha, box[:2])
+                t = child.opacity / 255.0
+                sub_color *= t
+                sub_color += backdrop[0] * (1.0 - t)
+                sub_alpha *= t
+                sub_alpha += backdrop[1] * (1.0 - t)
+            else:
+                height, width = box[3] - box[1], box[2] - box[0]
+                sub_color = np.zeros((height, width, 3), dtype=np.float32)
+                sub_alpha = np.zeros((height, width, 1), dtype=np.float32)
+                self._composite_group(child, sub_color, sub_alpha, box[:2])
+                As = sub_alpha * (child.opacity / 255.0)
+                Cs = np.divide(sub_color, sub_alpha, out=np.zeros_like(sub_color), where=sub_alpha > 0)
+                self._blend(color[region], alpha[region], Cs, As, child.blend_mode)
+
+    def composite(self, layer_idxs, viewport:tuple[int, int, int, int]|None=None) -> Image.Image:
+        ordered = self.cache.sort(layer_idxs)
+        for idx in ordered:
+            entry = self.cache.get(idx)
+            if not entry.supported or entry.blend_mode not in BLEND_FUNCS:
+                raise ValueError(f"图层 {idx} 含有 NumPy 合成器不支持的属性")
+        viewport = (0, 0) + self.size if viewport is None else viewport
+        width, height = viewport[2] - viewport[0], viewport[3] - viewport[1]
+        color = np.zeros((height, width, 3), dtype=np.float32)
+        alpha = np.zeros((height, width, 1), dtype=np.float32)
+        self._composite_group(self._build_tree(ordered), color, alpha, viewport[:2])
+        color = np.divide(color, alpha, out=np.zeros_like(color), where=alpha > 0)
+        rgba = np.concatenate([color, alpha], axis=2)
+        return Image.fromarray(np.round(np.clip(rgba, 0.0, 1.0) * 255.0).astype(np.uint8), 'RGBA')
+
+COMPOSITORS = {
+    'pil': Compositor,
+    'numpy': NumpyCompositor,
+}
+
+def max_difference(image:Image.Image, expected:Image.Image) -> float:
+    '''两张图在 8 位预乘颜色与不透明度上的最大差值，完全透明像素的颜色不参与比较'''
+    a = np.asarray(image.convert('RGBA'), dtype=np.float32)
+    b = np.asarray(expected.convert('RGBA'), dtype=np.float32)
+    if a.shape != b.shape:
+        return float('inf')
+    a[..., :3] *= a[..., 3:] / 255.0
+    b[..., :3] *= b[..., 3:] / 255.0
+    return float(np.abs(a - b).max()) if a.size else 0.0
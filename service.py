@@ -0,0 +1,383 @@
+'''
+常驻的本地渲染服务，PSD 只打开、索引一次，之后的请求复用已经解码的图层与缓存。
+
+    python service.py vh_config.json [more.json ...] [--port 8765 | --unix /tmp/vh.sock]
+
+只监听本机 (127.0.0.1 / ::1) 或 Unix 套接字。请求与响应都是 JSON，渲染结果直接返回编码后的图像：
+
+    GET  /handlers              已加载的配置
+    GET  /metrics               请求统计与 tracing.Aggregator 的汇总 (开启时)
+    POST /render     {"handler", "layers" | "variant" | 无, "visible", "backend", "level", "viewport", "format"}
+    POST /toggle     {"handler", "target", "parents"}    同 api.reverse_visibility
+    POST /enumerate  {"handler", "offset", "limit", "sample", "seed", "require_categories", ...}
+
+handler 为配置名 (文件名去掉扩展名)，只加载了一个配置时可以省略。
+同时到达的相同渲染请求只渲染一次；合成、编码、差分枚举与类别树的读写都在线程池中进行，事件循环不会被阻塞。
+'''
+import argparse, asyncio, ipaddress, itertools, json, os, threading
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+import psd_handler
+from psd_handler import PSDVarianceHandler, VHError
+from api import NotAllowedError, reverse_visibility, get_specific_layer_idxs
+from encoders import Encoder
+import tracing
+
+MAX_BODY = 1024 * 1024
+CONTENT_TYPES = {'png': 'image/png', 'webp': 'image/webp', 'raw': 'application/octet-stream', 'qoi': 'image/qoi'}
+
+class HTTPError(Exception):
+    def __init__(self, status:HTTPStatus, message:str):
+        super().__init__(message)
+        self.status = status
+
+def _error(status:HTTPStatus, message:str) -> tuple[HTTPStatus, bytes, str]:
+    return status, json.dumps({'error': message}, ensure_ascii=False).encode(), 'application/json'
+
+class _Entry:
+    '''
+    一个常驻的 PSDVarianceHandler。handler 的缓存与类别树都不是线程安全的，
+    工作线程中的渲染、枚举、toggle 都持有 lock，compiled() 也只在持有 lock 时调用
+    '''
+    def __init__(self, name:str, config:str, vh:PSDVarianceHandler):
+        self.name = name
+        self.config = config
+        self.vh = vh
+        self.lock = threading.Lock()
+        # 类别树每次被 toggle 修改后加一，编译结果按它失效
+        self.generation = 0
+        self._compiled = None
+        self._compiled_generation = -1
+    def compiled(self):
+        if self._compiled_generation != self.generation:
+            self._compiled = self.vh.compile_categories()
+            self._compiled_generation = self.generation
+        return self._compiled
+
+class RenderService:
+    '''
+    configs: {配置名: vh_config.json 路径}，handler 在第一次被请求时加载并常驻。
+    max_workers: 渲染/编码线程数
+    '''
+    def __init__(self, configs:dict[str, str], max_workers:int|None=None, lazy:bool=False,
+                 cache_dir:str|None=None, backend:str='pil'):
+        if not configs:
+            raise VHError("至少需要一个配置文件")
+        self.configs = dict(configs)
+        self.lazy = lazy
+        self.cache_dir = cache_dir
+        self.backend = backend
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='vh-render')
+        self._entries:dict[str, _Entry] = {}
+        self._loading:dict[str, asyncio.Future] = {}
+        self._inflight:dict[tuple, asyncio.Future] = {}
+        # 统计：实际渲染次数与被合并的请求数
+        self.rendered = 0
+        self.coalesced = 0
+        self._server:asyncio.AbstractServer|None = None
+        self._connections:dict[asyncio.StreamWriter, asyncio.Task] = {}
+        self.routes = {
+            ('GET', '/handlers'): self.handle_handlers,
+            ('GET', '/metrics'): self.handle_metrics,
+            ('POST', '/render'): self.handle_render,
+            ('POST', '/toggle'): self.handle_toggle,
+            ('POST', '/enumerate'): self.handle_enumerate,
+        }
+
+    ### handler ###
+    async def entry(self, name:str|None) -> _Entry:
+        if name is None:
+            if len(self.configs) != 1:
+                raise HTTPError(HTTPStatus.BAD_REQUEST, f"需要指定 handler: {', '.join(self.configs)}")
+            name = next(iter(self.configs))
+        if name not in self.configs:
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"未知的 handler: {name}")
+        if (entry := self._entries.get(name)) is not None:
+            return entry
+        # 打开 PSD 较慢，放到线程池；同时到达的请求等待同一次加载
+        if (future := self._loading.get(name)) is None:
+            loop = asyncio.get_running_loop()
+            future = self._loading[name] = loop.run_in_executor(self.executor, self._load, name)
+        try:
+            entry = await asyncio.shield(future)
+        finally:
+            self._loading.pop(name, None)
+        self._entries[name] = entry
+        return entry
+    def _load(self, name:str) -> _Entry:
+        config = self.configs[name]
+        vh = PSDVarianceHandler(config=config, lazy=self.lazy, cache_dir=self.cache_dir, backend=self.backend,
+                                incremental=True)
+        return _Entry(name, config, vh)
+
+    async def run(self, entry:_Entry, fn, *args):
+        '''在线程池中持有 entry.lock 调用 fn(*args)'''
+        def job():
+            with entry.lock:
+                return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, job)
+
+    ### render ###
+    def _layer_idxs(self, entry:_Entry, request:dict) -> list[str]:
+        '''请求中的图层/类别、差分，或 handler 当前的可见状态。渲染前先取快照，之后的 toggle 不影响本次渲染'''
+        vh = entry.vh
+        if (names := request.get('layers')) is not None:
+            return get_specific_layer_idxs(vh, names, request.get('visible', False))
+        if (variant := request.get('variant')) is not None:
+            compiled = entry.compiled()
+            state = compiled.variant_to_state({tuple(path): tuple(v) for path, v in variant})
+            return sorted(compiled.visible_layer_idxs(compiled.mask_of(state)))
+        return sorted(vh.get_all_visible_layers(original=True))
+
+    def _render_job(self, entry:_Entry, layer_idxs:list[str], backend:str, viewport, level:int,
+                    encoder:Encoder) -> bytes:
+        with entry.lock:
+            image = entry.vh.render(layer_idxs, backend, viewport, level)
+        # 编码不访问 handler，可以与其他渲染并行
+        return encoder.encode(image)
+
+    async def render(self, entry:_Entry, layer_idxs:list[str], backend:str|None=None, viewport=None,
+                     level:int=0, encoder:Encoder|None=None) -> bytes:
+        '''渲染并编码，参数相同且仍在进行中的请求共享同一个结果'''
+        encoder = encoder or Encoder()
+        backend = backend or entry.vh.backend
+        viewport = tuple(viewport) if viewport is not None else None
+        key = (entry.name, entry.vh.revision, tuple(sorted(set(layer_idxs))), backend, viewport, level, encoder.spec)
+        if (future := self._inflight.get(key)) is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+        loop = asyncio.get_running_loop()
+        future = self._inflight[key] = loop.run_in_executor(
+            self.executor, self._render_job, entry, list(key[2]), backend, viewport, level, encoder)
+        self.rendered += 1
+        # 渲染结束时才移除，某个等待者被取消不影响其他请求合并到这次渲染
+        def done(_):
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+        future.add_done_callback(done)
+        # shield: 某个客户端断开时不取消其他请求共享的渲染
+        return await asyncio.shield(future)
+
+    ### routes ###
+    async def handle_handlers(self, request:dict):
+        return [{'name': name, 'config': config, 'loaded': name in self._entries,
+                 'revision': self._entries[name].vh.revision if name in self._entries else None}
+                for name, config in self.configs.items()]
+
+    async def handle_metrics(self, request:dict):
+        aggregator = tracing.aggregator()
+        return {
+            'rendered': self.rendered,
+            'coalesced': self.coalesced,
+            'inflight': len(self._inflight),
+            'tracing': aggregator.snapshot() if aggregator is not None else None,
+        }
+
+    async def handle_render(self, request:dict):
+        entry = await self.entry(request.get('handler'))
+        try:
+            encoder = Encoder.parse(request.get('format', 'png'))
+        except ValueError:
+            raise VHError(f"无法解析输出格式: {request.get('format')}")
+        backend = request.get('backend')
+        if backend is not None and backend not in psd_handler.BACKENDS:
+            raise VHError(f"未知的合成后端: {backend}")
+        layer_idxs = await self.run(entry, self._layer_idxs, entry, request)
+        data = await self.render(entry, layer_idxs, backend, request.get('viewport'),
+                                 int(request.get('level', 0)), encoder)
+        return data, CONTENT_TYPES[encoder.format]
+
+    async def handle_toggle(self, request:dict):
+        entry = await self.entry(request.get('handler'))
+        if 'target' not in request or not request.get('parents'):
+            raise VHError("toggle 需要 target 与 parents (从 root 到目标所在类别的类别名，不含 root)")
+        return await self.run(entry, self._toggle, entry, request['target'], list(request['parents']))
+    def _toggle(self, entry:_Entry, target:str, parents:list[str]) -> dict:
+        reverse_visibility(entry.vh, target, parents)
+        entry.generation += 1
+        return {
+            'layers': sorted(entry.vh.get_all_visible_layers(original=True)),
+            'name': entry.vh.root.variant_name(entry.vh.root.get_variant()),
+        }
+
+    async def handle_enumerate(self, request:dict):
+        entry = await self.entry(request.get('handler'))
+        return await self.run(entry, self._enumerate, entry, request)
+    def _enumerate(self, entry:_Entry, request:dict) -> dict:
+        vh = entry.vh
+        offset = int(request.get('offset', 0))
+        limit = int(request.get('limit', 100))
+        query = {k: request.get(k, ()) for k in ('require_categories', 'forbid_categories', 'require_layers', 'forbid_layers')}
+        if request.get('sample') is not None:
+            variants = vh.sample_variants(int(request['sample']), request.get('seed'),
+                                          request.get('unique', False), request.get('stratified', False))
+            total = len(variants)
+            variants = variants[offset:offset + limit]
+        elif any(query.values()):
+            variants = list(itertools.islice(vh.query_variants(**query, search_mode=request.get('search_mode', 0)),
+                                             offset, offset + limit))
+            total = None
+        else:
+            total = vh.count_variants()
+            variants = [vh.unrank_variant(k) for k in range(offset, min(offset + limit, total))]
+        compiled = entry.compiled()
+        output = []
+        for index, variant in enumerate(variants, offset):
+            state = compiled.variant_to_state(variant)
+            output.append({
+                'index': index,
+                'name': vh.root.variant_name(variant),
+                'variant': [[list(path), list(v)] for path, v in variant.items()],
+                'layers': sorted(compiled.visible_layer_idxs(compiled.mask_of(state))),
+            })
+        return {'count': total, 'offset': offset, 'variants': output}
+
+    ### HTTP ###
+    async def dispatch(self, method:str, path:str, body:bytes) -> tuple[HTTPStatus, bytes, str]:
+        path = path.split('?', 1)[0]
+        if (route := self.routes.get((method, path))) is None:
+            if any(p == path for _, p in self.routes):
+                raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED, f"{method} {path}")
+            raise HTTPError(HTTPStatus.NOT_FOUND, path)
+        try:
+            request = json.loads(body) if body else {}
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"请求不是合法的 JSON: {e}")
+        if not isinstance(request, dict):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "请求必须是 JSON 对象")
+        result = await route(request)
+        if isinstance(result, tuple):
+            return HTTPStatus.OK, result[0], result[1]
+        return HTTPStatus.OK, json.dumps(result, ensure_ascii=False).encode(), 'application/json'
+
+    async def _respond(self, request_line:bytes, body:bytes):
+        try:
+            method, path, _ = request_line.decode('latin-1').split(' ', 2)
+            return await self.dispatch(method, path, body)
+        except HTTPError as e:
+            status, message = e.status, str(e)
+        except NotAllowedError as e:
+            status, message = HTTPStatus.CONFLICT, str(e)
+        except (VHError, KeyError, TypeError, ValueError) as e:
+            status, message = HTTPStatus.BAD_REQUEST, str(e)
+        except Exception as e:
+            status, message = HTTPStatus.INTERNAL_SERVER_ERROR, f"{type(e).__name__}: {e}"
+        tracing.log(f"{request_line.decode('latin-1').strip()} -> {status.value} {message}")
+        return _error(status, message)
+
+    async def handle_connection(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        '''最简单的 HTTP/1.1：支持 Content-Length 请求体与 keep-alive'''
+        self._connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    length = int(headers.get('content-length', 0))
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    # 无法确定请求体在哪里结束，回复后关闭连接
+                    status, data, content_type = _error(
+                        HTTPStatus.BAD_REQUEST, f"Content-Length 不是合法的长度: {headers['content-length']}")
+                    keep_alive = False
+                elif length > MAX_BODY:
+                    status, data, content_type = HTTPStatus.REQUEST_ENTITY_TOO_LARGE, b'{}', 'application/json'
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    status, data, content_type = await self._respond(request_line, body)
+                    keep_alive = headers.get('connection', '').lower() != 'close' and request_line.rstrip().endswith(b'1.1')
+                writer.write(
+                    f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(data)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._connections.pop(writer, None)
+            writer.close()
+
+    async def start(self, host:str='127.0.0.1', port:int=8765, unix:str|None=None) -> asyncio.AbstractServer:
+        '''开始监听，port=0 时由系统分配端口。只允许本机地址'''
+        if unix is not None:
+            self._server = await asyncio.start_unix_server(self.handle_connection, unix)
+        else:
+            if host != 'localhost':
+                try:
+                    loopback = ipaddress.ip_address(host).is_loopback
+                except ValueError:
+                    # 主机名不解析，避免经 DNS 指向非本机地址
+                    loopback = False
+                if not loopback:
+                    raise VHError(f"渲染服务只能监听本机地址: {host}，需要 loopback 地址或 unix socket")
+            self._server = await asyncio.start_server(self.handle_connection, host, port)
+        return self._server
+    @property
+    def address(self):
+        return self._server.sockets[0].getsockname() if self._server else None
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            # 关闭空闲的 keep-alive 连接，否则 wait_closed 会一直等待
+            connections = list(self._connections.items())
+            for writer, _ in connections:
+                writer.close()
+            await asyncio.gather(*(task for _, task in connections), return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+        self.executor.shutdown(wait=True)
+
+async def serve(service:RenderService, host:str='127.0.0.1', port:int=8765, unix:str|None=None):
+    server = await service.start(host, port, unix)
+    print(f"渲染服务已启动: {unix or service.address}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='PSD 差分本地渲染服务')
+    parser.add_argument('configs', nargs='+', help='vh_config.json，可以有多个，以文件名区分')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=8765)
+    parser.add_argument('--unix', help='监听 Unix 套接字而不是 TCP')
+    parser.add_argument('-j', '--jobs', type=int, help='渲染线程数')
+    parser.add_argument('--backend', default='pil', choices=psd_handler.BACKENDS)
+    parser.add_argument('--lazy', action='store_true')
+    parser.add_argument('--cache-dir')
+    parser.add_argument('-v', '--verbose', action='store_true', help='输出日志')
+    parser.add_argument('--trace', help='把计时与计数写成 JSON Lines')
+    args = parser.parse_args(argv)
+    # 汇总常开，开销很小，由 /metrics 查看
+    sinks = [tracing.Aggregator()]
+    if args.verbose:
+        sinks.append(tracing.LogSink())
+    if args.trace:
+        sinks.append(tracing.JSONLinesSink(args.trace))
+    tracing.enable(*sinks)
+    configs = {}
+    for config in args.configs:
+        name = os.path.splitext(os.path.basename(config))[0]
+        if name in configs:
+            raise VHError(f"配置名重复: {name}")
+        configs[name] = config
+    service = RenderService(configs, args.jobs, args.lazy, args.cache_dir, args.backend)
+    try:
+        asyncio.run(serve(service, args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+'''
+handler 状态的二进制快照：类别树、图层下标/名称索引、叶子图层、z 序与图层范围。
+
+从快照恢复不需要解析 vh_config.json、逐个 from_dict/check_visibility 重建类别，也不需要打开 PSD；
+只有真正用到图层对象或像素时 handler 才打开 PSD。快照记录 PSD 与配置文件的修改时间、大小与 sha256，
+修改时间不同但内容哈希相同时仍然有效，否则视为过期。
+文件格式为 MAGIC、版本号与 Python 版本，之后是 marshal 序列化的字典，只含内置类型。
+'''
+import hashlib, marshal, os, struct, sys
+
+import tracing
+
+MAGIC = b'VHSNAP\0\0'
+SNAPSHOT_VERSION = 3
+_HEADER = struct.Struct('<IBB')
+
+def snapshot_path(config:str) -> str:
+    '''配置文件对应的默认快照路径：vh_config.json -> vh_config.vhsnap'''
+    return os.path.splitext(config)[0] + '.vhsnap'
+
+def _hash(path:str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _stamp(path:str) -> tuple[int, int, str]:
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size, _hash(path)
+
+def _is_fresh(path:str, stamp:tuple[int, int, str]) -> bool:
+    '''修改时间与大小一致直接认为未变；只有修改时间不同时才计算哈希'''
+    mtime, size, digest = stamp
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    if st.st_size != size:
+        return False
+    return st.st_mtime_ns == mtime or _hash(path) == digest
+
+def _flatten(root) -> list[tuple]:
+    '''先序排列的 (名称, 模式, 子类别数, 图层, 可见性字节)'''
+    nodes = []
+    stack = [root]
+    while stack:
+        c = stack.pop()
+        nodes.append((c.name, c.mode, len(c.subcategories), tuple(c.layers), bytes(c.visibilities)))
+        stack.extend(reversed(c.subcategories))
+    return nodes
+
+def _unflatten(nodes:list[tuple]):
+    from psd_handler import Category
+    def build(i:int):
+        name, mode, n_subs, layers, visibilities = nodes[i]
+        i += 1
+        subs = []
+        for _ in range(n_subs):
+            sub, i = build(i)
+            subs.append(sub)
+        return Category._restore(name, mode, subs, list(layers), visibilities), i
+    # 递归深度等于类别树深度
+    return build(0)[0]
+
+def save_snapshot(vh, path:str, config:str):
+    '''把 vh 的当前状态写入 path，config 为 vh 加载时使用的配置文件'''
+    payload = {
+        'psd_path': vh.psd_path,
+        'psd_stamp': _stamp(vh.psd_path),
+        'config': os.path.abspath(config),
+        'config_stamp': _stamp(config),
+        'root': _flatten(vh.root),
+        'layer_name_index': vh.layer_name_index,
+        'leaf_index': vh.leaf_index,
+        'z_order': vh.z_order,
+        'double_names': vh._double_names,
+        'layer_bbox': vh.layer_bbox,
+        'size': tuple(vh.size),
+    }
+    data = MAGIC + _HEADER.pack(SNAPSHOT_VERSION, *sys.version_info[:2]) + marshal.dumps(payload)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def load_snapshot(path:str, config:str) -> dict|None:
+    '''读取并校验快照，返回状态字典 (root 已恢复为 Category)；不存在、损坏或过期时返回 None'''
+    with tracing.span('snapshot.load'):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        offset = len(MAGIC) + _HEADER.size
+        if data[:len(MAGIC)] != MAGIC or len(data) < offset:
+            return None
+        if _HEADER.unpack_from(data, len(MAGIC)) != (SNAPSHOT_VERSION, *sys.version_info[:2]):
+            return None
+        try:
+            payload = marshal.loads(data[offset:])
+        except (EOFError, ValueError, TypeError):
+            return None
+        if payload.get('config') != os.path.abspath(config) or not _is_fresh(config, payload['config_stamp']):
+            tracing.log(f"配置已改变，快照失效: {path}")
+            return None
+        if not _is_fresh(payload['psd_path'], payload['psd_stamp']):
+            tracing.log(f"PSD 已改变，快照失效: {path}")
+            return None
+        payload['root'] = _unflatten(payload['root'])
+        return payload
@@ -0,0 +1,25 @@
+import os, sys
+
+import pytest
+
+# 模块都在仓库根目录下，没有安装成包
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.synth import generate
+from psd_handler import PSDVarianceHandler
+
+@pytest.fixture(scope='session')
+def synth(tmp_path_factory) -> tuple[str, str]:
+    '''小尺寸合成 PSD 与配置：3 个图层组、12 个图层，含不透明与非普通混合模式的图层'''
+    return generate(str(tmp_path_factory.mktemp('synth')), layers=12, depth=1, fanout=3, size=(64, 48),
+                    coverage=0.3, opaque=0.3, blend=0.3, seed=1)
+
+@pytest.fixture(scope='session')
+def synth_blend(tmp_path_factory) -> tuple[str, str]:
+    '''每个图层都轮流使用 bench.synth.BLENDS 中的非普通混合模式'''
+    return generate(str(tmp_path_factory.mktemp('synth_blend')), layers=18, depth=1, fanout=3, size=(64, 48),
+                    coverage=0.3, opaque=0.3, blend=1.0, seed=2, name='blend')
+
+@pytest.fixture
+def vh(synth) -> PSDVarianceHandler:
+    return PSDVarianceHandler(config=synth[1])
@@ -0,0 +1,49 @@
+import threading
+
+import api
+from psd_handler import PSDVarianceHandler
+
+def test_mutations_wait_for_render_lock(synth):
+    '''后台线程渲染期间持有 vh.lock，修改类别树与图层名的调用等待其释放'''
+    vh = PSDVarianceHandler(config=synth[1])
+    rendering, release = threading.Event(), threading.Event()
+    def render():
+        with vh.lock:
+            rendering.set()
+            release.wait()
+    worker = threading.Thread(target=render)
+    worker.start()
+    rendering.wait()
+
+    done = []
+    def mutate():
+        api.reverse_visibility(vh, 'L00007', ['g1'])
+        vh.rename_layer(vh.layer_name_index['L00000'], 'renamed')
+        done.append(True)
+    mutator = threading.Thread(target=mutate)
+    mutator.start()
+    mutator.join(0.1)
+    assert done == [] and vh.revision == 0
+    release.set()
+    worker.join()
+    mutator.join()
+    assert done == [True] and vh.revision == 1
+    assert 'renamed' in vh.layer_name_index
+
+def test_subtree_crops_to_visible_leaves(synth):
+    '''图层组的合成图裁剪到可见叶子图层范围的并集，与 psd_tools 的 composite() 一致'''
+    from renderer import max_difference, union_bbox
+    vh = PSDVarianceHandler(config=synth[1], render_cache_bytes=0)
+    group_idx = next(idx for idx, leaves in vh.leaf_index.items() if len(leaves) > 2)
+    group = vh.layer_dict[group_idx]
+    leaves = list(vh.leaf_index[group_idx])
+    for leaf in leaves:
+        vh.layer_dict[leaf].visible = True
+    full_bbox = union_bbox(vh.layer_bbox[idx] for idx in leaves)
+    # 隐藏决定范围边界的叶子图层后，范围随之缩小
+    hidden = next(idx for idx in leaves if union_bbox(vh.layer_bbox[i] for i in leaves if i != idx) != full_bbox)
+    vh.layer_dict[hidden].visible = False
+    expected_bbox = union_bbox(vh.layer_bbox[idx] for idx in leaves if idx != hidden)
+    _, image = api.get_psd_layers_dict(vh, group_idx, show_image=True)
+    assert image.size == (expected_bbox[2] - expected_bbox[0], expected_bbox[3] - expected_bbox[1])
+    assert max_difference(image, group.composite(force=True)) <= 2
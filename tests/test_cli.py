@@ -0,0 +1,45 @@
+import json
+
+from psd_handler import PSDVarianceHandler
+from cli import write_manifest, render_manifest, read_manifest
+
+def _done_records(manifest:str) -> list[dict]:
+    with open(manifest + '.done', 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+def test_resume(synth, tmp_path):
+    vh = PSDVarianceHandler(config=synth[1], lazy=True)
+    manifest = str(tmp_path / 'manifest.jsonl')
+    output_dir = tmp_path / 'output'
+    write_manifest(vh, synth[1], manifest, '{index:05d}.png', 'pil', vh.sample_variants(4, seed=0, unique=True))
+    _, entries = read_manifest(manifest)
+    unique = [e for e in entries if 'alias' not in e]
+    assert len(unique) > 1
+    render = lambda: render_manifest(manifest, str(output_dir), max_workers=2, progress=False, encode_workers=0)
+
+    assert render() == len(unique)
+    assert sorted(r['output'] for r in _done_records(manifest)) == sorted(e['output'] for e in unique)
+    # 全部完成后重新运行不再渲染
+    assert render() == 0
+
+    # 输出内容与 .done 中的 sha256 不一致的条目重新渲染
+    changed = output_dir / unique[0]['output']
+    changed.write_bytes(changed.read_bytes() + b'\0')
+    records = len(_done_records(manifest))
+    assert render() == 1
+    assert [r['output'] for r in _done_records(manifest)[records:]] == [unique[0]['output']]
+    assert render() == 0
+
+def test_dedupe_facts_from_workers(synth, tmp_path):
+    '''去重所需的图层属性在工作进程中计算，主进程不解码图层，结果与主进程中计算相同'''
+    vh = PSDVarianceHandler(config=synth[1], lazy=True)
+    manifest = str(tmp_path / 'workers.jsonl')
+    write_manifest(vh, synth[1], manifest, '{index:05d}.png', 'pil', max_workers=2)
+    assert vh.layer_cache.missing_facts() == [] and len(vh.layer_cache) == 0
+
+    local = PSDVarianceHandler(config=synth[1], lazy=True)
+    for idx in local.z_order:
+        local.layer_cache.facts(idx)
+    expected = str(tmp_path / 'local.jsonl')
+    write_manifest(local, synth[1], expected, '{index:05d}.png', 'pil')
+    assert read_manifest(manifest)[1] == read_manifest(expected)[1]
@@ -0,0 +1,15 @@
+import pytest
+
+from delta_export import export_deltas, DeltaReader
+from renderer import max_difference
+
+@pytest.mark.parametrize('group_by', [None, [('g0',)]])
+def test_round_trip(vh, tmp_path, group_by):
+    '''基础图 + patch 还原的每个差分与直接渲染完全相同'''
+    variants = vh.sample_variants(12, seed=0, unique=True)
+    manifest = export_deltas(vh, str(tmp_path), variants, group_by)
+    assert any(e['patch'] is not None for e in manifest['variants'])
+    reader = DeltaReader(str(tmp_path))
+    assert len(reader) == len(variants)
+    for index, image in enumerate(reader):
+        assert max_difference(image, vh.render(reader.layers(index)).convert('RGBA')) == 0
@@ -0,0 +1,38 @@
+from psd_tools import PSDImage
+
+import tracing
+from psd_handler import PSDVarianceHandler
+from renderer import max_difference
+
+def _render(psd_path:str, cache_dir:str, lazy:bool=False):
+    '''新建 handler 渲染全部叶子图层，返回 (图像, 从磁盘读取的图层数)'''
+    vh = PSDVarianceHandler(psd_path, lazy=lazy, cache_dir=cache_dir)
+    aggregator = tracing.Aggregator()
+    tracing.enable(aggregator)
+    try:
+        image = vh.render(list(vh.z_order))
+    finally:
+        tracing.disable()
+    return image, aggregator.snapshot()['counters'].get('disk_cache.hit', 0)
+
+def test_hit(synth, tmp_path):
+    image, hits = _render(synth[0], str(tmp_path))
+    assert hits == 0
+    # 延迟加载与完整解析的图层共用条目
+    for lazy in (False, True):
+        cached, hits = _render(synth[0], str(tmp_path), lazy)
+        assert hits == len(PSDVarianceHandler(synth[0]).z_order)
+        assert max_difference(cached, image) == 0
+
+def test_edit_invalidates_changed_layers(synth, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    _render(synth[0], cache_dir)
+    psd = PSDImage.open(synth[0])
+    psd[0][0].opacity = 128
+    psd[2][1].visible = False
+    path = str(tmp_path / 'edited.psd')
+    psd.save(path)
+    image, hits = _render(path, cache_dir)
+    # 只有不透明度改变的图层重新解码，可见性不影响解码结果
+    assert hits == len(PSDVarianceHandler(path).z_order) - 1
+    assert max_difference(image, PSDVarianceHandler(path).render(list(PSDVarianceHandler(path).z_order))) == 0
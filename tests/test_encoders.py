@@ -0,0 +1,61 @@
+import hashlib, os
+
+import pytest
+
+from psd_handler import VHError
+from encoders import Encoder, read_image, write_atomic
+from batch import render_jobs
+
+def _encoder(spec:str) -> Encoder:
+    try:
+        return Encoder.parse(spec)
+    except VHError as e:
+        pytest.skip(str(e))
+
+def _shm_segments() -> set[str]:
+    return set(os.listdir('/dev/shm')) if os.path.isdir('/dev/shm') else set()
+
+@pytest.mark.parametrize('spec', ['png', 'png:0', 'webp', 'raw', 'qoi'])
+def test_round_trip(vh, tmp_path, spec):
+    '''各格式都是无损的，read_image 读回与合成结果相同的像素'''
+    encoder = _encoder(spec)
+    image = vh.render(list(vh.z_order))
+    output_path = encoder.output_path(str(tmp_path / 'out.png'))
+    data = encoder.encode(image)
+    assert write_atomic(data, output_path) == hashlib.sha256(data).hexdigest()
+    restored = read_image(output_path)
+    assert restored.size == image.size
+    assert restored.convert('RGBA').tobytes() == image.convert('RGBA').tobytes()
+
+def test_unknown_format():
+    with pytest.raises(VHError):
+        Encoder.parse('bmp')
+
+def test_write_atomic_failure(tmp_path, monkeypatch):
+    output_path = str(tmp_path / 'out.png')
+    write_atomic(b'old', output_path)
+    def fail(src, dst):
+        raise OSError('disk full')
+    monkeypatch.setattr(os, 'replace', fail)
+    with pytest.raises(OSError):
+        write_atomic(b'new', output_path)
+    # 原有的输出不变，也没有留下临时文件
+    assert os.listdir(tmp_path) == ['out.png']
+    with open(output_path, 'rb') as f:
+        assert f.read() == b'old'
+
+def test_render_jobs_encode_pool(vh, tmp_path):
+    '''合成与编码分两个进程池，像素经共享内存交给编码进程；结束后不留下共享内存段'''
+    before = _shm_segments()
+    leaves = list(vh.z_order)
+    layer_sets = [leaves[:k] for k in range(1, len(leaves) + 1, 2)]
+    jobs = [(str(tmp_path / f'{i:05d}.rgba'), layer_idxs) for i, layer_idxs in enumerate(layer_sets)]
+    digests = {}
+    count = render_jobs(vh, iter(jobs), max_workers=3, max_pending=3, encoder=Encoder('raw'), encode_workers=1,
+                        on_done=lambda output_path, digest: digests.__setitem__(output_path, digest))
+    assert count == len(jobs) and set(digests) == {output_path for output_path, _ in jobs}
+    for output_path, layer_idxs in jobs:
+        with open(output_path, 'rb') as f:
+            assert hashlib.sha256(f.read()).hexdigest() == digests[output_path]
+        assert read_image(output_path).tobytes() == vh.render(layer_idxs).convert('RGBA').tobytes()
+    assert _shm_segments() - before == set()
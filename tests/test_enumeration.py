@@ -0,0 +1,201 @@
+import itertools, random
+
+import pytest
+
+from psd_handler import Category, VHError
+from compiled_category import CompiledCategory
+from variant_query import VariantQuery
+from bench.tree import generate_tree
+
+ALLOWED = {
+    'all': lambda v: all(v),
+    'one': lambda v: sum(v) == 1,
+    'or': lambda v: True,
+    'same': lambda v: len(set(v)) <= 1,
+}
+
+def brute_force(c:Category, path:tuple=()) -> list[dict]:
+    '''逐个检查全部 2**n 种可见性，不依赖 iter_variants 的实现'''
+    output = []
+    n = len(c.visibilities)
+    for visibilities in itertools.product((False, True), repeat=n):
+        if not ALLOWED[c.mode](visibilities):
+            continue
+        subs = [s for s, v in zip(c.subcategories, visibilities) if v]
+        for parts in itertools.product(*(brute_force(s, path + (s.name,)) for s in subs)):
+            variant = {path: visibilities}
+            for part in parts:
+                variant.update(part)
+            output.append(variant)
+    return output
+
+def _key(variant:dict) -> tuple:
+    return tuple(sorted(variant.items()))
+
+@pytest.fixture(params=['synth', 'tree'])
+def root(request, synth) -> Category:
+    if request.param == 'synth':
+        return _synth_root(synth[1])
+    return Category.from_dict(generate_tree(nodes=15, fanout=3, layers_per_leaf=3, seed=2))
+
+def _synth_root(config:str) -> Category:
+    import json
+    with open(config, 'r', encoding='utf-8') as f:
+        return Category.from_dict(json.load(f)['root'])
+
+def test_iter_matches_brute_force(root):
+    variants = list(root.iter_variants())
+    expected = brute_force(root)
+    assert root.count_variants() == len(variants) == len(expected)
+    assert sorted(map(_key, variants)) == sorted(map(_key, expected))
+
+def test_unrank(root):
+    variants = list(root.iter_variants())
+    assert [root.unrank_variant(k) for k in range(len(variants))] == variants
+    with pytest.raises(VHError):
+        root.unrank_variant(len(variants))
+
+def test_compiled_order(root):
+    compiled = CompiledCategory(root)
+    variants = list(root.iter_variants())
+    assert compiled.count() == len(variants)
+    assert [compiled.state_to_variant(state) for state, _ in compiled.iter_states()] == variants
+    for variant in variants:
+        assert compiled.state_to_variant(compiled.variant_to_state(variant)) == variant
+
+def test_sample_variants(root):
+    variants = list(map(_key, root.iter_variants()))
+    n = min(5, len(variants))
+    samples = root.sample_variants(n, seed=3, unique=True)
+    assert len({_key(v) for v in samples}) == n
+    assert all(_key(v) in variants for v in samples)
+    stratified = root.sample_variants(n, seed=3, stratified=True)
+    assert [variants.index(_key(v)) for v in stratified] == sorted(variants.index(_key(v)) for v in stratified)
+
+def _visible_layers(c:Category, variant:dict, path:tuple=()) -> set:
+    output = set()
+    if c.subcategories:
+        for s, v in zip(c.subcategories, variant[path]):
+            if v:
+                output |= _visible_layers(s, variant, path + (s.name,))
+    else:
+        output.update(l for l, v in zip(c.layers, variant[path]) if v)
+    return output
+
+def _categories(c:Category, path:tuple=()) -> list[tuple]:
+    output = []
+    for s in c.subcategories:
+        output.append(path + (s.name,))
+        output.extend(_categories(s, path + (s.name,)))
+    return output
+
+def test_query_matches_filter(root):
+    '''带约束的枚举与枚举全部差分后逐个过滤的结果 (含顺序) 相同'''
+    rng = random.Random(0)
+    variants = list(root.iter_variants())
+    categories = _categories(root)
+    layers = sorted(set().union(*(_visible_layers(root, v) for v in variants)))
+    sizes = []
+    for _ in range(30):
+        require_c = rng.sample(categories, rng.randint(0, 2))
+        forbid_c = rng.sample(categories, rng.randint(0, 1))
+        picked = rng.sample(layers, rng.randint(0, 3))
+        require_l, forbid_l = picked[:len(picked) // 2], picked[len(picked) // 2:]
+        def ok(variant:dict) -> bool:
+            visible = _visible_layers(root, variant)
+            return (all(path in variant for path in require_c) and not any(path in variant for path in forbid_c)
+                    and visible.issuperset(require_l) and visible.isdisjoint(forbid_l))
+        query = VariantQuery(root, require_c, forbid_c, require_l, forbid_l)
+        expected = [v for v in variants if ok(v)]
+        assert list(query) == expected
+        assert query.count() == len(expected)
+        sizes.append(len(expected))
+    # 约束既有全部剪掉的，也有只保留一部分的
+    assert 0 in sizes and any(0 < n < len(variants) for n in sizes)
+
+def test_unrank_wide_or():
+    '''宽的 'or' 类别：第 k 个差分的可见性就是 k 的二进制位'''
+    n = 2000
+    c = Category('wide', 'or', layers=[f'L{i}' for i in range(n)])
+    rng = random.Random(0)
+    for k in [0, 2 ** n - 1] + [rng.randrange(2 ** n) for _ in range(5)]:
+        assert c.unrank_variant(k)[()] == tuple(bool(k >> i & 1) for i in range(n))
+
+def test_unrank_closed_form(root, monkeypatch):
+    '''各模式都直接定位，不再逐个枚举本类别的可见性'''
+    variants = list(root.iter_variants())
+    def fail(self):
+        raise AssertionError(self.mode)
+    monkeypatch.setattr(Category, '_iter_own_visibilities', fail)
+    assert [root.unrank_variant(k) for k in range(len(variants))] == variants
+    wide = Category('wide', 'one', subcategories=[
+        Category(f's{i}', 'same', layers=['a', 'b']) for i in range(2000)])
+    assert wide.unrank_variant(2 * 1234 + 1) == {(): tuple(i == 1234 for i in range(2000)), ('s1234',): (True, True)}
+
+def test_sample_empty():
+    # 'one' 类别的图层全部被移除后没有合法的差分
+    empty = Category('empty', 'one', layers=['a'])
+    empty.layers, empty.visibilities = [], []
+    empty = Category('root', 'all', subcategories=[empty])
+    assert empty.count_variants() == 0
+    for kwargs in ({}, {'unique': True}, {'stratified': True}):
+        assert empty.sample_variants(3, seed=0, **kwargs) == []
+
+@pytest.mark.parametrize('mode, kwargs', [
+    ('all', {'forbid_layers': ['x']}),
+    ('all', {'require_layers': ['a1', 'x'], 'forbid_layers': ['y']}),
+    ('one', {'require_layers': ['x', 'y']}),
+    ('all', {'forbid_categories': [('B',)]}),
+])
+def test_query_prunes_infeasible_sibling(mode, kwargs):
+    '''后面的子类别无法满足约束时直接返回，不逐个枚举前面子类别的 2**40 种状态'''
+    wide = Category('A', 'or', layers=[f'a{i}' for i in range(40)])
+    root = Category('root', 'all', subcategories=[wide, Category('B', mode, layers=['x', 'y'])])
+    query = VariantQuery(root, **kwargs)
+    assert query.first() is None
+    assert query.count() == 0
+
+def _visible_layer_names(c:Category) -> set:
+    return set(c.get_all_visible_layers())
+
+def test_compiled_count_and_mask(root):
+    compiled = CompiledCategory(root)
+    assert compiled.count() == root.count_variants()
+    assert set(compiled.visible_layers()) == _visible_layer_names(root)
+    assert compiled.mask_of(compiled.state) == compiled.mask
+    for variant in itertools.islice(root.iter_variants(), 50):
+        state = compiled.variant_to_state(variant)
+        assert set(compiled.visible_layers(compiled.mask_of(state))) == _visible_layers(root, variant)
+
+def test_compiled_set_slot_round_trip(root):
+    '''set_visibility 后增量维护的 mask 与重新计算的一致，store/load 往返不变'''
+    compiled = CompiledCategory(root)
+    rng = random.Random(0)
+    editable = [n for n in range(len(compiled)) if compiled.nodes[n].mode in ('one', 'or', 'same') and compiled.nslots[n]]
+    for _ in range(30):
+        n = rng.choice(editable)
+        c, i = compiled.nodes[n], rng.randrange(compiled.nslots[n])
+        name = c.subcategories[i].name if c.subcategories else c.layers[i]
+        compiled.set_visibility(compiled.paths[n], name, rng.random() < 0.5)
+        compiled.check()
+        assert compiled.mask == compiled.mask_of(compiled.state)
+    state, mask = compiled.state, compiled.mask
+    compiled.store()
+    assert _visible_layer_names(root) == set(compiled.visible_layers())
+    reloaded = CompiledCategory(root)
+    assert reloaded.mask == mask
+    assert compiled.state_to_variant(state) == reloaded.state_to_variant(reloaded.state)
+    # state 中不可见子树的 sel 不进入差分，往返后 mask 不变
+    assert reloaded.mask_of(reloaded.variant_to_state(reloaded.state_to_variant(state))) == mask
+
+def test_compiled_unk_set_slot():
+    ''''unk' 节点的可见性改变后组合数与枚举随之更新'''
+    subs = [Category('a', 'or', layers=['a0', 'a1']), Category('b', 'or', layers=['b0', 'b1'])]
+    root = Category('root', 'unk', subcategories=subs, visibilities=[True, False])
+    compiled = CompiledCategory(root)
+    assert compiled.count() == 4 and len(list(compiled.iter_states())) == 4
+    compiled.set_slot(0, 1, True)
+    assert compiled.count() == 16 and len(list(compiled.iter_states())) == 16
+    compiled.set_slot(0, 0, False)
+    assert compiled.count() == 4
+    assert {compiled.sel_of(state, 0) for state, _ in compiled.iter_states()} == {0b10}
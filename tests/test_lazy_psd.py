@@ -0,0 +1,34 @@
+from psd_tools import PSDImage
+
+from psd_handler import PSDVarianceHandler
+from renderer import max_difference
+
+def _assert_same_index(psd_path:str):
+    eager = PSDVarianceHandler(psd_path)
+    lazy = PSDVarianceHandler(psd_path, lazy=True)
+    assert lazy.layer_bbox == eager.layer_bbox
+    assert lazy.z_order == eager.z_order
+    assert lazy.leaf_index == eager.leaf_index
+
+def test_layer_bbox_matches_psd_tools(synth):
+    _assert_same_index(synth[0])
+
+def test_group_bbox_skips_hidden_layers(synth, tmp_path):
+    '''图层组的范围只含可见子图层，与 psd_tools 相同'''
+    psd = PSDImage.open(synth[0])
+    psd[0][0].visible = False
+    psd[1].visible = False
+    path = str(tmp_path / 'hidden.psd')
+    psd.save(path)
+    _assert_same_index(path)
+
+def test_rename_then_fallback(synth):
+    '''延迟加载时改名后，回退到 psd_tools 合成仍包含该图层'''
+    vh = PSDVarianceHandler(synth[0], lazy=True)
+    compositor = vh.get_compositor('pil')
+    idx = next(idx for idx in vh.z_order if not compositor.supports([idx]))
+    vh.rename_layer(idx, 'renamed')
+    image = vh.render([idx])
+    expected = PSDVarianceHandler(synth[0]).render([idx], backend='psd_tools')
+    assert image.getextrema()[3][1] > 0
+    assert max_difference(image, expected) == 0
@@ -0,0 +1,115 @@
+import random
+
+from PIL import Image
+
+from renderer import RenderCache, PrefixCache, Compositor
+
+def _image(width:int=4, height:int=4) -> Image.Image:
+    # 4 通道，每张 4×4×4 = 64 字节
+    return Image.new('RGBA', (width, height))
+
+def _key(*layer_idxs:str) -> tuple:
+    return RenderCache.render_key(layer_idxs)
+
+def test_eviction_order():
+    cache = RenderCache(max_bytes=3 * 64)
+    images = {name: _image() for name in 'abcd'}
+    for name in 'abc':
+        cache.put(_key(name), images[name])
+    # 访问 a 后 b 成为最久未用的条目
+    assert cache.get(_key('a')) is images['a']
+    cache.put(_key('d'), images['d'])
+    assert _key('b') not in cache
+    assert [cache.get(_key(name)) for name in 'acd'] == [images[name] for name in 'acd']
+    assert cache.nbytes == 3 * 64
+    # 超出整个预算的图像不缓存，也不挤掉其他条目
+    cache.put(_key('big'), _image(16, 16))
+    assert _key('big') not in cache and len(cache) == 3
+
+def test_alias():
+    cache = RenderCache(max_bytes=64)
+    image = _image()
+    cache.put(_key('a'), image)
+    cache.alias(_key('a', 'hidden'), _key('a'))
+    assert cache.get(_key('a', 'hidden')) is image
+    # 目标被淘汰后别名不再返回旧图像，目标重新缓存后别名恢复
+    cache.put(_key('b'), _image())
+    assert _key('a') not in cache
+    assert cache.get(_key('a', 'hidden')) is None
+    cache.put(_key('a'), image)
+    assert cache.get(_key('a', 'hidden')) is image
+
+def test_alias_limit(monkeypatch):
+    monkeypatch.setattr(RenderCache, 'MAX_ALIASES', 3)
+    cache = RenderCache(max_bytes=64)
+    image = _image()
+    cache.put(_key('a'), image)
+    for i in range(4):
+        cache.alias(_key('a', str(i)), _key('a'))
+    # 最早的别名被丢弃
+    assert cache.get(_key('a', '0')) is None
+    assert all(cache.get(_key('a', str(i))) is image for i in range(1, 4))
+
+def test_invalidate_after_rename(vh):
+    layer_idxs = list(vh.z_order)[:3]
+    image = vh.render(layer_idxs)
+    assert vh.render(layer_idxs) is image and vh.render_cache.hits == 1
+    revision = vh.revision
+    vh.rename_layer(layer_idxs[0], 'renamed')
+    assert vh.revision == revision + 1
+    assert len(vh.render_cache) == 0
+    misses = vh.render_cache.misses
+    assert vh.render(layer_idxs) is not image
+    assert vh.render_cache.misses == misses + 1
+
+def _prefix_sharing_sets(leaves:list[str], n:int=30, seed:int=0) -> list[list[str]]:
+    '''共享底层、只在上层不同的图层集合，以及与之部分重叠的随机集合'''
+    rng = random.Random(seed)
+    base = leaves[:len(leaves) // 2]
+    output = []
+    for _ in range(n):
+        if rng.random() < 0.7:
+            output.append(base + rng.sample(leaves[len(base):], rng.randint(0, len(leaves) - len(base))))
+        else:
+            output.append(rng.sample(leaves, rng.randint(1, len(leaves))))
+    return output
+
+def _normal_leaves(vh) -> list[str]:
+    compositor = vh.get_compositor('pil')
+    return [idx for idx in vh.z_order if compositor.supports([idx])]
+
+def test_prefix_cache_matches_uncached(vh):
+    '''从缓存的前缀继续混合与从头合成逐字节相同'''
+    leaves = _normal_leaves(vh)
+    cached = Compositor(vh.layer_cache, PrefixCache(max_entries=16, interval=2))
+    plain = Compositor(vh.layer_cache)
+    for layer_idxs in _prefix_sharing_sets(leaves):
+        assert cached.composite(layer_idxs).tobytes() == plain.composite(layer_idxs).tobytes()
+    assert cached.prefix_cache.hits > 0 and len(cached.prefix_cache) > 0
+
+def test_prefix_cache_budget(vh):
+    canvas = vh.size[0] * vh.size[1] * 4
+    assert PrefixCache.for_budget((PrefixCache.MIN_ENTRIES - 1) * canvas, vh.size) is None
+    prefix_cache = PrefixCache.for_budget(PrefixCache.MIN_ENTRIES * canvas + canvas - 1, vh.size, interval=1)
+    assert prefix_cache.max_entries == PrefixCache.MIN_ENTRIES
+
+    leaves = _normal_leaves(vh)
+    cached = Compositor(vh.layer_cache, prefix_cache)
+    plain = Compositor(vh.layer_cache)
+    for layer_idxs in _prefix_sharing_sets(leaves, n=40, seed=1):
+        assert cached.composite(layer_idxs).tobytes() == plain.composite(layer_idxs).tobytes()
+        assert len(prefix_cache) <= prefix_cache.max_entries
+    assert len(prefix_cache) == prefix_cache.max_entries and prefix_cache.hits > 0
+
+def test_prefix_cache_eviction():
+    cache = PrefixCache(max_entries=2, interval=1)
+    node_a = cache.extend(cache._root, 'a', _image())
+    node_b = cache.extend(node_a, 'b', _image())
+    # 访问 a 后 b 成为最久未用的前缀，保存 c 时 b 被淘汰，其空的叶子节点一并删去
+    assert cache.lookup(['a'])[0] == 1
+    cache.extend(cache._root, 'c', _image())
+    assert node_b.image is None and 'b' not in node_a.children
+    assert cache.lookup(['a', 'b']) == (1, node_a, 1)
+    assert cache.lookup(['c'])[0] == 1 and len(cache) == 2
+    cache.clear()
+    assert len(cache) == 0 and cache.lookup(['a', 'c'])[0] == 0
@@ -0,0 +1,90 @@
+import random
+
+import pytest
+from psd_tools.constants import BlendMode
+
+from psd_handler import PSDVarianceHandler, BACKENDS
+from renderer import BLEND_FUNCS, max_difference
+import tracing
+
+def _subsets(vh, leaves=None, n:int=20, seed:int=0):
+    rng = random.Random(seed)
+    leaves = list(vh.z_order) if leaves is None else list(leaves)
+    yield []
+    yield leaves
+    for _ in range(n):
+        yield rng.sample(leaves, rng.randint(1, len(leaves)))
+
+def _supported(vh, backend:str) -> list[str]:
+    if backend == 'psd_tools':
+        return list(vh.z_order)
+    compositor = vh.get_compositor(backend)
+    return [idx for idx in vh.z_order if compositor.supports([idx])]
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_matches_psd_tools(vh, backend):
+    '''直接合成与 copy_psd(...).composite(force=True) 一致，只比较该合成器支持的图层'''
+    leaves = _supported(vh, backend)
+    assert len(leaves) > 1
+    assert vh.check_backend(backend, list(_subsets(vh, leaves)), tolerance=2) == []
+
+def test_numpy_blend_modes(synth_blend):
+    '''NumPy 合成器的每种混合模式单独及叠加时都与 psd_tools 一致'''
+    vh = PSDVarianceHandler(config=synth_blend[1])
+    leaves = _supported(vh, 'numpy')
+    assert {vh.layer_dict[idx].blend_mode for idx in leaves} == set(BLEND_FUNCS) - {BlendMode.NORMAL}
+    layer_idx_sets = [[idx] for idx in leaves] + list(_subsets(vh, leaves))
+    assert vh.check_backend('numpy', layer_idx_sets, tolerance=2) == []
+
+def test_incremental_matches_full(synth):
+    '''逐个随机切换图层时，增量合成与完整合成只有 8 位舍入误差，且确实复用了 below/above'''
+    incremental = PSDVarianceHandler(config=synth[1], incremental=True, render_cache_bytes=0)
+    full = PSDVarianceHandler(config=synth[1], render_cache_bytes=0)
+    leaves = _supported(full, 'pil')
+    rng = random.Random(1)
+    visible = set(rng.sample(leaves, len(leaves) // 2))
+    aggregator = tracing.Aggregator()
+    tracing.enable(aggregator)
+    try:
+        for _ in range(40):
+            visible ^= {rng.choice(leaves)}
+            assert max_difference(incremental.render(visible), full.render(visible)) <= 2
+    finally:
+        tracing.disable()
+    assert aggregator.snapshot()['counters'].get('incremental.reused', 0) > 0
+
+VIEWPORTS = [(5, 3, 40, 30), (-10, -6, 20, 15), (50, 30, 80, 60), (-4, -4, 70, 52)]
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_viewport_matches_crop(synth, backend):
+    '''只合成 viewport 与完整合成后裁剪相同，超出画布的部分为透明'''
+    vh = PSDVarianceHandler(config=synth[1], render_cache_bytes=0)
+    leaves = _supported(vh, backend)
+    for layer_idxs in list(_subsets(vh, leaves, n=5)):
+        full = vh.render(layer_idxs, backend)
+        for viewport in VIEWPORTS:
+            image = vh.render(layer_idxs, backend, viewport=viewport)
+            assert image.size == (viewport[2] - viewport[0], viewport[3] - viewport[1])
+            # psd_tools 的透明像素颜色不同，按预乘颜色比较
+            assert max_difference(image, full.crop(viewport)) == 0
+
+def test_viewport_preview_level(synth):
+    vh = PSDVarianceHandler(config=synth[1], render_cache_bytes=0)
+    layer_idxs = _supported(vh, 'pil')
+    full = vh.render(layer_idxs, level=1)
+    for viewport in [(2, 2, 20, 14), (-3, -3, 10, 30)]:
+        assert vh.render(layer_idxs, level=1, viewport=viewport).tobytes() == full.crop(viewport).tobytes()
+
+def test_render_bbox(vh):
+    leaves = _supported(vh, 'pil')
+    for layer_idxs in _subsets(vh, leaves, n=5):
+        image, bbox = vh.render_bbox(layer_idxs)
+        if not layer_idxs:
+            assert (image, bbox) == (None, None)
+            continue
+        full = vh.render(layer_idxs)
+        # 范围在画布内，且包含全部不透明像素
+        assert 0 <= bbox[0] < bbox[2] <= vh.size[0] and 0 <= bbox[1] < bbox[3] <= vh.size[1]
+        if (content := full.getbbox()) is not None:
+            assert bbox[:2] <= content[:2] and bbox[2] >= content[2] and bbox[3] >= content[3]
+        assert image.tobytes() == full.crop(bbox).tobytes()
@@ -0,0 +1,91 @@
+import asyncio, json
+
+import pytest
+
+from psd_handler import VHError
+from service import RenderService
+
+async def _request(address, method:str, path:str, body:bytes|dict|None=None,
+                   headers:dict|None=None) -> tuple[int, bytes]:
+    '''发送一个 Connection: close 的请求，返回 (状态码, 响应体)'''
+    if isinstance(body, dict):
+        body = json.dumps(body).encode()
+    body = body or b''
+    headers = {'Content-Length': str(len(body)), 'Connection': 'close', **(headers or {})}
+    reader, writer = await asyncio.open_connection(*address[:2])
+    writer.write(f"{method} {path} HTTP/1.1\r\n".encode()
+                 + ''.join(f"{k}: {v}\r\n" for k, v in headers.items()).encode() + b'\r\n' + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, data = response.partition(b'\r\n\r\n')
+    return int(head.split(b' ', 2)[1]), data
+
+def _serve(synth, test):
+    '''在 127.0.0.1 的随机端口上启动服务，运行 await test(service)'''
+    async def main():
+        service = RenderService({'synth': synth[1]}, max_workers=4)
+        await service.start('127.0.0.1', 0)
+        try:
+            await test(service)
+        finally:
+            await service.close()
+    asyncio.run(main())
+
+def test_coalesce(synth):
+    async def test(service:RenderService):
+        entry = await service.entry(None)
+        layer_idxs = sorted(entry.vh.z_order)
+        # 持有锁让第一次渲染停在工作线程中，其余请求都在它结束前到达
+        entry.lock.acquire()
+        tasks = [asyncio.ensure_future(service.render(entry, layer_idxs)) for _ in range(8)]
+        await asyncio.sleep(0.05)
+        entry.lock.release()
+        results = await asyncio.gather(*tasks)
+        assert service.rendered == 1 and service.coalesced == 7
+        assert len(set(results)) == 1
+        status, data = await _request(service.address, 'GET', '/metrics')
+        assert status == 200 and json.loads(data)['inflight'] == 0
+    _serve(synth, test)
+
+def test_toggle_and_enumerate(synth):
+    async def test(service:RenderService):
+        # g1 为 'or' 类别，L00007 初始不可见
+        status, data = await _request(service.address, 'POST', '/toggle', {'target': 'L00007', 'parents': ['g1']})
+        assert status == 200
+        vh = (await service.entry(None)).vh
+        assert vh.layer_name_index['L00007'] in json.loads(data)['layers']
+        status, data = await _request(service.address, 'POST', '/toggle', {'target': 'L00002', 'parents': ['g2']})
+        assert status == 409
+
+        status, data = await _request(service.address, 'POST', '/enumerate', {'offset': 1, 'limit': 3})
+        assert status == 200
+        result = json.loads(data)
+        assert result['count'] == vh.count_variants()
+        assert [v['index'] for v in result['variants']] == [1, 2, 3]
+        assert result['variants'][0]['name'] == vh.root.variant_name(vh.unrank_variant(1))
+    _serve(synth, test)
+
+def test_bad_requests(synth):
+    async def test(service:RenderService):
+        address = service.address
+        assert (await _request(address, 'POST', '/render', {'format': 'png:abc'}))[0] == 400
+        assert (await _request(address, 'POST', '/render', {'backend': 'nope'}))[0] == 400
+        assert (await _request(address, 'POST', '/render', {'layers': ['missing']}))[0] == 400
+        assert (await _request(address, 'POST', '/toggle', {'target': 'missing', 'parents': ['g1']}))[0] == 400
+        status, data = await _request(address, 'POST', '/render', headers={'Content-Length': 'abc'})
+        assert status == 400 and 'error' in json.loads(data)
+        status, data = await _request(address, 'POST', '/render', {})
+        assert status == 200 and data.startswith(b'\x89PNG')
+    _serve(synth, test)
+
+@pytest.mark.parametrize('host', ['0.0.0.0', '127.0.0.1.nip.io', 'example.com', ''])
+def test_non_loopback_host(synth, host):
+    async def main():
+        service = RenderService({'synth': synth[1]})
+        try:
+            with pytest.raises(VHError, match='loopback'):
+                await service.start(host, 0)
+        finally:
+            await service.close()
+    asyncio.run(main())
@@ -0,0 +1,32 @@
+import json, os
+
+import pytest
+from psd_tools import PSDImage
+
+from psd_handler import PSDVarianceHandler, VHError
+from snapshot import snapshot_path
+
+def test_round_trip(synth, tmp_path):
+    config = str(tmp_path / 'vh_config.json')
+    PSDVarianceHandler(config=synth[1]).save_config(config)
+    written = PSDVarianceHandler(config=config, snapshot=True)
+    assert os.path.exists(snapshot_path(config))
+    restored = PSDVarianceHandler(config=config, snapshot=True)
+    assert restored._psd is None
+    assert restored.z_order == written.z_order and restored.layer_name_index == written.layer_name_index
+
+def test_no_snapshot_for_double_names(synth, tmp_path):
+    '''重名检查失败的配置不写快照'''
+    psd = PSDImage.open(synth[0])
+    psd[1][0].name = psd[0][0].name
+    psd_path = str(tmp_path / 'double.psd')
+    psd.save(psd_path)
+    with open(synth[1], 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    data['psd_path'] = psd_path.split(os.sep)
+    config = str(tmp_path / 'vh_config.json')
+    with open(config, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    with pytest.raises(VHError):
+        PSDVarianceHandler(config=config, snapshot=True)
+    assert not os.path.exists(snapshot_path(config))
@@ -0,0 +1,116 @@
+import io, json, os, threading
+
+import pytest
+
+import tracing
+
+class ListSink:
+    def __init__(self):
+        self.spans, self.counts, self.logs = [], [], []
+    def on_span(self, record:dict):
+        self.spans.append(record)
+    def on_count(self, name:str, n:int):
+        self.counts.append((name, n))
+    def on_log(self, record:dict):
+        self.logs.append(record)
+
+@pytest.fixture(autouse=True)
+def _restore():
+    yield
+    tracing.disable()
+
+def test_disabled_is_noop():
+    sink = ListSink()
+    tracing.enable(sink)
+    tracing.disable()
+    assert not tracing.ENABLED and tracing.sinks() == []
+    with tracing.span('outer', x=1) as s:
+        s.set(y=2)
+    assert s is tracing.NULL_SPAN
+    tracing.count('n')
+    tracing.log('message')
+    tracing.replay([('count', 'n', 1)])
+    assert sink.spans == sink.counts == sink.logs == []
+
+def test_add_and_remove_sink():
+    sink = ListSink()
+    tracing.add_sink(sink)
+    tracing.add_sink(sink)
+    assert tracing.ENABLED and tracing.sinks() == [sink]
+    tracing.count('n', 3)
+    tracing.remove_sink(sink)
+    assert not tracing.ENABLED
+    tracing.count('n')
+    assert sink.counts == [('n', 3)]
+
+def test_nested_spans():
+    sink = ListSink()
+    tracing.enable(sink)
+    with tracing.span('outer', backend='pil') as outer:
+        with tracing.span('inner'):
+            pass
+        outer.set(layers=3)
+    with pytest.raises(ValueError):
+        with tracing.span('failing'):
+            raise ValueError
+    # 每个线程有自己的 span 栈
+    def other():
+        with tracing.span('thread'):
+            pass
+    with tracing.span('main'):
+        thread = threading.Thread(target=other)
+        thread.start()
+        thread.join()
+    by_name = {record['name']: record for record in sink.spans}
+    assert [record['name'] for record in sink.spans] == ['inner', 'outer', 'failing', 'thread', 'main']
+    assert by_name['inner']['parent'] == 'outer' and by_name['outer']['parent'] is None
+    assert by_name['outer']['backend'] == 'pil' and by_name['outer']['layers'] == 3
+    assert by_name['outer']['duration'] >= by_name['inner']['duration'] >= 0
+    assert by_name['failing']['error'] == 'ValueError' and 'error' not in by_name['outer']
+    assert by_name['thread']['parent'] is None
+
+def test_aggregator_and_log_sinks():
+    aggregator = tracing.Aggregator()
+    stream, lines = io.StringIO(), io.StringIO()
+    tracing.enable(aggregator, tracing.LogSink(stream, spans=True, counters=True), tracing.JSONLinesSink(lines))
+    assert tracing.aggregator() is aggregator
+    for _ in range(3):
+        with tracing.span('composite'):
+            pass
+    tracing.count('hit')
+    tracing.count('hit', 2)
+    tracing.log('fallback', backend='numpy')
+    snapshot = aggregator.snapshot()
+    assert snapshot['counters'] == {'hit': 3}
+    stat = snapshot['spans']['composite']
+    assert stat['count'] == 3 and stat['min'] <= stat['max'] <= stat['total']
+    assert 'composite' in aggregator.report() and 'hit' in aggregator.report()
+    assert 'fallback  backend=numpy' in stream.getvalue() and '[hit] +2' in stream.getvalue()
+    records = [json.loads(line) for line in lines.getvalue().splitlines()]
+    assert [r['type'] for r in records] == ['span'] * 3 + ['count'] * 2 + ['log']
+    assert all(r['pid'] == os.getpid() for r in records)
+    aggregator.reset()
+    assert aggregator.snapshot() == {'spans': {}, 'counters': {}}
+
+def test_replay_round_trip():
+    '''工作进程中 Recorder 记下的记录在主进程中转发给 sink，附加 fields'''
+    tracing.enable(recorder := tracing.Recorder())
+    assert tracing.recorder() is recorder
+    with tracing.span('outer', backend='pil'):
+        with tracing.span('inner'):
+            pass
+    tracing.count('layers_blended', 4)
+    tracing.log('done', n=1)
+    records = recorder.drain()
+    assert recorder.drain() == []
+
+    sink, aggregator = ListSink(), tracing.Aggregator()
+    tracing.enable(sink, aggregator)
+    tracing.replay(records, stage='render')
+    assert [(r['name'], r['parent'], r['stage']) for r in sink.spans] == [('inner', 'outer', 'render'), ('outer', None, 'render')]
+    assert sink.spans[1]['backend'] == 'pil' and all(r['pid'] == recorder.pid for r in sink.spans)
+    assert sink.counts == [('layers_blended', 4)]
+    assert sink.logs[0]['message'] == 'done' and sink.logs[0]['n'] == 1 and sink.logs[0]['stage'] == 'render'
+    assert aggregator.snapshot()['spans']['outer']['count'] == 1
+    tracing.replay(None)
+    assert len(sink.spans) == 2
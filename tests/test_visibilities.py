@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+from psd_handler import Category, PSDVarianceHandler, Visibilities, VHError
+
+def test_list_surface():
+    v = Visibilities([True, False, True])
+    expected = [True, False, True]
+    assert v == expected and v == tuple(expected) and v != [True, False]
+    assert list(v) == expected and v[0] is True and v[-2] is False
+    assert type(v[1:]) is Visibilities and v[1:] == [False, True]
+
+    v.insert(1, True)
+    expected.insert(1, True)
+    assert v == expected
+    v.remove(False)
+    expected.remove(False)
+    assert v == expected
+    assert v.index(True) == expected.index(True) and v.count(True) == expected.count(True)
+    with pytest.raises(ValueError):
+        v.index(False)
+    v.append(False)
+    v[0] = False
+    v[1:3] = [False, False]
+    expected.append(False)
+    expected[0] = False
+    expected[1:3] = [False, False]
+    assert v == expected and v.pop() is expected.pop() and v == expected
+
+def test_copy_and_str():
+    v = Visibilities([True, False])
+    c = v.copy()
+    assert type(c) is Visibilities and c == v
+    c[0] = False
+    assert v == [True, False]
+    assert str(v) == repr(v) == f'{v}' == '[True, False]'
+    # 错误信息中显示为 list[bool] 而不是字节串
+    c = Category('s', 'same', layers=['a', 'b'])
+    c.visibilities[0] = True
+    with pytest.raises(VHError, match=r'\[True, False\]'):
+        c.check_visibility()
+
+def _all_visibilities(c:Category, path:tuple=()) -> dict:
+    output = {path: c.visibilities}
+    for sub_c in c.subcategories:
+        output.update(_all_visibilities(sub_c, path + (sub_c.name,)))
+    return output
+
+def test_json_round_trip():
+    c = Category('root', 'all', subcategories=[
+        Category('a', 'or', layers=['x', 'y', 'z']), Category('b', 'one', layers=['u', 'v'])])
+    c.subcategories[0].visibilities = [True, False, True]
+    restored = Category.from_dict(json.loads(json.dumps(c.to_dict())))
+    assert _all_visibilities(restored) == _all_visibilities(c)
+    assert all(type(v) is Visibilities for v in _all_visibilities(restored).values())
+
+def test_snapshot_round_trip(synth, tmp_path):
+    vh = PSDVarianceHandler(config=synth[1])
+    g1 = vh.get_Categories(['g1'])[-1]
+    g1.visibilities = [not v for v in g1.visibilities]
+    config = str(tmp_path / 'vh_config.json')
+    vh.save_config(config)
+    PSDVarianceHandler(config=config, snapshot=True)
+    restored = PSDVarianceHandler(config=config, snapshot=True)
+    assert restored._psd is None
+    assert _all_visibilities(restored.root) == _all_visibilities(vh.root)
+    assert all(type(v) is Visibilities for v in _all_visibilities(restored.root).values())
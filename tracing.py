@@ -0,0 +1,241 @@
+'''
+结构化的计时与计数。
+
+    import tracing
+    tracing.enable(tracing.LogSink(), aggregator := tracing.Aggregator())
+    with tracing.span('composite', backend='pil'):
+        ...
+    tracing.count('render_cache.hit')
+    tracing.log('回退到 psd_tools 合成', backend='pil')
+    print(aggregator.report())
+
+默认关闭。关闭时 span() 返回共享的空对象，count()/log() 只检查一次 ENABLED 就返回；
+热循环中需要额外计算的计数 (如合成的像素数) 应先检查 tracing.ENABLED 再计算。
+sink 是任意实现了 on_span(record)、on_count(name, n)、on_log(record) 的对象，record 是字典。
+'''
+import json, os, sys, threading, time
+
+ENABLED = False
+_sinks:list = []
+_local = threading.local()
+
+class _NullSpan:
+    __slots__ = ()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+    def set(self, **fields):
+        pass
+
+NULL_SPAN = _NullSpan()
+
+class Span:
+    '''一次计时。fields 会原样写入记录，可以在 with 块内用 set() 追加'''
+    __slots__ = ('name', 'fields', 'start', 'parent')
+    def __init__(self, name:str, fields:dict):
+        self.name = name
+        self.fields = fields
+        self.start = 0.0
+        self.parent:str|None = None
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent = stack[-1] if stack else None
+        stack.append(self.name)
+        self.start = time.perf_counter()
+        return self
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        _local.stack.pop()
+        record = {'name': self.name, 'duration': duration, 'parent': self.parent, **self.fields}
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        for sink in _sinks:
+            sink.on_span(record)
+        return False
+    def set(self, **fields):
+        self.fields.update(fields)
+
+def span(name:str, **fields) -> Span|_NullSpan:
+    '''with tracing.span('encode', format='png'): ... 关闭时几乎没有开销'''
+    if not ENABLED:
+        return NULL_SPAN
+    return Span(name, fields)
+
+def count(name:str, n:int=1):
+    if not ENABLED:
+        return
+    for sink in _sinks:
+        sink.on_count(name, n)
+
+def log(message:str, **fields):
+    '''代替调试用的 print，只发给 sink'''
+    if not ENABLED:
+        return
+    record = {'message': message, **fields}
+    for sink in _sinks:
+        sink.on_log(record)
+
+def enable(*sinks):
+    '''以 sinks 替换当前的 sink 并开启'''
+    global ENABLED
+    _sinks[:] = sinks
+    ENABLED = bool(_sinks)
+
+def disable():
+    global ENABLED
+    ENABLED = False
+    _sinks.clear()
+
+def add_sink(sink):
+    global ENABLED
+    if sink not in _sinks:
+        _sinks.append(sink)
+    ENABLED = True
+
+def remove_sink(sink):
+    global ENABLED
+    if sink in _sinks:
+        _sinks.remove(sink)
+    ENABLED = bool(_sinks)
+
+def sinks() -> list:
+    return list(_sinks)
+
+def aggregator() -> 'Aggregator|None':
+    '''当前启用的第一个 Aggregator，没有时返回 None'''
+    return next((sink for sink in _sinks if isinstance(sink, Aggregator)), None)
+
+### sinks ###
+class LogSink:
+    '''写成人可读的行。默认只输出 log()，spans/counters 为 True 时也输出计时与计数'''
+    def __init__(self, stream=None, spans:bool=False, counters:bool=False):
+        self.stream = stream
+        self.spans = spans
+        self.counters = counters
+        self._lock = threading.Lock()
+    def _write(self, line:str):
+        stream = self.stream or sys.stderr
+        with self._lock:
+            stream.write(line + '\n')
+    @staticmethod
+    def _fields(record:dict, skip) -> str:
+        return ' '.join(f'{k}={v}' for k, v in record.items() if k not in skip and v is not None)
+    def on_span(self, record:dict):
+        if self.spans:
+            self._write(f"[{record['name']}] {record['duration'] * 1000:.2f}ms {self._fields(record, ('name', 'duration'))}")
+    def on_count(self, name:str, n:int):
+        if self.counters:
+            self._write(f"[{name}] +{n}")
+    def on_log(self, record:dict):
+        fields = self._fields(record, ('message',))
+        self._write(f"{record['message']}{'  ' + fields if fields else ''}")
+
+class JSONLinesSink:
+    '''每条记录写成一行 JSON：{"type": "span"|"count"|"log", "ts", "pid", "thread", ...}'''
+    def __init__(self, path_or_stream, counters:bool=True):
+        if isinstance(path_or_stream, str):
+            self.stream = open(path_or_stream, 'a', encoding='utf-8')
+            self._owned = True
+        else:
+            self.stream = path_or_stream
+            self._owned = False
+        self.counters = counters
+        self._lock = threading.Lock()
+    def _write(self, record:dict):
+        record.setdefault('ts', time.time())
+        record.setdefault('pid', os.getpid())
+        record.setdefault('thread', threading.current_thread().name)
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._lock:
+            self.stream.write(line + '\n')
+    def on_span(self, record:dict):
+        self._write({'type': 'span', **record})
+    def on_count(self, name:str, n:int):
+        if self.counters:
+            self._write({'type': 'count', 'name': name, 'n': n})
+    def on_log(self, record:dict):
+        self._write({'type': 'log', **record})
+    def flush(self):
+        with self._lock:
+            self.stream.flush()
+    def close(self):
+        if self._owned:
+            self.stream.close()
+
+class Aggregator:
+    '''在内存中按名称汇总计时 (次数、总计、最小、最大) 与计数，线程安全'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+    def reset(self):
+        with self._lock:
+            self.spans:dict[str, list[float]] = {}
+            self.counters:dict[str, int] = {}
+    def on_span(self, record:dict):
+        duration = record['duration']
+        with self._lock:
+            if (stat := self.spans.get(record['name'])) is None:
+                self.spans[record['name']] = [1, duration, duration, duration]
+            else:
+                stat[0] += 1
+                stat[1] += duration
+                stat[2] = min(stat[2], duration)
+                stat[3] = max(stat[3], duration)
+    def on_count(self, name:str, n:int):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+    def on_log(self, record:dict):
+        pass
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'spans': {name: {'count': c, 'total': t, 'min': lo, 'max': hi} for name, (c, t, lo, hi) in self.spans.items()},
+                'counters': dict(self.counters),
+            }
+    def report(self) -> str:
+        snapshot = self.snapshot()
+        lines = [f"{'span':24s} {'count':>8s} {'total':>10s} {'mean':>10s} {'max':>10s}"]
+        for name, s in sorted(snapshot['spans'].items(), key=lambda x: -x[1]['total']):
+            lines.append(f"{name:24s} {s['count']:8d} {s['total'] * 1000:8.1f}ms {s['total'] / s['count'] * 1000:8.2f}ms {s['max'] * 1000:8.2f}ms")
+        for name, n in sorted(snapshot['counters'].items()):
+            lines.append(f"{name:24s} {n:8d}")
+        return '\n'.join(lines)
+
+class Recorder:
+    '''保存原始记录，供工作进程把记录交回主进程 (见 replay)。计时与日志附带记录时的时间与 pid'''
+    def __init__(self):
+        self.records:list[tuple] = []
+        self.pid = os.getpid()
+    def on_span(self, record:dict):
+        self.records.append(('span', {**record, 'ts': time.time(), 'pid': self.pid}))
+    def on_count(self, name:str, n:int):
+        self.records.append(('count', name, n))
+    def on_log(self, record:dict):
+        self.records.append(('log', {**record, 'ts': time.time(), 'pid': self.pid}))
+    def drain(self) -> list[tuple]:
+        records, self.records = self.records, []
+        return records
+
+def recorder() -> Recorder|None:
+    '''当前启用的 Recorder，没有时返回 None'''
+    return next((sink for sink in _sinks if isinstance(sink, Recorder)), None)
+
+def replay(records:list[tuple]|None, **fields):
+    '''把其他进程的 Recorder 记录转发给本进程的 sink，fields 追加到每条计时与日志'''
+    if not ENABLED or not records:
+        return
+    for record in records:
+        if record[0] == 'span':
+            record = {**record[1], **fields}
+            for sink in _sinks:
+                sink.on_span(record)
+        elif record[0] == 'count':
+            for sink in _sinks:
+                sink.on_count(record[1], record[2])
+        else:
+            record = {**record[1], **fields}
+            for sink in _sinks:
+                sink.on_log(record)
@@ -0,0 +1,211 @@
+from psd_handler import Category, VHError
+
+class VariantQuery:
+    '''
+    带约束的差分枚举。约束在枚举过程中向下传递，不可能满足约束的子树直接剪枝，而不是枚举后再过滤。
+    产生的差分是 Category.iter_variants 结果中满足约束的子序列，顺序不变。
+    require_categories / forbid_categories: 必须可见 / 不可见的类别路径 (名称元组)
+    require_layers / forbid_layers: 必须可见 / 不可见的图层，由 resolve 解析成叶子图层下标
+    必须可见的图层名若包含多个叶子图层 (图层组)，则其中每个叶子图层都必须可见
+    '''
+    def __init__(self, root:Category, require_categories=(), forbid_categories=(),
+                 require_layers=(), forbid_layers=(), resolve=None):
+        '''resolve: 可选的 图层名列表 -> 叶子图层下标列表 函数 (如 PSDVarianceHandler.parse_layer)，默认以图层名本身作为下标'''
+        self.root = root
+        self._resolve = resolve if resolve is not None else (lambda names: list(names))
+        self._layer_cache:dict[str, frozenset] = {}
+        # 以下缓存都以类别路径为键，约束在构造后不变
+        self._reach:dict[tuple, frozenset] = {}
+        self._feasible:dict[tuple, bool] = {}
+        self._slot_cache:dict[tuple, tuple[set[int], set[int]]] = {}
+        # 已知没有结果的 (路径, must) 与 (路径, 剩余子类别, must)
+        self._dead:set[tuple] = set()
+        self._alive:set[tuple] = set()
+        # {类别路径: 必须可见的槽位集合} 与 {类别路径: 必须不可见的槽位集合}
+        self.forced_on:dict[tuple, set[int]] = {}
+        self.forced_off:dict[tuple, set[int]] = {}
+        for path in require_categories:
+            path = tuple(path)
+            for i in range(len(path)):
+                self._add_slot(self.forced_on, path[:i + 1])
+        for path in forbid_categories:
+            self._add_slot(self.forced_off, tuple(path))
+        self.required = frozenset(self._resolve(list(require_layers))) if require_layers else frozenset()
+        self.forbidden = frozenset(self._resolve(list(forbid_layers))) if forbid_layers else frozenset()
+        if self.required & self.forbidden:
+            raise VHError(f"图层约束互相矛盾: {sorted(self.required & self.forbidden)}")
+
+    def _add_slot(self, slots:dict[tuple, set[int]], path:tuple):
+        if len(path) == 0:
+            raise VHError("类别约束不能为空路径")
+        c = self.root
+        for name in path[:-1]:
+            if not (result := c.get_sub(name)):
+                raise VHError(f"未找到名称为 {name} 的子类别: {path}")
+            c = result[1]
+        if not (result := c.get_sub(path[-1])):
+            raise VHError(f"未找到名称为 {path[-1]} 的子类别: {path}")
+        slots.setdefault(path[:-1], set()).add(result[0])
+
+    def _layer(self, name:str) -> frozenset:
+        if (result := self._layer_cache.get(name)) is None:
+            result = self._layer_cache[name] = frozenset(self._resolve([name]))
+        return result
+
+    def _slots(self, c:Category, path:tuple) -> tuple[set[int], set[int]]:
+        '''(必须可见的槽位, 不能可见的槽位)：槽位约束、含禁止图层的图层槽位与不可能满足约束的子类别'''
+        if (result := self._slot_cache.get(path)) is not None:
+            return result
+        on = set(self.forced_on.get(path, ()))
+        off = set(self.forced_off.get(path, ()))
+        if len(c.subcategories) == 0:
+            off.update(i for i, layer in enumerate(c.layers) if self._layer(layer) & self.forbidden)
+        else:
+            off.update(i for i, sub_c in enumerate(c.subcategories) if not self.feasible(sub_c, path + (sub_c.name,)))
+        result = self._slot_cache[path] = (on, off)
+        return result
+
+    def feasible(self, c:Category, path:tuple=()) -> bool:
+        '''
+        该类别是否存在满足槽位约束与禁止图层的状态 (不考虑必须可见的图层)。
+        按模式直接判断，每个类别只算一次，不可能满足的子树在枚举前就被剪掉
+        '''
+        if (result := self._feasible.get(path)) is not None:
+            return result
+        on, off = self._slots(c, path)
+        n = len(c.visibilities)
+        if c.mode == 'all':
+            result = not off
+        elif c.mode == 'one':
+            result = len(on) <= 1 and any(i not in off and on <= {i} for i in range(n))
+        elif c.mode == 'or':
+            result = not on & off
+        elif c.mode == 'same':
+            result = not off or not on
+        else:
+            result = all((i not in off) if v else (i not in on) for i, v in enumerate(c.visibilities))
+        self._feasible[path] = result
+        return result
+
+    def reach(self, c:Category, path:tuple=()) -> frozenset:
+        '''该类别在满足约束的状态下可能可见的叶子图层下标 (上界)'''
+        if (result := self._reach.get(path)) is not None:
+            return result
+        output = set()
+        if self.feasible(c, path):
+            on, off = self._slots(c, path)
+            if c.mode == 'unk':
+                slots = [i for i, v in enumerate(c.visibilities) if v]
+            elif c.mode == 'one' and on:
+                slots = list(on)
+            else:
+                slots = [i for i in range(len(c.visibilities)) if i not in off]
+            for i in slots:
+                if len(c.subcategories) > 0:
+                    sub_c = c.subcategories[i]
+                    output.update(self.reach(sub_c, path + (sub_c.name,)))
+                else:
+                    output.update(self._layer(c.layers[i]))
+        result = self._reach[path] = frozenset(output)
+        return result
+
+    def _own_visibilities(self, c:Category, path:tuple):
+        '''满足约束的自身可见性，顺序与 Category._iter_own_visibilities 相同，调用前已确认 feasible'''
+        n = len(c.visibilities)
+        on, off = self._slots(c, path)
+        if c.mode == 'or':
+            # 只枚举自由位，按计数顺序把自由位填回，整体仍是计数顺序
+            free = [i for i in range(n) if i not in on and i not in off]
+            for x in range(1 << len(free)):
+                visibilities = [i in on for i in range(n)]
+                for j, i in enumerate(free):
+                    if x >> j & 1:
+                        visibilities[i] = True
+                yield tuple(visibilities)
+        elif c.mode == 'one':
+            for i in range(n):
+                if i not in off and on <= {i}:
+                    yield tuple(j == i for j in range(n))
+        else:
+            for visibilities in c._iter_own_visibilities():
+                if all(visibilities[i] for i in on) and not any(visibilities[i] for i in off):
+                    yield visibilities
+
+    def _iter(self, c:Category, path:tuple, must:frozenset):
+        '''产生 (差分, 可见叶子图层下标) ，其中可见图层必须覆盖 must'''
+        key = (path, must)
+        if key in self._dead or not self.feasible(c, path) or not must <= self.reach(c, path):
+            return
+        found = False
+        is_leaf = len(c.subcategories) == 0
+        for visibilities in self._own_visibilities(c, path):
+            if is_leaf:
+                visible = set()
+                for layer, v in zip(c.layers, visibilities):
+                    if v:
+                        visible.update(self._layer(layer))
+                if must <= visible:
+                    found = True
+                    yield {path: visibilities}, visible
+                continue
+            subs = [sub_c for sub_c, v in zip(c.subcategories, visibilities) if v]
+            # suffix[i]: 第 i 个及之后的可见子类别可能覆盖的图层
+            suffix = [frozenset()] * (len(subs) + 1)
+            for i in reversed(range(len(subs))):
+                suffix[i] = suffix[i + 1] | self.reach(subs[i], path + (subs[i].name,))
+            if not must <= suffix[0]:
+                continue
+            for sub_variant, visible in self._iter_product(subs, suffix, 0, path, must):
+                found = True
+                yield {path: visibilities} | sub_variant, visible
+        # 完整枚举后仍没有结果的 (类别, must) 记下来，之后不再重新搜索 (中途停止的枚举不记录)
+        if not found:
+            self._dead.add(key)
+
+    def _iter_product(self, subs:list[Category], suffix:list[frozenset], i:int, path:tuple, must:frozenset):
+        if i == len(subs):
+            yield {}, set()
+            return
+        key = (path, tuple(sub_c.name for sub_c in subs[i:]), must)
+        if key in self._dead:
+            return
+        found = False
+        sub_c = subs[i]
+        sub_path = path + (sub_c.name,)
+        # 当前子类别无论怎样都覆盖不到的图层必须由之后的子类别覆盖；之后的子类别做不到时，
+        # 不必逐个枚举当前子类别的状态再逐个失败
+        if i + 1 < len(subs) and not self._any_product(subs, suffix, i + 1, path, must - self.reach(sub_c, sub_path)):
+            self._dead.add(key)
+            return
+        # 之后的子类别都无法覆盖的图层必须由当前子类别覆盖
+        for head, head_visible in self._iter(sub_c, sub_path, must - suffix[i + 1]):
+            rest = must - head_visible
+            if not rest <= suffix[i + 1]:
+                continue
+            for tail, tail_visible in self._iter_product(subs, suffix, i + 1, path, rest):
+                found = True
+                yield head | tail, head_visible | tail_visible
+        if not found:
+            self._dead.add(key)
+
+    def _any_product(self, subs:list[Category], suffix:list[frozenset], i:int, path:tuple, must:frozenset) -> bool:
+        key = (path, tuple(sub_c.name for sub_c in subs[i:]), must)
+        if key in self._alive:
+            return True
+        if key in self._dead:
+            return False
+        if next(self._iter_product(subs, suffix, i, path, must), None) is None:
+            return False
+        self._alive.add(key)
+        return True
+
+    def __iter__(self):
+        for variant, _ in self._iter(self.root, (), self.required):
+            yield variant
+
+    def first(self) -> dict[tuple, tuple[bool]]|None:
+        '''第一个满足约束的差分，不存在时返回 None'''
+        return next(iter(self), None)
+
+    def count(self) -> int:
+        return sum(1 for _ in self)